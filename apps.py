@@ -0,0 +1,26 @@
+# web/apps.py
+import os, sys
+
+from django.apps import AppConfig
+
+
+def _is_server_process() -> bool:
+    """
+    پروسه‌ای که درخواست سرو می‌کند: runserver (فرزند autoreloader یا --noreload) یا entrypointی
+    که CHATBOT_SERVER=1 می‌گذارد (مثلاً asgi.py/wsgi.py برای uvicorn/daphne).
+    migrate/check/bench و بقیهٔ دستورهای manage.py مدل لود نمی‌کنند.
+    """
+    if os.environ.get("CHATBOT_SERVER") == "1":
+        return True
+    if sys.argv[1:2] != ["runserver"]:
+        return False
+    return os.environ.get("RUN_MAIN") == "true" or "--noreload" in sys.argv
+
+
+class WebConfig(AppConfig):
+    name = "web"
+
+    def ready(self):
+        if _is_server_process():
+            from .views.chat import warmup_on_startup
+            warmup_on_startup()
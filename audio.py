@@ -0,0 +1,385 @@
+# web/views/audio.py
+# دیکد صوت آپلودی با ffmpeg از طریق pipe (بدون فایل موقت روی دیسک)
+import asyncio, os, subprocess, threading, logging
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Tuple
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .timing import register_collector
+
+log = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+FFMPEG_BIN = getattr(settings, "FFMPEG_BIN", "ffmpeg")
+FFMPEG_MAX_PROCS = int(getattr(settings, "FFMPEG_MAX_PROCS", os.cpu_count() or 2))  # سقف decode هم‌زمان (0 = بدون سقف)
+FFMPEG_SLOT_TIMEOUT = float(getattr(settings, "FFMPEG_SLOT_TIMEOUT", 30.0))  # ثانیه انتظار برای نوبت decode
+
+_DECODE_SLOTS = threading.BoundedSemaphore(FFMPEG_MAX_PROCS) if FFMPEG_MAX_PROCS > 0 else None
+
+
+class AudioDecodeError(Exception):
+    pass
+
+
+def _ffmpeg_cmd(sample_rate: int, low_latency: bool = False) -> List[str]:
+    # ffmpeg -i pipe:0 -ac 1 -ar 16000 -f s16le pipe:1
+    # low_latency: برای حالت استریم، probe ورودی کوتاه می‌شود تا PCM بلافاصله بیرون بیاید
+    probe = ["-fflags", "nobuffer", "-probesize", "32768", "-analyzeduration", "0"] if low_latency else []
+    return [
+        FFMPEG_BIN, "-hide_banner", "-loglevel", "error",
+        *probe,
+        "-i", "pipe:0",
+        "-ac", "1", "-ar", str(sample_rate),
+        "-f", "s16le", "-acodec", "pcm_s16le", "pipe:1",
+    ]
+
+
+class PCMPipe:
+    """
+    یک پروسه‌ی ffmpeg ماندگار: chunkهای صوتی به‌تدریج با write نوشته می‌شوند و
+    PCM تک‌کاناله‌ی int16 به محض آماده شدن (بلوک‌های زوج‌بایتی) به on_pcm داده می‌شود.
+    """
+    def __init__(self, on_pcm: Callable[[bytes], None], sample_rate: int = SAMPLE_RATE,
+                 block: int = 1 << 16, low_latency: bool = False):
+        try:
+            self.proc = subprocess.Popen(
+                _ffmpeg_cmd(sample_rate, low_latency),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+        except OSError as e:
+            raise AudioDecodeError(str(e))
+        self._on_pcm = on_pcm
+        self._block = block
+        self._stderr: List[bytes] = []
+        self._errors: List[BaseException] = []
+        self._closed = False
+        self._reader = threading.Thread(target=self._pump, daemon=True)
+        self._drain = threading.Thread(target=lambda: self._stderr.append(self.proc.stderr.read()), daemon=True)
+        self._reader.start(); self._drain.start()
+
+    def _pump(self) -> None:
+        # پس از خطای on_pcm خروجی همچنان خوانده (و دور ریخته) می‌شود تا ffmpeg و write قفل نشوند
+        carry = b""
+        while True:
+            try:
+                data = self.proc.stdout.read1(self._block)
+            except BaseException as e:
+                self._errors.append(e)
+                break
+            if not data: break
+            if self._errors:
+                continue
+            if carry:
+                data = carry + data
+            if len(data) % 2:
+                data, carry = data[:-1], data[-1:]
+            else:
+                carry = b""
+            if data:
+                try:
+                    self._on_pcm(data)
+                except BaseException as e:
+                    self._errors.append(e)
+
+    def write(self, chunk: bytes) -> None:
+        if self._closed or not chunk:
+            return
+        try:
+            self.proc.stdin.write(chunk)
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            pass        # ffmpeg زودتر خارج شده؛ خطا در close از returncode گزارش می‌شود
+
+    def check(self) -> None:
+        """اولین خطای on_pcm یا خواندن خروجی را همین حالا بالا می‌برد (بلوک‌های بعد از آن دور ریخته شده‌اند)."""
+        if self._errors:
+            raise self._errors[0]
+
+    def close(self) -> None:
+        """پایان ورودی؛ منتظر می‌ماند تا همه‌ی PCM تحویل شود."""
+        if not self._closed:
+            self._closed = True
+            try: self.proc.stdin.close()
+            except Exception: pass
+        self._reader.join(); self._drain.join()
+        rc = self.proc.wait()
+        if self._errors:
+            raise self._errors[0]
+        if rc != 0:
+            err = b"".join(self._stderr).decode("utf-8", "replace").strip().splitlines()
+            raise AudioDecodeError(err[-1] if err else f"exit status {rc}")
+
+    def kill(self) -> None:
+        self._closed = True
+        try: self.proc.kill()
+        except Exception: pass
+        try: self.proc.stdin.close()
+        except Exception: pass
+        self.proc.wait()
+
+
+@contextmanager
+def decode_slot() -> Iterator[None]:
+    """
+    نوبت اجرای یک ffmpeg برای decode کامل فایل (استریم‌ها شامل نمی‌شوند)؛
+    اگر در FFMPEG_SLOT_TIMEOUT نوبت نرسد AudioDecodeError می‌دهد.
+    """
+    if _DECODE_SLOTS is None:
+        yield
+        return
+    if not _DECODE_SLOTS.acquire(timeout=FFMPEG_SLOT_TIMEOUT):
+        raise AudioDecodeError("decoder busy")
+    try:
+        yield
+    finally:
+        _DECODE_SLOTS.release()
+
+
+def decode_to_pcm(chunks: Iterable[bytes], sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """
+    chunkهای فایل آپلودی (webm/opus و …) را مستقیم به stdin ffmpeg می‌دهد و
+    PCM تک‌کاناله‌ی int16 را از stdout در یک آرایه‌ی NumPy برمی‌گرداند.
+    """
+    buf = bytearray()
+    with decode_slot():
+        pipe = PCMPipe(buf.extend, sample_rate=sample_rate)
+        try:
+            for chunk in chunks:
+                pipe.write(chunk)
+        except BaseException as e:
+            pipe.kill()
+            raise AudioDecodeError(f"input read failed: {e}")
+        pipe.close()
+    return np.frombuffer(buf, dtype=np.int16)
+
+
+async def decode_to_pcm_async(data: bytes, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """همان decode_to_pcm برای viewهای async: ffmpeg با asyncio اجرا می‌شود و event loop بلاک نمی‌شود."""
+    if _DECODE_SLOTS is not None:
+        await _acquire_decode_slot()
+    try:
+        return await _decode_async(data, sample_rate)
+    finally:
+        if _DECODE_SLOTS is not None:
+            _DECODE_SLOTS.release()
+
+
+async def _acquire_decode_slot() -> None:
+    # نوبت آزاد: بدون thread؛ وگرنه acquire(timeout) در thread اجرا می‌شود تا loop بلاک نشود
+    if _DECODE_SLOTS.acquire(blocking=False):
+        return
+    fut = asyncio.get_running_loop().run_in_executor(None, _DECODE_SLOTS.acquire, True, FFMPEG_SLOT_TIMEOUT)
+    try:
+        ok = await asyncio.shield(fut)
+    except asyncio.CancelledError:
+        # درخواست لغو شد ولی acquire در thread ادامه دارد؛ اگر نوبت گرفت پس داده شود
+        def give_back(f) -> None:
+            if not f.cancelled() and f.exception() is None and f.result():
+                _DECODE_SLOTS.release()
+        fut.add_done_callback(give_back)
+        raise
+    if not ok:
+        raise AudioDecodeError("decoder busy")
+
+
+async def _decode_async(data: bytes, sample_rate: int) -> np.ndarray:
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *_ffmpeg_cmd(sample_rate),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+    except OSError as e:
+        raise AudioDecodeError(str(e))
+    try:
+        out, err = await proc.communicate(data)
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    if proc.returncode != 0:
+        lines = err.decode("utf-8", "replace").strip().splitlines()
+        raise AudioDecodeError(lines[-1] if lines else f"exit status {proc.returncode}")
+    if len(out) % 2:
+        out = out[:-1]
+    return np.frombuffer(out, dtype=np.int16)
+
+
+def pcm_to_float32(pcm: np.ndarray) -> np.ndarray:
+    # ورودی Whisper: float32 در بازهٔ [-1, 1]
+    return pcm.astype(np.float32) / 32768.0
+
+
+# ============= پیش‌پردازش: VAD، حذف سکوت، تقسیم و سقف طول =============
+VAD_ENABLED = bool(getattr(settings, "VAD_ENABLED", False))
+VAD_MODE = getattr(settings, "VAD_MODE", "energy")                      # energy | webrtc (نیازمند webrtcvad)
+VAD_AGGRESSIVENESS = int(getattr(settings, "VAD_AGGRESSIVENESS", 2))     # webrtcvad: 0..3
+VAD_FRAME_MS = int(getattr(settings, "VAD_FRAME_MS", 30))                # webrtcvad فقط 10/20/30 را می‌پذیرد
+VAD_ENERGY_DB = float(getattr(settings, "VAD_ENERGY_DB", -35.0))         # آستانه نسبت به پرانرژی‌ترین فریم
+VAD_FLOOR_DB = float(getattr(settings, "VAD_FLOOR_DB", -55.0))           # dBFS؛ پایین‌تر از این همیشه سکوت
+VAD_PAD_MS = int(getattr(settings, "VAD_PAD_MS", 200))                   # حاشیه دو طرف هر بخش گفتار
+VAD_MIN_SILENCE_MS = int(getattr(settings, "VAD_MIN_SILENCE_MS", 600))   # سکوت کوتاه‌تر بخش را نمی‌شکند
+STT_SEGMENT_SECONDS = float(getattr(settings, "STT_SEGMENT_SECONDS", 30.0))  # پنجرهٔ Whisper
+STT_MAX_SECONDS = float(getattr(settings, "STT_MAX_SECONDS", 0.0))       # سقف صوت ارسالی به مدل (0 = بدون سقف)
+
+if VAD_MODE not in ("energy", "webrtc"):
+    raise ImproperlyConfigured(f"VAD_MODE must be 'energy' or 'webrtc', not {VAD_MODE!r}")
+if VAD_MODE == "webrtc" and VAD_FRAME_MS not in (10, 20, 30):
+    raise ImproperlyConfigured(f"VAD_FRAME_MS must be 10, 20 or 30 with the webrtc VAD, not {VAD_FRAME_MS}")
+if VAD_MODE == "webrtc" and not 0 <= VAD_AGGRESSIVENESS <= 3:
+    raise ImproperlyConfigured(f"VAD_AGGRESSIVENESS must be 0..3, not {VAD_AGGRESSIVENESS}")
+if VAD_FRAME_MS <= 0:
+    raise ImproperlyConfigured(f"VAD_FRAME_MS must be positive, not {VAD_FRAME_MS}")
+
+_VAD_LOCK = threading.Lock()
+_VAD_M: Dict[str, float] = {"clips": 0, "silent_clips": 0, "truncated_clips": 0, "segments": 0,
+                            "audio_seconds_in": 0.0, "audio_seconds_out": 0.0}
+_WEBRTC_MISSING = False
+
+
+class PreparedAudio(NamedTuple):
+    segments: List[np.ndarray]      # بخش‌هایی که جداگانه (و موازی) به مدل داده می‌شوند
+    seconds_in: float
+    seconds_out: float
+    truncated: bool
+
+
+def _energy_voiced(pcm: np.ndarray, frame: int) -> np.ndarray:
+    n = len(pcm) // frame
+    x = pcm[:n * frame].astype(np.float32).reshape(n, frame) / 32768.0
+    db = 10.0 * np.log10(np.mean(x * x, axis=1) + 1e-10)
+    return db > max(float(db.max()) + VAD_ENERGY_DB, VAD_FLOOR_DB)
+
+
+def _webrtc_voiced(pcm: np.ndarray, frame: int, sample_rate: int) -> np.ndarray:
+    import webrtcvad
+    vad = webrtcvad.Vad(VAD_AGGRESSIVENESS)
+    buf = pcm.astype(np.int16, copy=False).tobytes()
+    step = frame * 2
+    return np.fromiter((vad.is_speech(buf[off:off + step], sample_rate)
+                        for off in range(0, (len(pcm) // frame) * step, step)), dtype=bool)
+
+
+def _voiced_frames(pcm: np.ndarray, frame: int, sample_rate: int) -> np.ndarray:
+    global _WEBRTC_MISSING
+    if VAD_MODE == "webrtc" and not _WEBRTC_MISSING:
+        try:
+            return _webrtc_voiced(pcm, frame, sample_rate)
+        except ImportError as e:
+            _WEBRTC_MISSING = True
+            log.warning("audio: webrtc VAD unavailable (%s), using energy VAD", e)
+    return _energy_voiced(pcm, frame)
+
+
+def voiced_spans(pcm: np.ndarray, sample_rate: int = SAMPLE_RATE) -> List[Tuple[int, int]]:
+    """بازه‌های [start, end) نمونه‌ها که گفتار دارند، با حاشیه؛ سکوت‌های کوتاه‌تر از VAD_MIN_SILENCE_MS ادغام می‌شوند."""
+    frame = max(1, sample_rate * VAD_FRAME_MS // 1000)
+    if len(pcm) < frame:
+        return [(0, len(pcm))] if len(pcm) else []
+    idx = np.flatnonzero(_voiced_frames(pcm, frame, sample_rate))
+    if not len(idx):
+        return []
+    breaks = np.flatnonzero(np.diff(idx) > max(1, VAD_MIN_SILENCE_MS // max(1, VAD_FRAME_MS)))
+    starts = np.concatenate([idx[:1], idx[breaks + 1]]) * frame
+    ends = (np.concatenate([idx[breaks], idx[-1:]]) + 1) * frame
+    pad = sample_rate * VAD_PAD_MS // 1000
+    spans: List[Tuple[int, int]] = []
+    for s, e in zip(starts.tolist(), ends.tolist()):
+        s, e = max(0, s - pad), min(len(pcm), e + pad)
+        if spans and s <= spans[-1][1]:
+            spans[-1] = (spans[-1][0], e)
+        else:
+            spans.append((s, e))
+    return spans
+
+
+def _pack(pcm: np.ndarray, spans: List[Tuple[int, int]], limit: int) -> List[np.ndarray]:
+    """بازه‌های پشت‌سرهم تا سقف limit نمونه در یک بخش کنار هم گذاشته می‌شوند؛ بازهٔ بلندتر شکسته می‌شود."""
+    out: List[np.ndarray] = []
+    cur: List[np.ndarray] = []
+    size = 0
+    for s, e in spans:
+        while e > s:
+            take = min(e - s, limit - size)
+            cur.append(pcm[s:s + take])
+            size += take
+            s += take
+            if size >= limit:
+                out.append(np.concatenate(cur))
+                cur, size = [], 0
+    if cur:
+        out.append(np.concatenate(cur))
+    return out
+
+
+def prepare_for_stt(pcm: np.ndarray, sample_rate: int = SAMPLE_RATE) -> PreparedAudio:
+    """
+    بین ffmpeg و مدل: با VAD سکوت حذف و گفتار به بخش‌های حداکثر STT_SEGMENT_SECONDS تقسیم می‌شود،
+    و مجموع صوت به STT_MAX_SECONDS محدود می‌شود. بدون VAD فقط سقف طول اعمال می‌شود.
+    """
+    spans = voiced_spans(pcm, sample_rate) if VAD_ENABLED else ([(0, len(pcm))] if len(pcm) else [])
+    truncated = False
+    if STT_MAX_SECONDS > 0:
+        budget = int(STT_MAX_SECONDS * sample_rate)
+        capped = []
+        for s, e in spans:
+            if budget <= 0:
+                truncated = True
+                break
+            if e - s > budget:
+                e, truncated = s + budget, True
+            capped.append((s, e))
+            budget -= e - s
+        spans = capped
+    if VAD_ENABLED:
+        segments = _pack(pcm, spans, max(1, int(STT_SEGMENT_SECONDS * sample_rate)))
+    else:
+        segments = [pcm[s:e] for s, e in spans]
+    kept = sum(len(x) for x in segments)
+    res = PreparedAudio(segments, len(pcm) / sample_rate, kept / sample_rate, truncated)
+    with _VAD_LOCK:
+        _VAD_M["clips"] += 1
+        _VAD_M["silent_clips"] += 0 if segments else 1
+        _VAD_M["truncated_clips"] += 1 if truncated else 0
+        _VAD_M["segments"] += len(segments)
+        _VAD_M["audio_seconds_in"] += res.seconds_in
+        _VAD_M["audio_seconds_out"] += res.seconds_out
+    return res
+
+
+def preprocess_signature() -> str:
+    """تنظیماتی که روی متن خروجی اثر دارند؛ بخشی از کلید کش متن."""
+    if not VAD_ENABLED:
+        return f"raw,max={STT_MAX_SECONDS:g}"
+    return (f"{VAD_MODE},a={VAD_AGGRESSIVENESS},f={VAD_FRAME_MS},e={VAD_ENERGY_DB:g},fl={VAD_FLOOR_DB:g},"
+            f"p={VAD_PAD_MS},s={VAD_MIN_SILENCE_MS},seg={STT_SEGMENT_SECONDS:g},max={STT_MAX_SECONDS:g}")
+
+
+def vad_stats() -> Dict[str, Any]:
+    with _VAD_LOCK:
+        out: Dict[str, Any] = dict(_VAD_M)
+    out["audio_seconds_saved"] = out["audio_seconds_in"] - out["audio_seconds_out"]
+    out.update({"enabled": VAD_ENABLED, "mode": VAD_MODE, "max_seconds": STT_MAX_SECONDS})
+    return out
+
+
+def _vad_metrics() -> List[str]:
+    s = vad_stats()
+    return [
+        "# HELP stt_audio_seconds_total Audio seconds before and after VAD trimming and length caps.",
+        "# TYPE stt_audio_seconds_total counter",
+        f'stt_audio_seconds_total{{kind="in"}} {s["audio_seconds_in"]:.3f}',
+        f'stt_audio_seconds_total{{kind="out"}} {s["audio_seconds_out"]:.3f}',
+        f'stt_audio_seconds_total{{kind="saved"}} {s["audio_seconds_saved"]:.3f}',
+        "# HELP stt_clips_total Clips passed through audio preprocessing.",
+        "# TYPE stt_clips_total counter",
+        f'stt_clips_total{{kind="all"}} {s["clips"]}',
+        f'stt_clips_total{{kind="silent"}} {s["silent_clips"]}',
+        f'stt_clips_total{{kind="truncated"}} {s["truncated_clips"]}',
+    ]
+
+
+register_collector(_vad_metrics)
@@ -0,0 +1,291 @@
+# web/management/commands/bench_chat.py
+# بنچمارک مسیر chat_api با بانک سؤالات مصنوعی و پیام‌های فارسی (هر خانوادهٔ KW_* پوشش داده می‌شود)
+#   python manage.py bench_chat --bank-sizes 200,2000,20000 --stub-encoder
+#   python manage.py bench_chat --bank-sizes 500 --rounds 3 --threads 4
+import json, random, hashlib, tempfile, threading, time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.test.runner import DiscoverRunner
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import NoReverseMatch, reverse
+
+from web.views import chat
+from web.views.timing import collect_stages
+
+_FILLER = ["من", "خیلی", "این روزها", "همیشه", "گاهی", "مدتیه", "نمی‌دونم چرا", "واقعا", "دیگه", "اصلا"]
+# شناسه‌هایی که هیوریستیک‌ها مستقیم دنبالشان می‌گردند
+_KNOWN_IDS = {
+    "anxiety": "ANX_PANIC", "ocd_related": "OCD_core", "bipolar": "BP_mania_hypomania_screen",
+    "sexual_function": "SEX_ED", "gender_identity": "GENDER_dysphoria_adult",
+}
+_RESPONSE_TYPES = ["yesno", "likert_0_3", "yesno", "text"]
+# سراسری‌های chat که بنچمارک عوض می‌کند و در پایان برمی‌گرداند
+_PATCHED = ("get_model", "QUESTIONS_FILE", "DIFF_QUESTIONS_FILE", "LABELS_FILE",
+            "BANK_EMB_FILE", "BANK_MV_EMB_FILE", "_SNAPSHOT", "QUERY_CACHE_ALIAS")
+
+
+class _StubEncoder:
+    """encoder جایگزین بدون مدل: کیسهٔ واژه‌های هش‌شده، نرمال‌شده؛ برای اجرای فقط-CPU و تکرارپذیر."""
+    def __init__(self, dim: int = 768):
+        self.dim = dim
+        self._cache: Dict[str, np.ndarray] = {}
+
+    def _word(self, w: str) -> np.ndarray:
+        v = self._cache.get(w)
+        if v is None:
+            seed = int.from_bytes(hashlib.blake2b(w.encode("utf-8"), digest_size=8).digest(), "little")
+            v = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+            self._cache[w] = v
+        return v
+
+    def encode(self, texts, convert_to_tensor=False, normalize_embeddings=False, **kwargs):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, t in enumerate(texts):
+            for w in (t or "").split():
+                out[i] += self._word(w)
+            if not out[i].any():
+                out[i, 0] = 1.0
+        if normalize_embeddings:
+            out /= np.linalg.norm(out, axis=1, keepdims=True)
+        if convert_to_tensor:
+            import torch
+            return torch.from_numpy(out)
+        return out
+
+    def eval(self):
+        return self
+
+
+def _vocab() -> List[str]:
+    words = set()
+    for name, vocab in chat.KEYWORD_SETS.items():
+        if name != "EMERGENCY_KEYWORDS":
+            words.update(vocab)
+    return sorted(words)
+
+
+def synthetic_bank(n: int, seed: int = 0) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    dids = list(chat.DEFAULT_LABELS)
+    words = _vocab()
+    bank = []
+    used_known = set()
+    for i in range(n):
+        did = dids[i % len(dids)]
+        iid = _KNOWN_IDS.get(did) if did not in used_known else None
+        used_known.add(did)
+        iid = iid or f"{did}_{i}"
+        symptom = " ".join(rng.sample(words, rng.randint(2, 4)))
+        followups = [
+            {"id": f"{iid}_F{j}", "text": " ".join(rng.sample(words, 3)) + "؟",
+             "response_type": _RESPONSE_TYPES[(i + j) % len(_RESPONSE_TYPES)]}
+            for j in range(rng.randint(2, 4))
+        ]
+        bank.append({
+            "id": iid, "disorder_id": did, "symptom": symptom,
+            "gateway": {"id": f"{iid}_G", "text": f"آیا {symptom} داشته‌ای؟"},
+            "followups": followups,
+        })
+    return {"question_bank": bank}
+
+
+def synthetic_diff_bank() -> List[Dict[str, Any]]:
+    return [
+        {"cluster": name, "title": name, "questions": [
+            {"id": f"D_{name}_{j}", "text": f"سؤال تمایز {j}", "response_type": rt}
+            for j, rt in enumerate(["yesno", "likert_0_3"])
+        ]}
+        for name in chat.DIFF_NEED_FUNCS
+    ]
+
+
+def persian_corpus(per_family: int, seed: int = 0) -> List[Dict[str, str]]:
+    """برای هر خانوادهٔ KW_* چند پیام که دست‌کم یک واژه از آن خانواده دارد."""
+    rng = random.Random(seed)
+    words = _vocab()
+    out = []
+    for name, vocab in sorted(chat.KEYWORD_SETS.items()):
+        if name == "EMERGENCY_KEYWORDS":
+            continue
+        vocab = sorted(vocab)
+        for _ in range(per_family):
+            parts = [rng.choice(_FILLER), rng.choice(vocab), "و", rng.choice(words), "دارم"]
+            out.append({"family": name, "message": " ".join(parts)})
+    return out
+
+
+def _answers(spec: Dict[str, Any], rng: random.Random) -> Dict[str, Any]:
+    ans = {}
+    for g in spec.get("groups") or []:
+        for q in g.get("questions") or []:
+            if not q.get("qid"):
+                continue
+            if q["kind"] == "yesno":
+                ans[q["qid"]] = rng.choice(["yes", "no"])
+            elif q["kind"] == "likert":
+                ans[q["qid"]] = rng.randint(0, 3)
+            else:
+                ans[q["qid"]] = "گاهی"
+    return ans
+
+
+def _pct(xs: List[float], q: float) -> float:
+    return float(np.percentile(xs, q) * 1000.0) if xs else 0.0
+
+
+class Command(BaseCommand):
+    help = "Benchmark chat_api (free message + batch_submit) on synthetic banks and a Persian corpus; per-stage p50/p95/p99."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bank-sizes", default="200,2000")
+        parser.add_argument("--per-family", type=int, default=3, help="messages per KW_* family")
+        parser.add_argument("--rounds", type=int, default=1)
+        parser.add_argument("--threads", type=int, default=1)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--stub-encoder", action="store_true", help="hashed bag-of-words encoder instead of the model")
+        parser.add_argument("--no-cache", action="store_true", help="disable the query embedding/ranking cache")
+        parser.add_argument("--json", action="store_true", help="print the report as JSON")
+
+    def handle(self, *args, **opts):
+        # Client جلسه‌ها را در دیتابیس می‌نویسد؛ دیتابیس تست جدا، نه دیتابیس تنظیم‌شده
+        try:
+            setup_test_environment()
+            own_env = True
+        except RuntimeError:
+            own_env = False
+        try:
+            runner = DiscoverRunner(verbosity=0, interactive=False)
+            old_dbs = runner.setup_databases()
+            try:
+                report = self._run_restoring(opts)
+            finally:
+                runner.teardown_databases(old_dbs)
+        finally:
+            if own_env:
+                teardown_test_environment()
+
+        if opts["json"]:
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+            return
+        for r in report:
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f"bank={r['bank_size']} requests={r['requests']} wall={r['wall_seconds']:.2f}s "
+                f"throughput={r['throughput_rps']:.1f} req/s (bank load {r['bank_load_seconds']:.2f}s)"
+            ))
+            for flow, stages in r["flows"].items():
+                self.stdout.write(f"  {flow}")
+                for name, s in stages.items():
+                    self.stdout.write(f"    {name:<12} n={s['n']:<5} p50={s['p50_ms']:8.2f}ms "
+                                      f"p95={s['p95_ms']:8.2f}ms p99={s['p99_ms']:8.2f}ms")
+
+    def _run_restoring(self, opts) -> List[Dict[str, Any]]:
+        saved = {name: getattr(chat, name) for name in _PATCHED}
+        saved_sizes = (chat._EMB_CACHE.maxsize, chat._ROWS_CACHE.maxsize)
+        try:
+            return self._run(opts)
+        finally:
+            for name, value in saved.items():
+                setattr(chat, name, value)
+            chat._EMB_CACHE.maxsize, chat._ROWS_CACHE.maxsize = saved_sizes
+            for c in (chat._EMB_CACHE, chat._ROWS_CACHE):
+                c.clear()
+
+    def _run(self, opts) -> List[Dict[str, Any]]:
+        # کش مشترک Django هیچ‌وقت: امبدینگ stub یا پرسش‌های مصنوعی زیر کلید مدل واقعی برای workerهای دیگر نوشته می‌شد
+        chat.QUERY_CACHE_ALIAS = None
+        if opts["stub_encoder"]:
+            stub = _StubEncoder()
+            chat.get_model = lambda: stub
+        if opts["no_cache"]:
+            chat._EMB_CACHE.maxsize = chat._ROWS_CACHE.maxsize = 0
+        try:
+            url = reverse("web:chat_api")
+        except NoReverseMatch:
+            url = "/api/chat/"
+
+        corpus = persian_corpus(opts["per_family"], opts["seed"])
+        report = []
+        with tempfile.TemporaryDirectory(prefix="bench_chat_") as tmp:
+            for size in [int(s) for s in opts["bank_sizes"].split(",") if s.strip()]:
+                report.append(self._run_size(Path(tmp) / str(size), size, url, corpus, opts))
+        return report
+
+    def _run_size(self, d: Path, size: int, url: str, corpus, opts) -> Dict[str, Any]:
+        d.mkdir(parents=True)
+        (d / "questions.json").write_text(json.dumps(synthetic_bank(size, opts["seed"]), ensure_ascii=False), "utf-8")
+        (d / "diff.json").write_text(json.dumps(synthetic_diff_bank(), ensure_ascii=False), "utf-8")
+        (d / "labels.json").write_text("{}", "utf-8")
+        chat.QUESTIONS_FILE = d / "questions.json"
+        chat.DIFF_QUESTIONS_FILE = d / "diff.json"
+        chat.LABELS_FILE = d / "labels.json"
+        chat.BANK_EMB_FILE = d / "bank_emb.npy"
+        chat.BANK_MV_EMB_FILE = d / "bank_emb.mv.npy"
+        for c in (chat._EMB_CACHE, chat._ROWS_CACHE):
+            c.clear()
+
+        t0 = time.perf_counter()
+        snap = chat.reload_bank(force=True)
+        snap.emb()
+        snap.vector_index()
+        load_s = time.perf_counter() - t0
+
+        samples: Dict[str, Dict[str, List[float]]] = {"message": {}, "batch_submit": {}}
+        lock = threading.Lock()
+        work = [m for _ in range(opts["rounds"]) for m in corpus]
+
+        def record(flow: str, stages: Dict[str, float], total: float) -> None:
+            with lock:
+                bucket = samples[flow]
+                for k, v in stages.items():
+                    bucket.setdefault(k, []).append(v)
+                bucket.setdefault("other", []).append(max(0.0, total - sum(stages.values())))
+                bucket.setdefault("total", []).append(total)
+
+        def post(client: Client, flow: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+            with collect_stages() as stages:
+                t = time.perf_counter()
+                resp = client.post(url, data=json.dumps(payload, ensure_ascii=False), content_type="application/json")
+                total = time.perf_counter() - t
+            if resp.status_code != 200:
+                raise RuntimeError(f"{flow}: HTTP {resp.status_code}: {resp.content[:200]!r}")
+            record(flow, dict(stages), total)
+            return json.loads(resp.content)
+
+        errors: List[BaseException] = []
+
+        def worker(items, seed):
+            # خطای thread جمع می‌شود تا دستور با شکست تمام شود، نه با گزارش ناقص
+            try:
+                client = Client()
+                rng = random.Random(seed)
+                for m in items:
+                    res = post(client, "message", {"message": m["message"]})
+                    if res.get("ui") == "batch":
+                        post(client, "batch_submit", {"action": "batch_submit", "answers": _answers(res, rng)})
+            except BaseException as e:
+                with lock:
+                    errors.append(e)
+
+        n = max(1, opts["threads"])
+        threads = [threading.Thread(target=worker, args=(work[i::n], opts["seed"] + i)) for i in range(n)]
+        t0 = time.perf_counter()
+        for t in threads: t.start()
+        for t in threads: t.join()
+        wall = time.perf_counter() - t0
+        if errors:
+            raise CommandError(f"bank={size}: {len(errors)} worker(s) failed: {errors[0]!r}") from errors[0]
+
+        requests = sum(len(b.get("total", [])) for b in samples.values())
+        if not requests:
+            raise CommandError(f"bank={size}: no requests completed")
+        flows = {
+            flow: {name: {"n": len(xs), "p50_ms": _pct(xs, 50), "p95_ms": _pct(xs, 95), "p99_ms": _pct(xs, 99)}
+                   for name, xs in bucket.items()}
+            for flow, bucket in samples.items() if bucket
+        }
+        return {"bank_size": size, "bank_load_seconds": load_s, "requests": requests,
+                "wall_seconds": wall, "throughput_rps": requests / wall if wall else 0.0, "flows": flows}
@@ -0,0 +1,127 @@
+# web/management/commands/bench_encoder.py
+# مقایسهٔ بک‌اندهای encoder (torch / torch_int8 / onnx) با مرجع fp32:
+#   پاریتی امبدینگ بانک، هم‌خوانی رتبه‌بندی با min_sim، تأخیر encode و حافظهٔ RSS
+#   python manage.py bench_encoder [--backends torch_int8,onnx] [--queries-file q.txt] [--min-cos 0.98]
+import gc, time
+
+import numpy as np
+import torch
+from django.core.management.base import BaseCommand, CommandError
+
+from web.views.chat import (
+    ENCODER_BACKENDS, get_device, load_encoder, _encode_texts, current_snapshot, rank_by_sims,
+)
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _pct(xs, q) -> float:
+    return float(np.percentile(xs, q) * 1000.0) if xs else 0.0
+
+
+class Command(BaseCommand):
+    help = "Check encoder backends against fp32 bank embeddings (parity, ranking at min_sim) and benchmark latency/RSS."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--backends", default=",".join(b for b in ENCODER_BACKENDS if b != "torch"))
+        parser.add_argument("--queries-file", default=None, help="one query per line (default: gateway/followup texts of the bank)")
+        parser.add_argument("--limit", type=int, default=200)
+        parser.add_argument("--min-sim", type=float, default=0.45)
+        parser.add_argument("--top-k", type=int, default=5)
+        parser.add_argument("--min-cos", type=float, default=0.98)
+        parser.add_argument("--min-agree", type=float, default=0.95)
+
+    def _queries(self, snap, path, limit):
+        if path:
+            with open(path, encoding="utf-8") as f:
+                qs = [ln.strip() for ln in f if ln.strip()]
+        else:
+            qs = []
+            for it in snap.bank:
+                gw = (it.get("gateway") or {}).get("text")
+                if gw: qs.append(gw)
+                qs.extend(f.get("text") for f in (it.get("followups") or []) if f.get("text"))
+            qs = list(dict.fromkeys(qs))
+        return qs[:limit]
+
+    def _run(self, backend, titles, queries):
+        gc.collect()
+        rss0 = _rss_mb()
+        t0 = time.perf_counter()
+        model = load_encoder(backend)
+        load_s = time.perf_counter() - t0
+        bank = _encode_texts(titles, model=model)
+        lat = []
+        qemb = []
+        for q in queries:
+            t = time.perf_counter()
+            qemb.append(_encode_texts([q], batch_size=1, model=model)[0])
+            lat.append(time.perf_counter() - t)
+        rss = _rss_mb() - rss0
+        del model
+        gc.collect()
+        return {"load_s": load_s, "rss_mb": rss, "lat": lat,
+                "bank": bank, "queries": np.stack(qemb) if qemb else np.zeros((0, bank.shape[1]), np.float32)}
+
+    def _ranks(self, snap, bank, queries, top_k, min_sim):
+        sims = torch.from_numpy(queries @ bank.T).to(get_device())
+        return [[d for d, _, _ in rank_by_sims(sims[i], top_k=top_k, min_sim=min_sim, snap=snap)]
+                for i in range(sims.shape[0])], sims.cpu().numpy()
+
+    def _report(self, name, r):
+        self.stdout.write(
+            f"{name:<11} load={r['load_s']:.2f}s rss=+{r['rss_mb']:.0f}MB "
+            f"encode p50={_pct(r['lat'], 50):.1f}ms p95={_pct(r['lat'], 95):.1f}ms"
+        )
+
+    def handle(self, *args, **opts):
+        backends = [b.strip() for b in opts["backends"].split(",") if b.strip()]
+        for b in backends:
+            if b not in ENCODER_BACKENDS:
+                raise CommandError(f"unknown backend {b!r}; choose from {', '.join(ENCODER_BACKENDS)}")
+        snap = current_snapshot()
+        if not snap.titles:
+            raise CommandError("question bank is empty")
+        queries = self._queries(snap, opts["queries_file"], opts["limit"])
+        top_k, min_sim = opts["top_k"], opts["min_sim"]
+
+        ref = self._run("torch", snap.titles, queries)
+        self._report("torch(fp32)", ref)
+        ref_ranks, ref_sims = self._ranks(snap, ref["bank"], ref["queries"], top_k, min_sim)
+
+        failed = []
+        for b in backends:
+            if b == "torch":
+                continue
+            try:
+                r = self._run(b, snap.titles, queries)
+            except Exception as e:
+                self.stdout.write(self.style.WARNING(f"{b:<11} unavailable: {e}"))
+                continue
+            self._report(b, r)
+            cos = np.sum(ref["bank"] * r["bank"], axis=1)
+            ranks, sims = self._ranks(snap, r["bank"], r["queries"], top_k, min_sim)
+            agree = sum(a == c for a, c in zip(ref_ranks, ranks)) / max(1, len(ranks))
+            flips = int(np.count_nonzero((ref_sims >= min_sim) != (sims >= min_sim)))
+            speedup = _pct(ref["lat"], 50) / max(1e-9, _pct(r["lat"], 50))
+            self.stdout.write(
+                f"{'':<11} bank cos mean={cos.mean():.4f} min={cos.min():.4f} | "
+                f"top-{top_k}@{min_sim} identical={agree:.1%} over {len(ranks)} queries, "
+                f"threshold flips={flips} | p50 speedup x{speedup:.2f}"
+            )
+            if cos.min() < opts["min_cos"] or agree < opts["min_agree"]:
+                failed.append(b)
+
+        if failed:
+            raise CommandError(f"parity below threshold for: {', '.join(failed)}")
+        self.stdout.write(self.style.SUCCESS("parity ok"))
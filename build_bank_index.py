@@ -0,0 +1,50 @@
+# web/management/commands/build_bank_index.py
+# ساخت فایل امبدینگ بانک سؤالات برای بارگذاری سریع (mmap) در workerها
+#   python manage.py build_bank_index [--out path/to/bank_emb.npy]
+#   python manage.py build_bank_index --index ivf --recall 200     # + ایندکس تقریبی و سنجش recall@k
+# ایندکس روی امبدینگ‌های همان --out ساخته و کنارش نوشته می‌شود؛ runtime فقط کنار CHATBOT["BANK_EMB_FILE"] را می‌خواند.
+from pathlib import Path
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from web.views.chat import (
+    build_bank_emb_file, build_vector_index_file, _encode_texts,
+    BANK_EMB_FILE, VECTOR_INDEX,
+)
+from web.views.vindex import INDEX_KINDS, FlatIndex, recall_at_k
+
+
+class Command(BaseCommand):
+    help = "Encode question bank titles once and write the normalized embedding matrix for mmap loading."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--out", default=str(BANK_EMB_FILE))
+        parser.add_argument("--index", choices=INDEX_KINDS, default=VECTOR_INDEX,
+                            help="also build and persist this vector index next to the embedding file")
+        parser.add_argument("--recall", type=int, default=0, metavar="N",
+                            help="measure recall@k of the index against exact search on N bank followup/gateway texts")
+
+    def handle(self, *args, **opts):
+        meta = build_bank_emb_file(opts["out"])
+        self.stdout.write(self.style.SUCCESS(
+            f"wrote {meta['count']}x{meta['dim']} {meta['dtype']} -> {opts['out']} ({meta['fingerprint'][:12]})"
+        ))
+        if opts["index"] == "flat":
+            return
+        snap, vi = build_vector_index_file(opts["index"], opts["out"])
+        self.stdout.write(self.style.SUCCESS(f"wrote {vi.kind} index over {len(vi)} rows"))
+        if Path(opts["out"]) != Path(BANK_EMB_FILE):
+            self.stdout.write(self.style.WARNING(
+                f"--out differs from BANK_EMB_FILE ({BANK_EMB_FILE}); point BANK_EMB_FILE at {opts['out']} to use this index"
+            ))
+        if opts["recall"]:
+            texts = []
+            for it in snap.bank:
+                gw = (it.get("gateway") or {}).get("text")
+                if gw: texts.append(gw)
+                texts.extend(f.get("text") for f in (it.get("followups") or []) if f.get("text"))
+            texts = list(dict.fromkeys(texts))[:opts["recall"]]
+            queries = _encode_texts(texts) if texts else np.zeros((0, snap.search_np.shape[1]), np.float32)
+            rec = recall_at_k(vi, FlatIndex(snap.search_np), queries)
+            self.stdout.write("  ".join(f"recall@{k}={v:.3f}" for k, v in rec.items()) + f"  ({len(queries)} queries)")
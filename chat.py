@@ -1,886 +1,1914 @@
-# web/views/chat.py
-import os, json, re
-from pathlib import Path
-from typing import Dict, Any, List, Optional, Set, Tuple
-from functools import lru_cache
-
-from django.http import JsonResponse, HttpRequest
-from django.shortcuts import render
-from django.conf import settings
-from django.views.decorators.csrf import ensure_csrf_cookie
-
-import torch
-from sentence_transformers import SentenceTransformer, util
-
-# ============= تنظیمات پایه =============
-CHAT_TEMPLATE = "chatbot/customer/page-bot-chat.html"
-DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-BASE_DIR: Path = Path(settings.BASE_DIR)
-CHATBOT_DIR: Path = BASE_DIR / "chatbot"
-
-QUESTIONS_FILE = CHATBOT_DIR / "questions_.json"                  # بانک سؤالات
-DIFF_QUESTIONS_FILE = CHATBOT_DIR / "differential_questions.json" # سؤالات تمایز
-
-SENTENCE_MODEL_NAME = settings.CHATBOT.get(
-    "SENTENCE_MODEL", "paraphrase-multilingual-mpnet-base-v2"
-)
-
-BATCH_ITEMS_PER_FAMILY = 5
-ST_BATCH_SIZE = int(os.getenv("ST_BATCH_SIZE", "8"))
-BATCH_MAX_GROUPS = 12
-
-# برچسب‌ها
-DEFAULT_LABELS: Dict[str, str] = {
-    "depression": "اختلالات خلقی مرتبط (افسردگی)",
-    "bipolar": "اختلالات خلقی مرتبط (دوقطبی/مانیا)",
-    "anxiety": "اختلالات اضطرابی",
-    "ocd_related": "وسواس فکری‌عملی و اختلالات مرتبط",
-    "trauma_stressor": "اختلالات مرتبط با تروما و استرسور",
-    "psychosis": "طیف اسکیزوفرنی و اختلالات روان‌پریشی",
-    "eating": "اختلالات خوردن",
-    "sleep_wake": "اختلالات خواب و بیداری",
-    "neurodev": "اختلالات عصبی‌رشدی",
-    "dissociative": "اختلالات گسستی",
-    "somatic": "سوماتیک/اضطراب بیماری",
-    "substance": "اختلالات مصرف مواد/الکل/تنباکو",
-    "sexual_function": "اختلالات عملکرد جنسی",
-    "paraphilic": "پارافیلیک",
-    "gender_identity": "دیفوریا/ناهماهنگی جنسیتی",  # ← اضافه شد
-    "diff": "سؤالات تمایز",
-
-    # سازگاری با لیبل‌های قدیمی عددی
-    "0": "آپنهٔ انسدادی خواب (OSA)",
-    "1": "عصبی/رشدی/زبان/خلقی (پایه/وسواس و…)",
-    "2": "اضطراب/فوبیا/سوگ و مرتبط",
-    "3": "شخصیت/نامشخص و دیگر",
-    "4": "مصرف مواد/الکل/تنباکو",
-    "5": "عملکرد جنسی/پارافیلیک",
-    "6": "ADHD/یادگیری/هماهنگی",
-    "7": "اختلالات خلقی مرتبط (افسردگی)",
-    "8": "اختلالات خواب/ریتم/PMDD/DMDD",
-    "9": "کودک/وابستگی/دفع/روان‌پریشی ناشی از ماده/جسمی",
-    "10": "سایر",
-    "22": "اختلالات خلقی مرتبط (دوقطبی/مانیا)"
-}
-
-# عبارات اضطراری
-EMERGENCY_KEYWORDS = [
-    "خودکشی","می‌خوام خودکشی","میخوام خودکشی","به خودم آسیب","کشتن خود",
-    "می‌خوام خودمو تموم کنم","تمومش کنم","میرم خودمو بکشم","به دیگران آسیب","کشتن کسی","قتل"
-]
-
-# ============= ابزار لود =============
-def _load_json(path: Path) -> Any:
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-def _load_question_bank(path: Path):
-    obj = _load_json(path)
-    bank: List[Dict[str, Any]] = obj.get("question_bank", [])
-    by_symptom = {it.get("symptom"): it for it in bank if it.get("symptom")}
-    by_id      = {it.get("id"): it for it in bank if it.get("id")}
-    return bank, by_symptom, by_id
-
-def _load_labels() -> Dict[str, str]:
-    cand = CHATBOT_DIR / "disorder_labels.json"
-    labels = DEFAULT_LABELS.copy()
-    if cand.exists():
-        try:
-            custom = _load_json(cand)
-            if isinstance(custom, dict):
-                labels.update({str(k): str(v) for k, v in custom.items()})
-        except Exception:
-            pass
-    return labels
-
-def _load_diff_bank(path: Path) -> List[Dict[str, Any]]:
-    try:
-        arr = _load_json(path)
-        if isinstance(arr, dict):
-            arr = arr.get("diff_questions", [])
-        ok = []
-        for c in (arr or []):
-            if isinstance(c, dict) and c.get("cluster") and isinstance(c.get("questions"), list):
-                ok.append(c)
-        return ok
-    except Exception:
-        return []
-
-def _norm_label(s: str) -> str:
-    s = re.sub(r"[\(\（][^)）]*[\)\）]", "", s or "")
-    return re.sub(r"\s+", " ", s).strip().lower()
-
-def normalize_yes_no(v: Any) -> str:
-    s = ("" if v is None else str(v)).strip().lower()
-    return "yes" if s in ["بله","اره","آره","yes","y","true","۱","1","✔","✓","on"] else "no"
-
-def check_emergency(text: str) -> bool:
-    t = (text or "").replace("‌", " ").lower()
-    return any(kw in t for kw in EMERGENCY_KEYWORDS)
-
-def token_count(text: str) -> int:
-    return len([w for w in re.split(r"\s+", (text or "").strip()) if w])
-
-# Session sets <-> JSON
-def _st_to_session(st: Dict[str, Any]) -> Dict[str, Any]:
-    out = dict(st)
-    for k in ("asked_ids", "asked_norms"):
-        if isinstance(out.get(k), set):
-            out[k] = list(out[k])
-    return out
-
-def _st_from_session(obj: Dict[str, Any]) -> Dict[str, Any]:
-    st = dict(obj)
-    for k in ("asked_ids", "asked_norms"):
-        if isinstance(st.get(k), list):
-            st[k] = set(st[k])
-    return st
-
-# ============= داده‌های جهانی =============
-try:
-    _BANK, _BY_SYM, _BY_ID = _load_question_bank(QUESTIONS_FILE)
-except FileNotFoundError:
-    _BANK, _BY_SYM, _BY_ID = [], {}, {}
-
-_LABELS = _load_labels()
-_BANK_TITLES = [it.get("symptom", "") for it in _BANK]
-_BANK_TITLES_NORM = [_norm_label(t) for t in _BANK_TITLES]
-_DIFF_BANK = _load_diff_bank(DIFF_QUESTIONS_FILE)
-
-# ============= مدل امبدینگ =============
-@lru_cache(maxsize=1)
-def get_model() -> SentenceTransformer:
-    m = SentenceTransformer(SENTENCE_MODEL_NAME)
-    try: m = m.to(DEVICE)
-    except Exception: pass
-    return m
-
-@lru_cache(maxsize=1)
-def get_bank_emb():
-    if not _BANK_TITLES:
-        return None
-    m = get_model()
-    emb = m.encode(
-        _BANK_TITLES,
-        convert_to_tensor=True,
-        batch_size=ST_BATCH_SIZE,
-        show_progress_bar=False,
-        normalize_embeddings=True,
-    )
-    try: emb = emb.to(DEVICE)
-    except Exception: pass
-    return emb
-
-# ============= امتیازدهی =============
-def score_answer(meta_q: Dict[str, Any], value: Any) -> int:
-    t = meta_q.get("response_type")
-    if t == "yesno":
-        return 1 if normalize_yes_no(value) == "yes" else 0
-    if t == "likert_0_3":
-        try: n = int(value)
-        except Exception: n = 0
-        return max(0, min(3, n))
-    if t in ("open","text"):
-        return 1 if str(value or "").strip() else 0
-    return 0
-
-def max_score_for(meta_q: Dict[str, Any]) -> int:
-    t = meta_q.get("response_type")
-    if t == "likert_0_3": return 3
-    if t == "yesno": return 1
-    if t in ("open","text"): return 1
-    return 0
-
-def severity_label(percent: float) -> str:
-    if percent >= 66: return "زیاد"
-    if percent >= 33: return "متوسط"
-    return "کم"
-
-# ============= کلیدواژه‌ها =============
-def _has_any(text: str, vocab: Set[str]) -> bool:
-    t = (text or "").replace("‌"," ").lower()
-    return any(v.lower() in t for v in vocab)
-
-# اضطراب/پانیک
-KW_GAD_CORE: Set[str] = {"نگرانی","دلشوره","استرس","بی‌قراری","تنش","کنترل‌ناپذیر"}
-KW_PANIC: Set[str] = {
-    "حمله پانیک","حملهٔ پانیک","حمله وحشت","حمله اضطراب","پانیک",
-    "تپش قلب","قلبم تند می‌زنه","قلبم تند میزنه",
-    "تنگی نفس","نفس کم میارم","احساس خفگی","خفگی","نمی‌تونم نفس بکشم","نمیتونم نفس بکشم",
-    "سرگیجه","سبکی سر","تعریق","لرزش","مورمور","بی‌حسی","گزگز",
-    "ترس از مردن","می‌میرم الان","ترس از دیوونه شدن","کنترل از دست میره",
-    "حمله ناگهانی","ناگهانی میاد","یهویی میاد"
-}
-
-# وسواس
-KW_OCD: Set[str] = {"وسواس","افکار مزاحم","ناخواسته","اجبار","شستن","چک کردن","مرتب کردن","شمردن"}
-KW_OCD_STRONG: Set[str] = {
-    "کثیفه","کثیف","آلودگی","آلوده","نمی‌تونم به چیزی دست بزنم","می‌شورم","چند بار","مرتب می‌شورم","چک می‌کنم","ضدعفونی"
-}
-
-# مانیا/افسردگی
-KW_SLEEP: Set[str] = {"بی‌خوابی","بی خواب","کم‌خوابی","پرخوابی","خواب","بیدار","صبح زود","کابوس","ریتم"}
-KW_DEPRESSIVE: Set[str] = {"افسرد","غم","غمگین","ناامید","بی‌انگیزه","بی‌علاقه","لذت نمی‌برم","پرخوابی","پوچی","خستگی","حالم بده"}
-KW_IRRITABILITY: Set[str] = {"عصبی","عصبانی","زودرنج","تحریک‌پذیر","تحریک پذیری"}
-KW_MANIC: Set[str] = {
-    "پرانرژی","انرژیم بالاست","کاهش نیاز به خواب","پرحرف",
-    "ولخرجی","ریسکی","میل جنسی زیاد","خوشحال غیرعادی","تحریک‌پذیر",
-    "مانیا","هیپومانیا","خلق بالا","افکار تندتند","نوسان خلق","بی‌قرار","تمرکز ندارم","حواس‌پرتی"
-}
-
-# جنسیت/دیفوریا و پارافیلیک
-KW_GENDER_DYSPHORIA: Set[str] = {
-    "با جنسیت خودم راحت نیستم","ناراحتی از جنسیت","دوست ندارم جنسیت خودم",
-    "می‌خوام مرد باشم","می‌خوام زن باشم",
-    "اسم خودمو صدا نزنن","ضمیر","می‌خوام با ضمیر دیگه صدام کنن",
-    "دوست دارم لباس جنس مقابل بپوشم","نقش اجتماعی جنس دیگر","ویژگی‌های جنسی اذیتم می‌کنه",
-    "دوست ندارم بدن/اندام جنسی فعلی"
-}
-KW_SEXUAL_AROUSAL_WORDS: Set[str] = {
-    "تحریک","برانگیختگی","شهوت","لذت جنسی","فانتزی جنسی","برایم تحریک‌کننده است","ارگاسم"
-}
-
-# سایر دسته‌ها
-KW_AVOIDANT_PD: Set[str] = {"اجتناب","طرد","نقد","کفایت","بی‌عرضگی","خجالت","کمرویی","تنهایی","فاصله","روابط صمیمی"}
-KW_TRAUMA: Set[str] = {"تروما","حادثه","آزار","تصادف","جنگ","فاجعه","مرگ ناگهانی","تجاوز"}
-KW_PTSD_SYMPTOMS: Set[str] = {"فلش‌بک","کابوس","اجتناب","گوش به زنگ","بی‌حسی هیجانی"}
-
-KW_BINGE_EATING: Set[str] = {"پرخوری","مقدار زیاد غذا","کنترل از دست رفته","شرم","گناه"}
-KW_COMPENSATORY_BEHAVIORS: Set[str] = {"استفراغ","ملین","ورزش زیاد","روزه","جبران"}
-KW_EATING_TRIGGER: Set[str] = {"بی‌اشتهایی","لاغری","چاقی","وزن","رژیم","اندام","بدن","غذا"}
-
-KW_SUBSTANCE: Set[str] = {"مواد","الکل","سیگار","قلیان","تریاک","شیشه","حشیش","ترک","دارو","اعتیاد"}
-KW_MEDICAL: Set[str]   = {"بیماری جسمی","تیروئید","قلب","صرع","پارکینسون","دیابت"}
-
-KW_SEXUAL_GENERAL: Set[str] = {"رابطه جنسی","سکس","میل جنسی","انزال","ارگاسم","درد هنگام رابطه"}
-KW_SEXUAL_ED: Set[str] = {"نعوظ","نعوذ","سفت نمیشه","نعوظ سخت","قادر به نعوظ نیستم"}
-
-KW_CHILDHOOD_ONSET: Set[str] = {"از کودکی","کودکی","قبل از ۱۲","قبل از12","قبل از دوازده"}
-KW_ADHD: Set[str] = {"adhd","بیش‌فعالی","بیش فعالی","نقص توجه"}
-
-KW_SHIFT: Set[str] = {"شیفت","شیفت کاری","نوبت‌کاری","شیفت شب"}
-KW_PHASE: Set[str] = {"خیلی دیر می‌خوابم","دیر می‌خوابم","دیر بیدار می‌شم","تا دیروقت بیدارم"}
-
-KW_BDD: Set[str] = {"بدریخت","بدشکلی","ظاهر","دماغ","پوست","آینه","عکس","پوشاندن","مقایسه"}
-KW_HEALTH_ANX: Set[str] = {"بیماری جدی","سرطان","ام اس","ms","آزمایش می‌دم","چک می‌کنم بدن"}
-KW_BPD: Set[str] = {"ترس از رها شدن","رابطه‌هام بالا پایین","قهر","مرزی","بی‌ثباتی هویت"}
-KW_DISS: Set[str] = {"مسخ شخصیت","مسخ واقعیت","غیرواقعی","گسست","هویت","یادم نمیاد","فراموشی"}
-KW_GRIEF: Set[str] = {"سوگ","عزا","عزاداری","فقدان","از دست دادم","مرگ","فوت"}
-KW_PERIPARTUM: Set[str] = {"بارداری","حامله","زایمان","پس از زایمان","پیرامون‌زایمان","نوزاد","شیردهی"}
-KW_EXCESSIVE_SLEEPINESS: Set[str] = {"خواب‌آلودگی","حملات خواب","کاتاپلکسی","چرت‌های ناگهانی"}
-
-def is_mania_like(text: str) -> bool:
-    return _has_any(text, KW_MANIC)
-
-def is_grief_dominant(text: str) -> bool:
-    t = (text or "")
-    return _has_any(t, KW_GRIEF) and not is_mania_like(t)
-
-def has_adhd_signal(text: str) -> bool:
-    return (
-        _has_any(text, {"adhd","بیش‌فعالی","بیش فعالی","نقص توجه"}) or
-        (_has_any(text, {"تمرکز","حواس","بی‌قراری"}) and _has_any(text, KW_CHILDHOOD_ONSET))
-    )
-
-# ============= امبدینگ/رنکینگ =============
-@torch.no_grad()
-def rank_disorders_from_text(user_text: str, top_k: int = 5, min_sim: float = 0.45) -> List[Tuple[str, float, int]]:
-    m = get_model()
-    bank_emb = get_bank_emb()
-    if bank_emb is None or not _BANK_TITLES:
-        return []
-    q = m.encode([user_text], convert_to_tensor=True, normalize_embeddings=True).to(DEVICE)
-    sims = util.cos_sim(q, bank_emb)[0]
-
-    best_by_did: Dict[str, Tuple[float, int]] = {}
-    for i, it in enumerate(_BANK):
-        did = str(it.get("disorder_id",""))
-        if not did or not it.get("symptom"):
-            continue
-        s = float(sims[i])
-        cur = best_by_did.get(did)
-        if (cur is None) or (s > cur[0]):
-            best_by_did[did] = (s, i)
-
-    rows: List[Tuple[str, float, int]] = []
-    for did,(sim_sem, idx) in best_by_did.items():
-        if sim_sem < min_sim:
-            continue
-        rows.append((did, float(sim_sem), idx))
-    rows.sort(key=lambda x: x[1], reverse=True)
-    return rows[:top_k]
-
-def pick_representative_items(rows: List[Tuple[str,float,int]]) -> List[Dict[str,Any]]:
-    return [_BANK[idx] for _,_,idx in rows]
-
-def _find_item_by_id(item_id: str) -> Optional[Dict[str, Any]]:
-    if not item_id: return None
-    return next((it for it in _BANK if it.get("id")==item_id), None)
-
-def _find_representative_item_for_did(did: str,
-                                      prefer_ids: Optional[List[str]] = None,
-                                      prefer_symptom_subs: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
-    prefer_ids = prefer_ids or []
-    prefer_symptom_subs = [s.lower() for s in (prefer_symptom_subs or [])]
-
-    for it in _BANK:
-        if str(it.get("disorder_id")) != did:
-            continue
-        if it.get("id") in prefer_ids:
-            return it
-    for it in _BANK:
-        if str(it.get("disorder_id")) != did:
-            continue
-        sym = (it.get("symptom","") or "").lower()
-        if any(sub in sym for sub in prefer_symptom_subs):
-            return it
-    for it in _BANK:
-        if str(it.get("disorder_id")) == did:
-            return it
-    return None
-
-# ============= ساخت Batch =============
-def _group_from_item(it: Dict[str, Any]) -> Dict[str, Any]:
-    gqs = []
-    gw = (it.get("gateway") or {})
-    gw_text = gw.get("text", "")
-    timeframe = gw.get("timeframe_hint", "")
-    if timeframe:
-        gw_text = f"{gw_text}\n🕒 بازهٔ مدنظر: {timeframe}"
-    gqs.append({"qid": gw.get("id"), "kind": "yesno", "text": gw_text, "required": False})
-
-    for fq in (it.get("followups") or []):
-        rt = fq.get("response_type")
-        qobj = {"qid": fq.get("id"), "text": fq.get("text",""), "required": False}
-        if rt == "yesno":
-            qobj["kind"] = "yesno"
-        elif rt == "likert_0_3":
-            qobj["kind"] = "likert"; qobj["min"]=0; qobj["max"]=3
-        else:
-            qobj["kind"] = "text"; qobj["placeholder"] = "مثال یا توضیح کوتاه..."
-        gqs.append(qobj)
-
-    return {
-        "title": it.get("symptom",""),
-        "disorder_id": str(it.get("disorder_id","")),
-        "questions": gqs
-    }
-
-def build_batch_spec_multi(user_text: str,
-                           selected_items: List[Dict[str,Any]],
-                           per_family: int = BATCH_ITEMS_PER_FAMILY,
-                           max_groups: int = BATCH_MAX_GROUPS) -> Tuple[List[Dict[str,Any]], Dict[str,Any]]:
-    model = get_model()
-    bank_emb = get_bank_emb()
-    q_emb = model.encode([user_text], convert_to_tensor=True, normalize_embeddings=True).to(DEVICE)
-
-    picked_idx: List[int] = []
-    seen_norm: Set[str] = set()
-
-    for base in selected_items:
-        did = str(base.get("disorder_id"))
-        same_idx = [i for i,it in enumerate(_BANK) if str(it.get("disorder_id")) == did and it.get("symptom")]
-        if bank_emb is not None and same_idx:
-            sims = util.cos_sim(q_emb, bank_emb)[0]
-            same_sorted = sorted(same_idx, key=lambda i: float(sims[i]), reverse=True)
-        else:
-            same_sorted = same_idx
-
-        cnt = 0
-        for i in same_sorted:
-            lab = _norm_label(_BANK[i]["symptom"])
-            if lab in seen_norm:
-                continue
-            seen_norm.add(lab)
-            picked_idx.append(i)
-            cnt += 1
-            if cnt >= per_family:
-                break
-        if len(picked_idx) >= max_groups:
-            break
-
-    items = [_BANK[i] for i in picked_idx]
-    groups = [_group_from_item(it) for it in items]
-    spec = {"ui":"batch","groups": groups}
-    return items, spec
-
-# ============= فیلتر زمینه‌ای =============
-def filter_groups_by_context(user_text: str, groups: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
-    has_substance   = _has_any(user_text, KW_SUBSTANCE)
-    has_medical     = _has_any(user_text, KW_MEDICAL)
-    mania_like      = is_mania_like(user_text)
-
-    has_peripartum  = _has_any(user_text, KW_PERIPARTUM)
-    has_eating      = _has_any(user_text, KW_BINGE_EATING) or _has_any(user_text, KW_COMPENSATORY_BEHAVIORS) or _has_any(user_text, KW_EATING_TRIGGER)
-    has_excess_day  = _has_any(user_text, KW_EXCESSIVE_SLEEPINESS)
-    has_child_adhd  = has_adhd_signal(user_text)
-
-    # تمایز دیفوریا در برابر پارافیلیک: اگر «پوشیدن لباس جنس دیگر» بدون واژگان برانگیختگی جنسی بیاید،
-    # گروه‌های پارافیلیکِ صرف را حذف می‌کنیم (تا جای درست یعنی Gender Dysphoria فعال بماند).
-    mention_cross_dress = "لباس جنس دیگر" in (user_text or "")
-    mention_arousal     = _has_any(user_text, KW_SEXUAL_AROUSAL_WORDS)
-
-    out: List[Dict[str,Any]] = []
-    seen_titles: Set[str] = set()
-
-    for g in groups:
-        title = (g.get("title") or "")
-        tlow = title.lower()
-
-        if ("ماده" in tlow or "مصرف" in tlow or "دارو" in tlow or "جسمی" in tlow):
-            if not (has_substance or has_medical):
-                continue
-
-        if mania_like and any(k in tlow for k in ["نارکولپسی","آپنه","پاراسومنیا","ریتم خواب","ریتم","پرخوابی","بی‌خوابی"]):
-            continue
-
-        if any(k in tlow for k in ["زایمان","بارداری","پیرامون"]):
-            if not has_peripartum:
-                continue
-
-        if any(k in tlow for k in ["پرخوری","بی‌اشتهایی","رومینیشن","پیکا","خوردن"]):
-            if not has_eating:
-                continue
-
-        if any(k in tlow for k in ["نارکولپسی","خواب‌آلودگی","حملات خواب"]):
-            if not has_excess_day:
-                continue
-
-        if any(k in tlow for k in ["adhd","بیش‌فعالی","نقص توجه","یادگیری","اوتیسم","تیک","tourette"]):
-            if not has_child_adhd:
-                continue
-
-        # حذف پارافیلیک ترانسوستیک اگر کاربر فقط از پوشش/نقش گفت و اشاره‌ای به برانگیختگی جنسی نکرد
-        if ("transvestic" in tlow or "ترانسوستیک" in tlow or "پوشیدن لباس جنس دیگر" in tlow):
-            if mention_cross_dress and not mention_arousal:
-                continue
-
-        nl = _norm_label(title)
-        if nl in seen_titles:
-            continue
-        seen_titles.add(nl)
-
-        out.append(g)
-
-    return out
-
-# ============= تمایز (Diff) =============
-def _label_has_any(did: str, subs: Set[str]) -> bool:
-    lab = (_LABELS.get(did, "") or "").lower()
-    return any(s in lab for s in subs)
-
-def _rows_contain_labels(rows: List[Tuple[str,float,int]], subs: Set[str]) -> bool:
-    return any(_label_has_any(did, subs) for did,_,_ in rows)
-
-def need_mdd_vs_bipolar(text: str, rows) -> bool:
-    if is_grief_dominant(text):
-        return False
-    dep_kw = _has_any(text, KW_DEPRESSIVE)
-    cand_dep = _rows_contain_labels(rows, {"افسرد","depress"})
-    if not (dep_kw or cand_dep):
-        return False
-    mania = is_mania_like(text)
-    redflag = _has_any(text, KW_SLEEP) and _has_any(text, KW_IRRITABILITY)
-    if mania or redflag:
-        return True
-    has_dep = cand_dep
-    has_bip = _rows_contain_labels(rows, {"دو قطبی","دوقطبی","bipolar","مانیا"})
-    return has_dep and has_bip
-
-def need_gad_vs_ocd(text: str, rows) -> bool:
-    return (_has_any(text, KW_GAD_CORE) and (_has_any(text, KW_OCD) or _has_any(text, KW_OCD_STRONG)))
-
-def need_social_anxiety_vs_avoidant_pd(text: str, rows) -> bool:
-    return _has_any(text, {"جمع","اجتماعی","قضاوت","مسخره"}) or _has_any(text, KW_AVOIDANT_PD)
-
-def need_bed_vs_bulimia(text: str, rows) -> bool:
-    return _has_any(text, KW_BINGE_EATING) or _has_any(text, KW_COMPENSATORY_BEHAVIORS)
-
-def need_bipolar_vs_adhd(text: str, rows) -> bool:
-    return is_mania_like(text) or has_adhd_signal(text)
-
-def need_insomnia_vs_circadian(text: str, rows) -> bool:
-    return _has_any(text, KW_SLEEP) and (_has_any(text, KW_SHIFT) or _has_any(text, KW_PHASE))
-
-def need_ocd_vs_ocpd(text: str, rows) -> bool:
-    return _has_any(text, KW_OCD) or _has_any(text, KW_OCD_STRONG)
-
-def need_dysthymia_vs_mdd(text: str, rows) -> bool:
-    return _has_any(text, KW_DEPRESSIVE)
-
-def need_ptsd_vs_bpd(text: str, rows) -> bool:
-    return (_has_any(text, KW_TRAUMA) or _has_any(text, KW_PTSD_SYMPTOMS)) or _has_any(text, KW_BPD)
-
-def need_adhd_vs_depression(text: str, rows) -> bool:
-    return has_adhd_signal(text) or (_has_any(text, KW_DEPRESSIVE) and _has_any(text, {"تمرکز","حواس"}))
-
-def need_adhd_vs_anxiety(text: str, rows) -> bool:
-    return has_adhd_signal(text) or _has_any(text, KW_GAD_CORE)
-
-def need_atypical_vs_melancholic_depression(text: str, rows) -> bool:
-    return _has_any(text, {"پرخوابی","پرخوری","صبح زود"}) or _has_any(text, KW_DEPRESSIVE)
-
-def need_atypical_vs_dysthymia(text: str, rows) -> bool:
-    return _has_any(text, KW_DEPRESSIVE)
-
-def need_somatic_vs_mood_anxiety(text: str, rows) -> bool:
-    return _has_any(text, KW_HEALTH_ANX) or _has_any(text, {"علائم جسمی","درد"})
-
-def need_mixed_anxiety_depression(text: str, rows) -> bool:
-    return _has_any(text, KW_DEPRESSIVE) and _has_any(text, KW_GAD_CORE)
-
-def need_bdd_vs_sad_depression(text: str, rows) -> bool:
-    return _has_any(text, KW_BDD) or _has_any(text, {"ظاهر","قیافه","دماغ"})
-
-DIFF_NEED_FUNCS = {
-    "mdd_vs_bipolar": need_mdd_vs_bipolar,
-    "gad_vs_ocd": need_gad_vs_ocd,
-    "social_anxiety_vs_avoidant_pd": need_social_anxiety_vs_avoidant_pd,
-    "bed_vs_bulimia": need_bed_vs_bulimia,
-    "bipolar_vs_adhd": need_bipolar_vs_adhd,
-    "insomnia_vs_circadian": need_insomnia_vs_circadian,
-    "ocd_vs_ocpd": need_ocd_vs_ocpd,
-    "dysthymia_vs_mdd": need_dysthymia_vs_mdd,
-    "ptsd_vs_bpd": need_ptsd_vs_bpd,
-    "adhd_vs_depression": need_adhd_vs_depression,
-    "adhd_vs_anxiety": need_adhd_vs_anxiety,
-    "atypical_vs_melancholic_depression": need_atypical_vs_melancholic_depression,
-    "atypical_vs_dysthymia": need_atypical_vs_dysthymia,
-    "somatic_vs_mood_anxiety": need_somatic_vs_mood_anxiety,
-    "mixed_anxiety_depression": need_mixed_anxiety_depression,
-    "bdd_vs_sad_depression": need_bdd_vs_sad_depression,
-    "did_vs_bpd_schizo": need_ptsd_vs_bpd,
-}
-
-def pick_diff_clusters(user_text: str, rows: List[Tuple[str,float,int]]) -> List[Dict[str,Any]]:
-    res = []
-    for cl in _DIFF_BANK:
-        name = cl.get("cluster","")
-        fn = DIFF_NEED_FUNCS.get(name)
-        if not fn:
-            continue
-        try:
-            if fn(user_text, rows):
-                res.append(cl)
-        except Exception:
-            continue
-    return res
-
-def build_diff_batch_spec(clusters: List[Dict[str,Any]]) -> Dict[str, Any]:
-    groups = []
-    for cl in clusters:
-        qs = []
-        for q in (cl.get("questions") or []):
-            rt = q.get("response_type","yesno")
-            qobj = {"qid": q.get("id"), "text": q.get("text",""), "required": False}
-            if rt == "yesno":
-                qobj["kind"] = "yesno"
-            elif rt == "likert_0_3":
-                qobj["kind"] = "likert"; qobj["min"]=0; qobj["max"]=3
-            elif rt == "multiple_choice":
-                opts = q.get("options") or []
-                labels = " / ".join([o.get("label","") for o in opts if isinstance(o, dict)])
-                qobj["kind"] = "text"
-                qobj["placeholder"] = f"انتخاب: {labels}" if labels else "انتخاب را بنویس..."
-            else:
-                qobj["kind"] = "text"; qobj["placeholder"] = "مثال یا توضیح کوتاه..."
-            qs.append(qobj)
-
-        groups.append({
-            "title": cl.get("title",""),
-            "disorder_id": "diff",
-            "questions": qs
-        })
-    return {"ui":"batch", "groups": groups}
-
-# ============= Heuristics: افزودن آیتم‌ها =============
-def infer_extra_dids_and_items(user_text: str) -> Tuple[List[str], List[str]]:
-    """
-    خروجی: (extra_dids, direct_item_ids)
-    direct_item_ids: آیتم‌هایی که باید صریحاً اضافه شوند (مثل ANX_PANIC، GENDER_dysphoria_adult)
-    """
-    extras: List[str] = []
-    direct_items: List[str] = []
-    t = (user_text or "")
-
-    # پانیک: آیتم مستقیم
-    if _has_any(t, KW_PANIC):
-        direct_items.append("ANX_PANIC")
-
-    # Gender Dysphoria در اولویت بالاتر از ترانسوستیک
-    if _has_any(t, KW_GENDER_DYSPHORIA):
-        # اگر واژگان برانگیختگی جنسی دیده نشود، به‌صورت مستقیم دیفوریا را اضافه کن
-        if not _has_any(t, KW_SEXUAL_AROUSAL_WORDS):
-            # این آیتم را باید در بانک داشته باشید
-            direct_items.append("GENDER_dysphoria_adult")
-        else:
-            # هر دو را می‌توان آورد (دیفوریا و پارافیلیک)
-            direct_items.append("GENDER_dysphoria_adult")
-            extras.append("paraphilic")
-
-    # الگوهای قبلی
-    if is_mania_like(t):
-        extras.append("bipolar")
-
-    if _has_any(t, KW_DEPRESSIVE) and (_has_any(t, KW_SLEEP) or _has_any(t, KW_IRRITABILITY)):
-        if "bipolar" not in extras:
-            extras.append("bipolar")
-
-    if _has_any(t, KW_OCD) or _has_any(t, KW_OCD_STRONG):
-        extras.append("ocd_related")
-
-    if _has_any(t, KW_SEXUAL_ED) or _has_any(t, KW_SEXUAL_GENERAL):
-        extras.append("sexual_function")
-
-    if _has_any(t, KW_SLEEP) and (not is_mania_like(t)):
-        extras.append("sleep_wake")
-
-    if _has_any(t, KW_GAD_CORE):
-        extras.append("anxiety")
-
-    if has_adhd_signal(t):
-        extras.append("neurodev")
-
-    # یکتا
-    seen = set()
-    extras_u = []
-    for d in extras:
-        if d not in seen:
-            extras_u.append(d); seen.add(d)
-    # direct unique
-    seen = set()
-    direct_u = []
-    for d in direct_items:
-        if d not in seen:
-            direct_u.append(d); seen.add(d)
-
-    return extras_u, direct_u
-
-def _ensure_one_bipolar_gateway_if_dep_like(user_text: str, spec: Dict[str, Any]) -> None:
-    if not (_has_any(user_text, KW_DEPRESSIVE) and ("groups" in spec)):
-        return
-    titles = " ".join([g.get("title","") for g in spec.get("groups",[])]).lower()
-    if ("دو قطبی" in titles) or ("بایپولار" in titles) or ("bipolar" in titles) or ("هیپومانیا" in titles) or ("مانیا" in titles):
-        return
-    it = _find_representative_item_for_did(
-        "bipolar",
-        prefer_ids=["BP_mania_hypomania_screen"],
-        prefer_symptom_subs=["هیپومانیا","مانیا","بالا رفتن","خلق بالا"]
-    )
-    if it:
-        spec["groups"].insert(0, _group_from_item(it))
-
-def _ensure_bipolar_gateway_if_mania_like(user_text: str, spec: Dict[str, Any]) -> None:
-    if not (is_mania_like(user_text) and ("groups" in spec)):
-        return
-    titles = " ".join([g.get("title","") for g in spec.get("groups",[])]).lower()
-    if ("دو قطبی" in titles) or ("بایپولار" in titles) or ("bipolar" in titles) or ("هیپومانیا" in titles) or ("مانیا" in titles):
-        return
-    it = _find_representative_item_for_did(
-        "bipolar",
-        prefer_ids=["BP_mania_hypomania_screen"],
-        prefer_symptom_subs=["هیپومانیا","مانیا","بالا رفتن","خلق بالا"]
-    )
-    if it:
-        spec["groups"].insert(0, _group_from_item(it))
-
-# ============= View: صفحه =============
-@ensure_csrf_cookie
-def chat_page(request: HttpRequest):
-    return render(request, CHAT_TEMPLATE, {})
-
-# ============= View: API =============
-@ensure_csrf_cookie
-def chat_api(request: HttpRequest):
-    if request.method != "POST":
-        return JsonResponse({"ok": False, "error": "POST only"}, status=405)
-
-    try:
-        data = json.loads(request.body.decode("utf-8"))
-    except Exception:
-        data = {}
-
-    action = (data.get("action") or "").strip()
-    st = _st_from_session(request.session.get("chat_state", {}))
-
-    def save_ok(payload: Dict[str, Any], *, reset: bool=False):
-        if reset:
-            st.clear()
-        request.session["chat_state"] = _st_to_session(st)
-        request.session.modified = True
-        return JsonResponse(payload, safe=True)
-
-    # ----------- پیام آزاد -----------
-    if action == "" and "message" in data:
-        msg = (data.get("message") or "").strip()
-        if not msg:
-            return save_ok({"ui":"text", "reply":"یه چیزی بنویس لطفاً 😊"})
-
-        if check_emergency(msg):
-            return save_ok({"ui":"text", "reply":"به نظر می‌رسه به کمک فوری نیاز داری. لطفاً همین الآن با اورژانس ۱۱۵ تماس بگیر یا با یکی از متخصصین ما صحبت کن. ❤️"})
-
-        # 1) امبدینگ
-        rows = rank_disorders_from_text(msg, top_k=5, min_sim=0.45)
-
-        # 2) هیؤریستیک‌ها: DID/آیتم‌های مستقیم مثل پانیک و دیفوریا
-        extra_dids, direct_item_ids = infer_extra_dids_and_items(msg)
-
-        # اگر هیچ شباهت کافی نبود، از آیتم‌های مستقیم/دسته‌ها استفاده کن
-        if not rows and (extra_dids or direct_item_ids):
-            selected_items: List[Dict[str, Any]] = []
-
-            # آیتم‌های مستقیم (مثلاً ANX_PANIC، GENDER_dysphoria_adult)
-            for iid in direct_item_ids:
-                it = _find_item_by_id(iid)
-                if it: selected_items.append(it)
-
-            # دسته‌های پیشنهادی
-            for did in extra_dids:
-                if did == "ocd_related":
-                    rep = _find_representative_item_for_did("ocd_related", prefer_ids=["OCD_core"], prefer_symptom_subs=["وسواس"])
-                elif did == "bipolar":
-                    rep = _find_representative_item_for_did("bipolar", prefer_ids=["BP_mania_hypomania_screen"], prefer_symptom_subs=["هیپومانیا","مانیا","خلق بالا"])
-                elif did == "sexual_function":
-                    rep = _find_representative_item_for_did("sexual_function", prefer_ids=["SEX_ED","SEX_function"])
-                elif did == "gender_identity":
-                    rep = _find_representative_item_for_did("gender_identity", prefer_ids=["GENDER_dysphoria_adult"], prefer_symptom_subs=["دیفوریا","ناهماهنگی جنسیتی"])
-                else:
-                    rep = _find_representative_item_for_did(did)
-                if rep: selected_items.append(rep)
-
-            if selected_items:
-                items, spec = build_batch_spec_multi(msg, selected_items, per_family=BATCH_ITEMS_PER_FAMILY, max_groups=BATCH_MAX_GROUPS)
-                spec["groups"] = filter_groups_by_context(msg, spec["groups"])
-
-                diff_clusters = pick_diff_clusters(msg, [])
-                if diff_clusters:
-                    diff_spec = build_diff_batch_spec(diff_clusters)
-                    spec["groups"] = diff_spec["groups"] + spec["groups"]
-                    st["diff_active"] = [cl.get("cluster") for cl in diff_clusters]
-
-                _ensure_bipolar_gateway_if_mania_like(msg, spec)
-                _ensure_one_bipolar_gateway_if_dep_like(msg, spec)
-
-                st["mode"] = "batch"
-                st["user_text"] = msg
-                st["batch_items_ids"] = [it.get("id") for it in items if it.get("id")]
-                return save_ok(spec)
-
-            return save_ok({"ui":"text", "reply":"هنوز مطمئن نیستم. لطفاً کمی بیشتر دربارهٔ علائمت توضیح بده."})
-
-        # اگر rows داریم:
-        selected_items = pick_representative_items(rows)
-
-        # آیتم‌های مستقیم را جلوتر تزریق کن
-        for iid in direct_item_ids:
-            it = _find_item_by_id(iid)
-            if it and it not in selected_items:
-                selected_items.insert(0, it)
-
-        # دسته‌های اضافی
-        existing_dids = {str(it.get("disorder_id")) for it in selected_items}
-        for did in extra_dids:
-            if did in existing_dids: 
-                continue
-            if did == "ocd_related":
-                rep = _find_representative_item_for_did("ocd_related", prefer_ids=["OCD_core"], prefer_symptom_subs=["وسواس"])
-            elif did == "bipolar":
-                rep = _find_representative_item_for_did("bipolar", prefer_ids=["BP_mania_hypomania_screen"], prefer_symptom_subs=["هیپومانیا","مانیا","خلق بالا"])
-            elif did == "sexual_function":
-                rep = _find_representative_item_for_did("sexual_function", prefer_ids=["SEX_ED","SEX_function"])
-            elif did == "gender_identity":
-                rep = _find_representative_item_for_did("gender_identity", prefer_ids=["GENDER_dysphoria_adult"], prefer_symptom_subs=["دیفوریا","ناهماهنگی جنسیتی"])
-            else:
-                rep = _find_representative_item_for_did(did)
-            if rep:
-                selected_items.append(rep)
-                existing_dids.add(did)
-
-        items, spec = build_batch_spec_multi(msg, selected_items, per_family=BATCH_ITEMS_PER_FAMILY, max_groups=BATCH_MAX_GROUPS)
-        spec["groups"] = filter_groups_by_context(msg, spec["groups"])
-
-        if not spec["groups"]:
-            return save_ok({"ui":"text", "reply":"علائمی که گفتی واضح نبود. کمی دقیق‌تر بگو چه چیزهایی اذیتت می‌کنه."})
-
-        diff_clusters = pick_diff_clusters(msg, rows)
-        if diff_clusters:
-            diff_spec = build_diff_batch_spec(diff_clusters)
-            spec["groups"] = diff_spec["groups"] + spec["groups"]
-            st["diff_active"] = [cl.get("cluster") for cl in diff_clusters]
-
-        _ensure_bipolar_gateway_if_mania_like(msg, spec)
-        _ensure_one_bipolar_gateway_if_dep_like(msg, spec)
-
-        st["mode"] = "batch"
-        st["user_text"] = msg
-        st["batch_items_ids"] = [it.get("id") for it in items if it.get("id")]
-
-        return save_ok(spec)
-
-    # ----------- دریافت پاسخ فرم -----------
-    if action == "batch_submit":
-        answers: Dict[str, Any] = data.get("answers") or {}
-
-        total_by_dis: Dict[str, int] = {}
-        max_by_dis: Dict[str, int] = {}
-
-        shown_item_ids: Set[str] = set(st.get("batch_items_ids") or [])
-
-        qmeta: Dict[str, Dict[str, Any]] = {}
-        for it in _BANK:
-            if shown_item_ids and it.get("id") not in shown_item_ids:
-                continue
-            did = str(it.get("disorder_id"))
-            gid = (it.get("gateway") or {}).get("id")
-            if gid:
-                qmeta[gid] = {"disorder_id": did, "response_type": "yesno"}
-            for fq in (it.get("followups") or []):
-                qid = fq.get("id")
-                if not qid:
-                    continue
-                qmeta[qid] = {"disorder_id": did, "response_type": fq.get("response_type")}
-
-        def _default_for(rt: Optional[str]) -> Any:
-            if rt == "yesno":
-                return "no"
-            if rt == "likert_0_3":
-                return 0
-            return ""
-
-        for qid, meta in qmeta.items():
-            did = meta["disorder_id"]
-            rt  = meta.get("response_type")
-            val = answers.get(qid, None)
-            if val is None or (isinstance(val, str) and not val.strip()):
-                val = _default_for(rt)
-            sc = score_answer(meta, val)
-            mx = max_score_for(meta)
-            total_by_dis[did] = total_by_dis.get(did, 0) + sc
-            max_by_dis[did]   = max_by_dis.get(did, 0) + mx
-
-        results = []
-        for did, sc in total_by_dis.items():
-            mx = max_by_dis.get(did, 0) or 1
-            pct = round(100.0 * sc / mx, 1)
-            if sc > 0:
-                results.append({
-                    "disorder_id": did,
-                    "label": _LABELS.get(did, f"اختلال {did}"),
-                    "score": sc,
-                    "max": mx,
-                    "percent": pct,
-                    "severity": severity_label(pct)
-                })
-
-        if not results:
-            return save_ok({"ui":"text","reply":"بر اساس پاسخ‌ها نشانهٔ فعالی تأیید نشد. می‌تونی فقط به سؤال‌هایی که دوست داری جواب بدی؛ بقیه به‌صورت «خیر» درنظر گرفته می‌شن."})
-
-        results.sort(key=lambda r: (-r["percent"], -r["score"]))
-        lines = ["نتیجهٔ غربالگری (غیردقیق/غیرتشخیصی):"]
-        for r in results[:6]:
-            lines.append(f"• {r['label']} — امتیاز {r['score']}/{r['max']} (٪{r['percent']})")
-
-        return save_ok({"ui":"text", "reply":"\n".join(lines)}, reset=True)
-
-    return JsonResponse({"ok": False, "error": "bad request"}, status=400)
+# web/views/chat.py
+import os, json, re, time, hashlib, tempfile, threading, warnings, logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Any, FrozenSet, Iterable, List, NamedTuple, Optional, Set, Tuple
+from functools import lru_cache, wraps
+from dataclasses import dataclass, field
+
+from django.http import JsonResponse, HttpRequest
+from django.shortcuts import render
+from django.conf import settings
+from django.views.decorators.csrf import ensure_csrf_cookie
+
+import numpy as np
+
+from .kwmatch import KeywordMatcher
+from .encoder import EmbeddingBatcher
+from .qcache import TTLCache
+from .vindex import INDEX_KINDS, FlatIndex, IVFIndex, HNSWIndex
+from .timing import stage, timed_view
+from .pools import PoolFull, text_pool, busy_response
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+log = logging.getLogger(__name__)
+
+# ============= تنظیمات پایه =============
+CHAT_TEMPLATE = "chatbot/customer/page-bot-chat.html"
+
+BASE_DIR: Path = Path(settings.BASE_DIR)
+CHATBOT_DIR: Path = BASE_DIR / "chatbot"
+
+QUESTIONS_FILE = CHATBOT_DIR / "questions_.json"                  # بانک سؤالات
+DIFF_QUESTIONS_FILE = CHATBOT_DIR / "differential_questions.json" # سؤالات تمایز
+LABELS_FILE = CHATBOT_DIR / "disorder_labels.json"                 # برچسب‌های سفارشی
+
+# هر چند ثانیه mtime فایل‌های بانک بررسی شود (0 = فقط بارگذاری دستی)
+BANK_RELOAD_INTERVAL = float(settings.CHATBOT.get("BANK_RELOAD_INTERVAL", 5.0))
+
+SENTENCE_MODEL_NAME = settings.CHATBOT.get(
+    "SENTENCE_MODEL", "paraphrase-multilingual-mpnet-base-v2"
+)
+# torch (fp32) | torch_int8 (کوانتیزه‌ی پویا، فقط CPU) | onnx (ONNX Runtime)
+ENCODER_BACKEND = settings.CHATBOT.get("ENCODER_BACKEND", "torch")
+ENCODER_ONNX_FILE = settings.CHATBOT.get("ENCODER_ONNX_FILE")    # مثلا onnx/model_qint8_avx2.onnx
+
+# امبدینگ ازپیش‌محاسبهٔ بانک (مشترک بین workerها با mmap)؛ همیشه float32 تا بدون کپی مستقیم استفاده شود
+BANK_EMB_FILE = Path(settings.CHATBOT.get("BANK_EMB_FILE", CHATBOT_DIR / "bank_emb.npy"))
+BANK_EMB_AUTOSAVE = bool(settings.CHATBOT.get("BANK_EMB_AUTOSAVE", True))
+
+# ایندکس برداری بانک: flat (دقیق) | ivf | hnsw — زیر VECTOR_INDEX_MIN_ITEMS همیشه flat
+VECTOR_INDEX = settings.CHATBOT.get("VECTOR_INDEX", "flat")
+VECTOR_INDEX_MIN_ITEMS = int(settings.CHATBOT.get("VECTOR_INDEX_MIN_ITEMS", 5000))
+ANN_CANDIDATES = int(settings.CHATBOT.get("ANN_CANDIDATES", 512))      # تعداد ردیف نامزد برای رتبه‌بندی
+IVF_NLIST = int(settings.CHATBOT.get("IVF_NLIST", 0))                   # 0 = 4·√N
+IVF_NPROBE = int(settings.CHATBOT.get("IVF_NPROBE", 16))
+HNSW_EF = int(settings.CHATBOT.get("HNSW_EF", 128))                     # در عمل max(HNSW_EF, ANN_CANDIDATES)
+
+# ایندکس چندبرداری: متن gateway و followupها هم امبد می‌شوند و امتیاز هر آیتم تجمیع max/mean آن‌هاست
+MULTI_VECTOR = bool(settings.CHATBOT.get("MULTI_VECTOR", False))
+MULTI_VECTOR_AGG = settings.CHATBOT.get("MULTI_VECTOR_AGG", "max")      # max | mean
+BANK_MV_EMB_FILE = Path(settings.CHATBOT.get("BANK_MV_EMB_FILE", BANK_EMB_FILE.with_name(BANK_EMB_FILE.stem + ".mv.npy")))
+
+BATCH_ITEMS_PER_FAMILY = 5
+ST_BATCH_SIZE = int(os.getenv("ST_BATCH_SIZE", "8"))
+
+# میکروبچ امبدینگ پرسش‌ها بین درخواست‌های هم‌زمان همین پروسه؛
+# فقط با workerهای چند-thread یا ASGI فایده دارد (worker تک‌thread هرگز دو پرسش هم‌زمان ندارد)
+EMBED_BATCHING = bool(settings.CHATBOT.get("EMBED_BATCHING", False))
+EMBED_MAX_BATCH = int(settings.CHATBOT.get("EMBED_MAX_BATCH", 32))
+EMBED_MAX_WAIT_MS = float(settings.CHATBOT.get("EMBED_MAX_WAIT_MS", 5.0))
+
+# کش امبدینگ/رتبه‌بندی پیام‌ها بر اساس متن نرمال‌شده (QUERY_CACHE_SIZE=0 → خاموش)
+QUERY_CACHE_SIZE = int(settings.CHATBOT.get("QUERY_CACHE_SIZE", 2048))
+QUERY_CACHE_TTL = float(settings.CHATBOT.get("QUERY_CACHE_TTL", 600.0))          # ثانیه
+QUERY_CACHE_ALIAS = settings.CHATBOT.get("QUERY_CACHE_ALIAS")                   # کش مشترک Django (اختیاری)
+
+# گرم کردن موتور چت در پس‌زمینه هنگام بالا آمدن پروسهٔ سرور (web/apps.py)، نه در دستورهای manage.py
+WARMUP_ON_STARTUP = bool(settings.CHATBOT.get("WARMUP_ON_STARTUP", False))
+
+# حالت preload پیش از fork در gunicorn (web/views/prefork.py)؛ تعداد threadهای torch در هر worker
+PREFORK_PRELOAD = bool(settings.CHATBOT.get("PREFORK_PRELOAD", False))
+TORCH_THREADS = int(settings.CHATBOT.get("TORCH_THREADS", 0))                  # 0 = پیش‌فرض torch
+BATCH_MAX_GROUPS = 12
+
+# برچسب‌ها
+DEFAULT_LABELS: Dict[str, str] = {
+    "depression": "اختلالات خلقی مرتبط (افسردگی)",
+    "bipolar": "اختلالات خلقی مرتبط (دوقطبی/مانیا)",
+    "anxiety": "اختلالات اضطرابی",
+    "ocd_related": "وسواس فکری‌عملی و اختلالات مرتبط",
+    "trauma_stressor": "اختلالات مرتبط با تروما و استرسور",
+    "psychosis": "طیف اسکیزوفرنی و اختلالات روان‌پریشی",
+    "eating": "اختلالات خوردن",
+    "sleep_wake": "اختلالات خواب و بیداری",
+    "neurodev": "اختلالات عصبی‌رشدی",
+    "dissociative": "اختلالات گسستی",
+    "somatic": "سوماتیک/اضطراب بیماری",
+    "substance": "اختلالات مصرف مواد/الکل/تنباکو",
+    "sexual_function": "اختلالات عملکرد جنسی",
+    "paraphilic": "پارافیلیک",
+    "gender_identity": "دیفوریا/ناهماهنگی جنسیتی",  # ← اضافه شد
+    "diff": "سؤالات تمایز",
+
+    # سازگاری با لیبل‌های قدیمی عددی
+    "0": "آپنهٔ انسدادی خواب (OSA)",
+    "1": "عصبی/رشدی/زبان/خلقی (پایه/وسواس و…)",
+    "2": "اضطراب/فوبیا/سوگ و مرتبط",
+    "3": "شخصیت/نامشخص و دیگر",
+    "4": "مصرف مواد/الکل/تنباکو",
+    "5": "عملکرد جنسی/پارافیلیک",
+    "6": "ADHD/یادگیری/هماهنگی",
+    "7": "اختلالات خلقی مرتبط (افسردگی)",
+    "8": "اختلالات خواب/ریتم/PMDD/DMDD",
+    "9": "کودک/وابستگی/دفع/روان‌پریشی ناشی از ماده/جسمی",
+    "10": "سایر",
+    "22": "اختلالات خلقی مرتبط (دوقطبی/مانیا)"
+}
+
+# عبارات اضطراری
+EMERGENCY_KEYWORDS = [
+    "خودکشی","می‌خوام خودکشی","میخوام خودکشی","به خودم آسیب","کشتن خود",
+    "می‌خوام خودمو تموم کنم","تمومش کنم","میرم خودمو بکشم","به دیگران آسیب","کشتن کسی","قتل"
+]
+
+# ============= ابزار لود =============
+def _load_json(path: Path) -> Any:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _load_labels() -> Dict[str, str]:
+    cand = LABELS_FILE
+    labels = DEFAULT_LABELS.copy()
+    if cand.exists():
+        try:
+            custom = _load_json(cand)
+            if isinstance(custom, dict):
+                labels.update({str(k): str(v) for k, v in custom.items()})
+        except Exception:
+            pass
+    return labels
+
+def _load_diff_bank(path: Path) -> List[Dict[str, Any]]:
+    try:
+        arr = _load_json(path)
+        if isinstance(arr, dict):
+            arr = arr.get("diff_questions", [])
+        ok = []
+        for c in (arr or []):
+            if isinstance(c, dict) and c.get("cluster") and isinstance(c.get("questions"), list):
+                ok.append(c)
+        return ok
+    except Exception:
+        return []
+
+def _norm_label(s: str) -> str:
+    s = re.sub(r"[\(\（][^)）]*[\)\）]", "", s or "")
+    return re.sub(r"\s+", " ", s).strip().lower()
+
+def normalize_yes_no(v: Any) -> str:
+    s = ("" if v is None else str(v)).strip().lower()
+    return "yes" if s in ["بله","اره","آره","yes","y","true","۱","1","✔","✓","on"] else "no"
+
+_QUERY_FOLD = str.maketrans({
+    "ي": "ی", "ى": "ی", "ك": "ک", "ة": "ه", "ۀ": "ه", "أ": "ا", "إ": "ا", "ٱ": "ا",
+    "\u200c": " ", "\u200d": "", "\u200f": "", "\u200e": "", "\u0640": "",
+    **{c: str(i) for i, c in enumerate("۰۱۲۳۴۵۶۷۸۹")},
+    **{c: str(i) for i, c in enumerate("٠١٢٣٤٥٦٧٨٩")},
+})
+_QUERY_DIACRITICS = re.compile(r"[\u064B-\u065F\u0670]")
+
+def normalize_query(text: str) -> str:
+    """
+    شکل کانونی پیام فقط برای کلید کش: نیم‌فاصله، ی/ک عربی، اعراب، کشیده و فاصله‌های تکراری یکسان می‌شوند.
+    ورودی مدل همیشه متن اصلی کاربر است، نه این کلید.
+    """
+    s = _QUERY_DIACRITICS.sub("", (text or "").translate(_QUERY_FOLD))
+    return re.sub(r"\s+", " ", s).strip().lower()
+
+def check_emergency(text: str, hits: Optional["KeywordHits"] = None) -> bool:
+    return (hits or keyword_hits(text)).has(EMERGENCY_KEYWORDS)
+
+def token_count(text: str) -> int:
+    return len([w for w in re.split(r"\s+", (text or "").strip()) if w])
+
+# Session sets <-> JSON
+def _st_to_session(st: Dict[str, Any]) -> Dict[str, Any]:
+    out = dict(st)
+    for k in ("asked_ids", "asked_norms"):
+        if isinstance(out.get(k), set):
+            out[k] = list(out[k])
+    return out
+
+def _st_from_session(obj: Dict[str, Any]) -> Dict[str, Any]:
+    st = dict(obj)
+    for k in ("asked_ids", "asked_norms"):
+        if isinstance(st.get(k), list):
+            st[k] = set(st[k])
+    return st
+
+# ============= امتیازدهی =============
+def _score_value(t: Optional[str], value: Any) -> int:
+    if t == "yesno":
+        return 1 if normalize_yes_no(value) == "yes" else 0
+    if t == "likert_0_3":
+        try: n = int(value)
+        except Exception: n = 0
+        return max(0, min(3, n))
+    if t in ("open","text"):
+        return 1 if str(value or "").strip() else 0
+    return 0
+
+def score_answer(meta_q: Dict[str, Any], value: Any) -> int:
+    return _score_value(meta_q.get("response_type"), value)
+
+def _default_answer(rt: Optional[str]) -> Any:
+    if rt == "yesno":
+        return "no"
+    if rt == "likert_0_3":
+        return 0
+    return ""
+
+def max_score_for(meta_q: Dict[str, Any]) -> int:
+    t = meta_q.get("response_type")
+    if t == "likert_0_3": return 3
+    if t == "yesno": return 1
+    if t in ("open","text"): return 1
+    return 0
+
+def severity_label(percent: float) -> str:
+    if percent >= 66: return "زیاد"
+    if percent >= 33: return "متوسط"
+    return "کم"
+
+# ============= ایندکس بانک =============
+class QuestionMeta(NamedTuple):
+    disorder_id: str
+    response_type: Optional[str]
+    max_score: int
+    item_id: Optional[str]
+
+class QuestionBankIndex:
+    """
+    ایندکس‌های O(1) روی بانک سؤالات که یک بار هنگام لود ساخته می‌شوند.
+    همهٔ مقادیر اندیس ردیف در بانک‌اند و ترتیب بانک حفظ می‌شود (اولین ردیف برنده است).
+    """
+    def __init__(self, bank: List[Dict[str, Any]]):
+        self.by_id: Dict[str, int] = {}                   # item id → ردیف
+        self.by_did: Dict[str, List[int]] = {}            # disorder_id → ردیف‌ها
+        self.by_did_symptom: Dict[str, List[int]] = {}    # disorder_id → ردیف‌های دارای symptom
+        self.by_did_id: Dict[Tuple[str, str], int] = {}   # (disorder_id, item id) → ردیف
+        self.by_label: Dict[str, List[int]] = {}          # برچسب نرمال‌شدهٔ symptom → ردیف‌ها
+        self.by_qid: Dict[str, int] = {}                  # id سؤال gateway/followup → ردیف
+        self.labels_norm: List[str] = []
+
+        # متادیتای امتیازدهی سؤال‌ها: برای هر ردیف [(qid, QuestionMeta)] و جدول کل بانک
+        self.qmeta_rows: List[List[Tuple[str, QuestionMeta]]] = []
+        self.qmeta_all: Dict[str, QuestionMeta] = {}
+
+        # ردیف‌های قابل رتبه‌بندی و اندیس اختلالِ هر ردیف (برای scatter-max)
+        self.rank_dids: List[str] = []
+        self.rank_rows: List[int] = []
+        self.rank_did_idx: List[int] = []
+        pos: Dict[str, int] = {}
+
+        for i, it in enumerate(bank):
+            iid = it.get("id")
+            did = str(it.get("disorder_id"))
+            sym = it.get("symptom")
+            lab = _norm_label(sym or "")
+            self.labels_norm.append(lab)
+
+            if iid:
+                self.by_id.setdefault(iid, i)
+                self.by_did_id.setdefault((did, iid), i)
+            self.by_did.setdefault(did, []).append(i)
+            if sym:
+                self.by_did_symptom.setdefault(did, []).append(i)
+                self.by_label.setdefault(lab, []).append(i)
+
+            metas: List[Tuple[str, QuestionMeta]] = []
+            gid = (it.get("gateway") or {}).get("id")
+            if gid:
+                self.by_qid.setdefault(gid, i)
+                metas.append((gid, QuestionMeta(did, "yesno", max_score_for({"response_type": "yesno"}), iid)))
+            for fq in (it.get("followups") or []):
+                qid = fq.get("id")
+                if not qid:
+                    continue
+                self.by_qid.setdefault(qid, i)
+                rt = fq.get("response_type")
+                metas.append((qid, QuestionMeta(did, rt, max_score_for({"response_type": rt}), iid)))
+            self.qmeta_rows.append(metas)
+            for qid, meta in metas:
+                self.qmeta_all[qid] = meta
+
+            rdid = str(it.get("disorder_id", ""))
+            if rdid and sym:
+                if rdid not in pos:
+                    pos[rdid] = len(self.rank_dids)
+                    self.rank_dids.append(rdid)
+                self.rank_rows.append(i)
+                self.rank_did_idx.append(pos[rdid])
+
+# ============= مدل امبدینگ =============
+# torch و sentence_transformers فقط با اولین استفاده از موتور چت import می‌شوند؛
+# urls، دستورات مدیریتی و کمک‌تابع‌های کلیدواژه‌ای بدون آن‌ها بالا می‌آیند.
+@lru_cache(maxsize=1)
+def get_device():
+    import torch
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def _no_grad(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        import torch
+        with torch.no_grad():
+            return fn(*args, **kwargs)
+    return wrapper
+
+ENCODER_BACKENDS = ("torch", "torch_int8", "onnx")
+
+def load_encoder(backend: str = ENCODER_BACKEND) -> "SentenceTransformer":
+    import torch
+    from sentence_transformers import SentenceTransformer
+    if backend == "torch":
+        m = SentenceTransformer(SENTENCE_MODEL_NAME)
+        try: m = m.to(get_device())
+        except Exception: pass
+        return m
+    if backend == "torch_int8":
+        # Linearها به int8 با مقیاس پویا؛ کوانتیزه‌ی پویا فقط روی CPU اجرا می‌شود
+        m = SentenceTransformer(SENTENCE_MODEL_NAME, device="cpu")
+        m = torch.ao.quantization.quantize_dynamic(m, {torch.nn.Linear}, dtype=torch.qint8)
+        m.eval()
+        return m
+    if backend == "onnx":
+        # sentence-transformers>=3.2؛ اگر فایل onnx در مخزن مدل نباشد با optimum export می‌شود
+        kwargs = {"file_name": ENCODER_ONNX_FILE} if ENCODER_ONNX_FILE else {}
+        return SentenceTransformer(SENTENCE_MODEL_NAME, device="cpu", backend="onnx", model_kwargs=kwargs)
+    raise ValueError(f"unknown encoder backend: {backend!r} (expected one of {ENCODER_BACKENDS})")
+
+@lru_cache(maxsize=1)
+def get_model() -> "SentenceTransformer":
+    return load_encoder(ENCODER_BACKEND)
+
+# ============= ایندکس امبدینگ روی دیسک =============
+def _bank_emb_meta_path(path: Path) -> Path:
+    return path.with_suffix(".json")
+
+def bank_fingerprint(raw: Optional[bytes] = None) -> str:
+    h = hashlib.sha256()
+    if raw is None:
+        try:
+            raw = QUESTIONS_FILE.read_bytes()
+        except FileNotFoundError:
+            raw = b""
+    h.update(raw)
+    h.update(b"\0" + SENTENCE_MODEL_NAME.encode("utf-8"))
+    if ENCODER_BACKEND != "torch":
+        # امبدینگ بانک و پرسش باید از یک بک‌اند بیایند
+        h.update(b"\0" + ENCODER_BACKEND.encode("utf-8"))
+    return h.hexdigest()
+
+def _encode_texts(texts: List[str], batch_size: int = ST_BATCH_SIZE,
+                  model: Optional["SentenceTransformer"] = None) -> np.ndarray:
+    import torch
+    m = model or get_model()
+    with torch.no_grad():
+        emb = m.encode(
+            texts,
+            convert_to_numpy=True,
+            batch_size=batch_size,
+            show_progress_bar=False,
+            normalize_embeddings=True,
+        )
+    return np.asarray(emb, dtype=np.float32)
+
+def _atomic_write(path: Path, write) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        try: os.unlink(tmp)
+        except OSError: pass
+        raise
+
+def _save_bank_emb(emb: np.ndarray, path: Path, fingerprint: str) -> None:
+    arr = np.ascontiguousarray(emb, dtype=np.float32)
+    meta = {
+        "fingerprint": fingerprint,
+        "model": SENTENCE_MODEL_NAME,
+        "encoder": ENCODER_BACKEND,
+        "count": int(arr.shape[0]),
+        "dim": int(arr.shape[1]) if arr.ndim == 2 else 0,
+        "dtype": str(arr.dtype),
+    }
+    # اول ماتریس، بعد متادیتا: متادیتای معتبر همیشه به فایل کامل اشاره می‌کند
+    _atomic_write(path, lambda f: np.save(f, arr, allow_pickle=False))
+    _atomic_write(_bank_emb_meta_path(path), lambda f: f.write(json.dumps(meta).encode("utf-8")))
+
+def _mv_emb_path(path: Path) -> Path:
+    return BANK_MV_EMB_FILE if path == BANK_EMB_FILE else path.with_name(path.stem + ".mv.npy")
+
+def build_bank_emb_file(path: Optional[Path] = None) -> Dict[str, Any]:
+    """مرحلهٔ build: امبدینگ نرمال‌شدهٔ عناوین بانک را برای mmap روی دیسک می‌نویسد."""
+    path = Path(path or BANK_EMB_FILE)
+    snap = BankSnapshot(0)
+    emb = _encode_texts(snap.titles)
+    _save_bank_emb(emb, path, snap.fingerprint)
+    if snap.mv_texts:
+        _save_bank_emb(_encode_texts(snap.mv_texts), _mv_emb_path(path), snap.fingerprint)
+    return _load_json(_bank_emb_meta_path(path))
+
+def _load_bank_emb_file(path: Path, fingerprint: str, count: int) -> Optional[np.ndarray]:
+    try:
+        meta = _load_json(_bank_emb_meta_path(path))
+    except (FileNotFoundError, ValueError):
+        return None
+    if meta.get("fingerprint") != fingerprint or meta.get("count") != count:
+        log.info("chat: bank embedding file %s is stale, re-encoding", path)
+        return None
+    if meta.get("dtype") != "float32":
+        # فایل float16 قدیمی: تبدیلش در هر worker یک کپی جدا می‌سازد؛ float32 بازنویسی می‌شود
+        log.info("chat: bank embedding file %s is %s, re-encoding as float32", path, meta.get("dtype"))
+        return None
+    try:
+        return np.load(str(path), mmap_mode="r", allow_pickle=False)
+    except (OSError, ValueError):
+        return None
+
+# ============= ایندکس برداری روی دیسک =============
+def _vindex_prefix(kind: str, path: Optional[Path] = None) -> Path:
+    path = Path(path or BANK_EMB_FILE)
+    return path.with_name(f"{path.stem}.{kind}" + (".mv" if MULTI_VECTOR else ""))
+
+def _build_vector_index(vecs: np.ndarray, kind: str):
+    if kind == "ivf":
+        return IVFIndex.build(vecs, nlist=IVF_NLIST, nprobe=IVF_NPROBE)
+    if kind == "hnsw":
+        return HNSWIndex.build(vecs, ef=HNSW_EF, max_k=ANN_CANDIDATES)
+    return FlatIndex(vecs)
+
+def _load_vector_index(vecs: np.ndarray, kind: str, fingerprint: str):
+    prefix = _vindex_prefix(kind)
+    if kind == "ivf":
+        return IVFIndex.load(prefix, vecs, fingerprint, nprobe=IVF_NPROBE, nlist=IVF_NLIST)
+    if kind == "hnsw":
+        return HNSWIndex.load(prefix, vecs, fingerprint, ef=HNSW_EF, max_k=ANN_CANDIDATES)
+    return FlatIndex(vecs)
+
+def build_vector_index_file(kind: Optional[str] = None, path: Optional[Path] = None):
+    """
+    مرحلهٔ build: ایندکس تقریبی را کنار فایل امبدینگ path (پیش‌فرض BANK_EMB_FILE) می‌نویسد و
+    خود ایندکس هم روی همان امبدینگ‌ها ساخته می‌شود. runtime فقط ایندکس کنار BANK_EMB_FILE را می‌خواند.
+    """
+    kind = kind or VECTOR_INDEX
+    snap = BankSnapshot(0, path)
+    snap.emb()
+    vi = _build_vector_index(snap.search_np, kind)
+    vi.save(_vindex_prefix(kind, path), snap.fingerprint)
+    return snap, vi
+
+def _multi_vector_texts(bank: List[Dict[str, Any]]) -> Tuple[List[str], List[int]]:
+    """متن gateway و followupهای هر آیتم (غیرتکراری درون آیتم) + اندیس آیتم صاحب هر متن."""
+    texts: List[str] = []
+    owner: List[int] = []
+    for i, it in enumerate(bank):
+        seen = {it.get("symptom", "")}
+        cands = [(it.get("gateway") or {}).get("text", "")]
+        cands += [fq.get("text", "") for fq in (it.get("followups") or [])]
+        for t in cands:
+            t = (t or "").strip()
+            if t and t not in seen:
+                seen.add(t)
+                texts.append(t)
+                owner.append(i)
+    return texts, owner
+
+def _reuse_or_encode(texts: List[str], prev_texts: List[str], prev_arr: Optional[np.ndarray], what: str) -> np.ndarray:
+    # فقط متن‌های جدید/تغییرکرده encode می‌شوند؛ بقیه از اسنپ‌شات قبلی برداشته می‌شوند
+    old: Dict[str, int] = {}
+    if prev_arr is not None:
+        for i, t in enumerate(prev_texts):
+            old.setdefault(t, i)
+    missing = [i for i, t in enumerate(texts) if t not in old]
+    if prev_arr is None or len(missing) == len(texts):
+        return _encode_texts(texts)
+    arr = np.empty((len(texts), prev_arr.shape[1]), dtype=np.float32)
+    for i, t in enumerate(texts):
+        if t in old:
+            arr[i] = prev_arr[old[t]]
+    if missing:
+        arr[missing] = _encode_texts([texts[i] for i in missing])
+    log.info("chat: re-embedded %d/%d bank %s", len(missing), len(texts), what)
+    return arr
+
+def _load_or_encode(path: Path, fingerprint: str, texts: List[str],
+                    prev_texts: List[str], prev_arr: Optional[np.ndarray], what: str) -> np.ndarray:
+    arr = _load_bank_emb_file(path, fingerprint, len(texts))
+    if arr is None:
+        arr = _reuse_or_encode(texts, prev_texts, prev_arr, what)
+        if BANK_EMB_AUTOSAVE:
+            try:
+                _save_bank_emb(arr, path, fingerprint)
+            except OSError as e:
+                log.warning("chat: could not write %s: %s", path, e)
+    return np.asarray(arr, dtype=np.float32)     # mmap خودش float32 است و کپی نمی‌شود
+
+def _bank_emb_tensor(arr: np.ndarray):
+    import torch
+    with warnings.catch_warnings():
+        # mmap فقط‌خواندنی است؛ تنسور هیچ‌وقت درجا تغییر نمی‌کند
+        warnings.simplefilter("ignore", UserWarning)
+        emb = torch.from_numpy(arr)
+    try: emb = emb.to(get_device())
+    except Exception: pass
+    return emb
+
+# ============= اسنپ‌شات بانک (قابل بارگذاری مجدد) =============
+def _bank_sources() -> Tuple[Any, ...]:
+    out = []
+    for p in (QUESTIONS_FILE, DIFF_QUESTIONS_FILE, LABELS_FILE):
+        try:
+            st = p.stat()
+            out.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            out.append(None)
+    return tuple(out)
+
+class BankSnapshot:
+    """
+    نسخهٔ تغییرناپذیر بانک سؤالات، برچسب‌ها، سؤالات تمایز و ایندکس‌ها.
+    با تغییر فایل‌ها یک اسنپ‌شات تازه ساخته و اتمیک جایگزین می‌شود؛
+    درخواست‌های در جریان تا پایان روی اسنپ‌شات قبلی می‌مانند.
+    """
+    def __init__(self, version: int, emb_file: Optional[Path] = None):
+        self.version = version
+        self.emb_file = Path(emb_file or BANK_EMB_FILE)   # فایل امبدینگ عناوین (و .mv کنارش)
+        self.sources = _bank_sources()      # قبل از خواندن؛ تغییر هم‌زمان در بررسی بعدی دیده می‌شود
+        try:
+            raw = QUESTIONS_FILE.read_bytes()
+        except FileNotFoundError:
+            raw = b""
+        self.fingerprint = bank_fingerprint(raw)
+        obj = json.loads(raw.decode("utf-8")) if raw else {}
+        self.bank: List[Dict[str, Any]] = obj.get("question_bank", [])
+        self.by_symptom = {it.get("symptom"): it for it in self.bank if it.get("symptom")}
+        self.by_item_id = {it.get("id"): it for it in self.bank if it.get("id")}
+        self.labels = _load_labels()
+        self.diff_bank = _load_diff_bank(DIFF_QUESTIONS_FILE)
+        self.titles = [it.get("symptom", "") for it in self.bank]
+        self.index = QuestionBankIndex(self.bank)
+        self.titles_norm = self.index.labels_norm
+        self.mv_texts, self.mv_owner = _multi_vector_texts(self.bank) if MULTI_VECTOR else ([], [])
+        self._emb = None
+        self.emb_np: Optional[np.ndarray] = None        # امبدینگ عناوین، float32 (mmap در صورت امکان)
+        self.mv_np: Optional[np.ndarray] = None         # امبدینگ متن‌های gateway/followup
+        self.search_np: Optional[np.ndarray] = None     # ماتریس جستجو: عناوین (+ متن‌ها در حالت چندبرداری)
+        self.row_item: Optional[np.ndarray] = None      # آیتم صاحب هر ردیف search_np (فقط چندبرداری)
+        self._row_item_t = None
+        self._emb_ready = False
+        self._emb_lock = threading.Lock()
+        self._rank = None
+        self._vindex = None
+
+    @property
+    def emb_ready(self) -> bool:
+        return self._emb_ready
+
+    def emb(self, prev: Optional["BankSnapshot"] = None):
+        if self._emb_ready:
+            return self._emb
+        with self._emb_lock:
+            if not self._emb_ready:
+                self._emb = self._build_emb(prev)
+                self._emb_ready = True
+        return self._emb
+
+    def _build_emb(self, prev: Optional["BankSnapshot"]):
+        """ماتریس جستجو (تنسور): عناوین، و در حالت چندبرداری عناوین + متن‌های gateway/followup."""
+        if not self.titles:
+            return None
+        warm = prev is not None and prev.emb_ready
+        self.emb_np = _load_or_encode(self.emb_file, self.fingerprint, self.titles,
+                                      prev.titles if warm else [], prev.emb_np if warm else None, "titles")
+        if not self.mv_texts:
+            self.search_np = self.emb_np
+            return _bank_emb_tensor(self.search_np)
+        warm = warm and prev.mv_np is not None
+        self.mv_np = _load_or_encode(_mv_emb_path(self.emb_file), self.fingerprint, self.mv_texts,
+                                     prev.mv_texts if warm else [], prev.mv_np if warm else None, "question texts")
+        self.search_np = np.concatenate([self.emb_np, self.mv_np])
+        self.row_item = np.concatenate([np.arange(len(self.titles)), np.asarray(self.mv_owner)]).astype(np.int64)
+        return _bank_emb_tensor(self.search_np)
+
+    def item_sims(self, row_sims):
+        """تجمیع شباهت ردیف‌های ماتریس جستجو به شباهت هر آیتم بانک (max یا mean) در یک scatter."""
+        if self.row_item is None:
+            return row_sims
+        import torch
+        if self._row_item_t is None:
+            self._row_item_t = torch.from_numpy(self.row_item).to(row_sims.device)
+        n = len(self.bank)
+        # با ایندکس تقریبی ردیف‌های جستجونشده -inf اند؛ میانگین فقط روی جستجوی دقیق معنا دارد
+        if MULTI_VECTOR_AGG == "mean" and bool(torch.isfinite(row_sims).all()):
+            return torch.zeros(n, dtype=row_sims.dtype, device=row_sims.device).scatter_reduce(
+                0, self._row_item_t, row_sims, reduce="mean", include_self=False)
+        return torch.full((n,), float("-inf"), dtype=row_sims.dtype, device=row_sims.device).scatter_reduce(
+            0, self._row_item_t, row_sims, reduce="amax")
+
+    def item_sims_exact(self, items: List[int], q: np.ndarray) -> List[float]:
+        """شباهت دقیق (تجمیع‌شده) فقط برای آیتم‌های داده‌شده."""
+        if self.row_item is None:
+            return (self.emb_np[items] @ q).tolist()
+        owner = self.row_item[len(self.titles):]         # صعودی: متن‌ها به ترتیب آیتم‌ها ساخته شده‌اند
+        lo = np.searchsorted(owner, items, side="left")
+        hi = np.searchsorted(owner, items, side="right")
+        out = []
+        for i, a, b in zip(items, lo, hi):
+            rows = np.concatenate([[i], len(self.titles) + np.arange(a, b)])
+            s = self.search_np[rows] @ q
+            out.append(float(s.mean() if MULTI_VECTOR_AGG == "mean" else s.max()))
+        return out
+
+    def rank_tensors(self):
+        if self._rank is None:
+            import torch
+            rows = torch.tensor(self.index.rank_rows, dtype=torch.long, device=get_device())
+            dids = torch.tensor(self.index.rank_did_idx, dtype=torch.long, device=get_device())
+            self._rank = (rows, dids)
+        return self._rank
+
+    def vector_index(self):
+        """ایندکس جستجوی امبدینگ بانک؛ برای بانک کوچک یا VECTOR_INDEX=flat جستجوی دقیق."""
+        if self._vindex is not None:
+            return self._vindex
+        if self.emb() is None:
+            return None
+        with self._emb_lock:
+            if self._vindex is None:
+                self._vindex = self._build_vindex()
+        return self._vindex
+
+    def _build_vindex(self):
+        kind = VECTOR_INDEX if len(self.search_np) >= VECTOR_INDEX_MIN_ITEMS else "flat"
+        if kind not in INDEX_KINDS:
+            log.warning("chat: unknown VECTOR_INDEX %r, using flat", kind)
+            kind = "flat"
+        try:
+            vi = _load_vector_index(self.search_np, kind, self.fingerprint)
+            if vi is None:
+                t0 = time.perf_counter()
+                vi = _build_vector_index(self.search_np, kind)
+                log.info("chat: built %s index over %d rows in %.2fs", kind, len(self.search_np), time.perf_counter() - t0)
+                if BANK_EMB_AUTOSAVE:
+                    try:
+                        vi.save(_vindex_prefix(kind), self.fingerprint)
+                    except OSError as e:
+                        log.warning("chat: could not write %s index: %s", kind, e)
+            return vi
+        except ImportError as e:
+            log.warning("chat: %s index unavailable (%s), using flat", kind, e)
+            return FlatIndex(self.search_np)
+
+
+_SNAPSHOT: Optional[BankSnapshot] = None
+_SNAPSHOT_LOCK = threading.Lock()
+_SNAPSHOT_CHECKED = 0.0
+_SNAPSHOT_BAD_SOURCES: Optional[Tuple[Any, ...]] = None
+_PINNED: ContextVar[Optional[BankSnapshot]] = ContextVar("chat_bank_snapshot", default=None)
+
+def reload_bank(force: bool = False, blocking: bool = True) -> BankSnapshot:
+    """
+    اسنپ‌شات تازه می‌سازد و جایگزین می‌کند (اگر فایل‌ها تغییر کرده باشند یا force).
+    هر چه اسنپ‌شات فعلی گرم دارد (امبدینگ افزایشی، ایندکس برداری، تنسورهای رتبه‌بندی) قبل از
+    جایگزینی برای نسخهٔ جدید هم ساخته می‌شود تا اولین درخواست بعد از تعویض هزینه‌ای ندهد.
+    """
+    global _SNAPSHOT, _SNAPSHOT_BAD_SOURCES
+    if not _SNAPSHOT_LOCK.acquire(blocking=blocking):
+        return _SNAPSHOT
+    try:
+        old = _SNAPSHOT
+        if old is not None and not force and _bank_sources() == old.sources:
+            return old
+        try:
+            new = BankSnapshot(old.version + 1 if old else 1)
+            if old is not None and old.emb_ready:
+                new.emb(prev=old)
+                if old._vindex is not None:
+                    new.vector_index()
+                if old._rank is not None:
+                    new.rank_tensors()
+        except Exception:
+            if old is None:
+                raise
+            # فایل نیمه‌نوشته/نامعتبر: نسخهٔ فعلی می‌ماند تا تغییر بعدی
+            _SNAPSHOT_BAD_SOURCES = _bank_sources()
+            log.exception("chat: bank reload failed, keeping version %s", old.version)
+            return old
+        _SNAPSHOT = new
+        _SNAPSHOT_BAD_SOURCES = None
+        log.info("chat: question bank version %s loaded (%d items)", new.version, len(new.bank))
+        return new
+    finally:
+        _SNAPSHOT_LOCK.release()
+
+_RELOAD_THREAD: Optional[threading.Thread] = None
+_RELOAD_THREAD_LOCK = threading.Lock()
+
+def _reload_in_background() -> None:
+    """
+    reload در thread جدا؛ درخواستی که تغییر را دیده (و بقیه) تا آماده شدن نسخهٔ جدید
+    همان اسنپ‌شات قبلی را می‌گیرند و encode/ساخت ایندکس روی مسیر درخواست نمی‌افتد.
+    """
+    global _RELOAD_THREAD
+    with _RELOAD_THREAD_LOCK:
+        if _RELOAD_THREAD is not None and _RELOAD_THREAD.is_alive():
+            return
+        _RELOAD_THREAD = threading.Thread(target=_background_reload, name="chat-bank-reload", daemon=True)
+        _RELOAD_THREAD.start()
+
+def _background_reload() -> None:
+    try:
+        reload_bank()
+    except Exception:
+        log.exception("chat: background bank reload failed")
+
+def get_snapshot() -> BankSnapshot:
+    global _SNAPSHOT_CHECKED
+    snap = _SNAPSHOT
+    if snap is None:
+        return reload_bank()
+    if BANK_RELOAD_INTERVAL > 0:
+        now = time.monotonic()
+        if now - _SNAPSHOT_CHECKED >= BANK_RELOAD_INTERVAL:
+            _SNAPSHOT_CHECKED = now
+            src = _bank_sources()
+            if src != snap.sources and src != _SNAPSHOT_BAD_SOURCES:
+                _reload_in_background()
+    return snap
+
+def current_snapshot() -> BankSnapshot:
+    """اسنپ‌شاتِ قفل‌شده برای درخواست جاری، وگرنه آخرین نسخه."""
+    snap = _PINNED.get()
+    return snap if snap is not None else get_snapshot()
+
+@contextmanager
+def pinned_snapshot():
+    token = _PINNED.set(current_snapshot())
+    try:
+        yield _PINNED.get()
+    finally:
+        _PINNED.reset(token)
+
+def get_bank_emb():
+    return current_snapshot().emb()
+
+# ============= کلیدواژه‌ها =============
+# اضطراب/پانیک
+KW_GAD_CORE: Set[str] = {"نگرانی","دلشوره","استرس","بی‌قراری","تنش","کنترل‌ناپذیر"}
+KW_PANIC: Set[str] = {
+    "حمله پانیک","حملهٔ پانیک","حمله وحشت","حمله اضطراب","پانیک",
+    "تپش قلب","قلبم تند می‌زنه","قلبم تند میزنه",
+    "تنگی نفس","نفس کم میارم","احساس خفگی","خفگی","نمی‌تونم نفس بکشم","نمیتونم نفس بکشم",
+    "سرگیجه","سبکی سر","تعریق","لرزش","مورمور","بی‌حسی","گزگز",
+    "ترس از مردن","می‌میرم الان","ترس از دیوونه شدن","کنترل از دست میره",
+    "حمله ناگهانی","ناگهانی میاد","یهویی میاد"
+}
+
+# وسواس
+KW_OCD: Set[str] = {"وسواس","افکار مزاحم","ناخواسته","اجبار","شستن","چک کردن","مرتب کردن","شمردن"}
+KW_OCD_STRONG: Set[str] = {
+    "کثیفه","کثیف","آلودگی","آلوده","نمی‌تونم به چیزی دست بزنم","می‌شورم","چند بار","مرتب می‌شورم","چک می‌کنم","ضدعفونی"
+}
+
+# مانیا/افسردگی
+KW_SLEEP: Set[str] = {"بی‌خوابی","بی خواب","کم‌خوابی","پرخوابی","خواب","بیدار","صبح زود","کابوس","ریتم"}
+KW_DEPRESSIVE: Set[str] = {"افسرد","غم","غمگین","ناامید","بی‌انگیزه","بی‌علاقه","لذت نمی‌برم","پرخوابی","پوچی","خستگی","حالم بده"}
+KW_IRRITABILITY: Set[str] = {"عصبی","عصبانی","زودرنج","تحریک‌پذیر","تحریک پذیری"}
+KW_MANIC: Set[str] = {
+    "پرانرژی","انرژیم بالاست","کاهش نیاز به خواب","پرحرف",
+    "ولخرجی","ریسکی","میل جنسی زیاد","خوشحال غیرعادی","تحریک‌پذیر",
+    "مانیا","هیپومانیا","خلق بالا","افکار تندتند","نوسان خلق","بی‌قرار","تمرکز ندارم","حواس‌پرتی"
+}
+
+# جنسیت/دیفوریا و پارافیلیک
+KW_GENDER_DYSPHORIA: Set[str] = {
+    "با جنسیت خودم راحت نیستم","ناراحتی از جنسیت","دوست ندارم جنسیت خودم",
+    "می‌خوام مرد باشم","می‌خوام زن باشم",
+    "اسم خودمو صدا نزنن","ضمیر","می‌خوام با ضمیر دیگه صدام کنن",
+    "دوست دارم لباس جنس مقابل بپوشم","نقش اجتماعی جنس دیگر","ویژگی‌های جنسی اذیتم می‌کنه",
+    "دوست ندارم بدن/اندام جنسی فعلی"
+}
+KW_SEXUAL_AROUSAL_WORDS: Set[str] = {
+    "تحریک","برانگیختگی","شهوت","لذت جنسی","فانتزی جنسی","برایم تحریک‌کننده است","ارگاسم"
+}
+
+# سایر دسته‌ها
+KW_AVOIDANT_PD: Set[str] = {"اجتناب","طرد","نقد","کفایت","بی‌عرضگی","خجالت","کمرویی","تنهایی","فاصله","روابط صمیمی"}
+KW_TRAUMA: Set[str] = {"تروما","حادثه","آزار","تصادف","جنگ","فاجعه","مرگ ناگهانی","تجاوز"}
+KW_PTSD_SYMPTOMS: Set[str] = {"فلش‌بک","کابوس","اجتناب","گوش به زنگ","بی‌حسی هیجانی"}
+
+KW_BINGE_EATING: Set[str] = {"پرخوری","مقدار زیاد غذا","کنترل از دست رفته","شرم","گناه"}
+KW_COMPENSATORY_BEHAVIORS: Set[str] = {"استفراغ","ملین","ورزش زیاد","روزه","جبران"}
+KW_EATING_TRIGGER: Set[str] = {"بی‌اشتهایی","لاغری","چاقی","وزن","رژیم","اندام","بدن","غذا"}
+
+KW_SUBSTANCE: Set[str] = {"مواد","الکل","سیگار","قلیان","تریاک","شیشه","حشیش","ترک","دارو","اعتیاد"}
+KW_MEDICAL: Set[str]   = {"بیماری جسمی","تیروئید","قلب","صرع","پارکینسون","دیابت"}
+
+KW_SEXUAL_GENERAL: Set[str] = {"رابطه جنسی","سکس","میل جنسی","انزال","ارگاسم","درد هنگام رابطه"}
+KW_SEXUAL_ED: Set[str] = {"نعوظ","نعوذ","سفت نمیشه","نعوظ سخت","قادر به نعوظ نیستم"}
+
+KW_CHILDHOOD_ONSET: Set[str] = {"از کودکی","کودکی","قبل از ۱۲","قبل از12","قبل از دوازده"}
+KW_ADHD: Set[str] = {"adhd","بیش‌فعالی","بیش فعالی","نقص توجه"}
+
+KW_SHIFT: Set[str] = {"شیفت","شیفت کاری","نوبت‌کاری","شیفت شب"}
+KW_PHASE: Set[str] = {"خیلی دیر می‌خوابم","دیر می‌خوابم","دیر بیدار می‌شم","تا دیروقت بیدارم"}
+
+KW_BDD: Set[str] = {"بدریخت","بدشکلی","ظاهر","دماغ","پوست","آینه","عکس","پوشاندن","مقایسه"}
+KW_HEALTH_ANX: Set[str] = {"بیماری جدی","سرطان","ام اس","ms","آزمایش می‌دم","چک می‌کنم بدن"}
+KW_BPD: Set[str] = {"ترس از رها شدن","رابطه‌هام بالا پایین","قهر","مرزی","بی‌ثباتی هویت"}
+KW_DISS: Set[str] = {"مسخ شخصیت","مسخ واقعیت","غیرواقعی","گسست","هویت","یادم نمیاد","فراموشی"}
+KW_GRIEF: Set[str] = {"سوگ","عزا","عزاداری","فقدان","از دست دادم","مرگ","فوت"}
+KW_PERIPARTUM: Set[str] = {"بارداری","حامله","زایمان","پس از زایمان","پیرامون‌زایمان","نوزاد","شیردهی"}
+KW_EXCESSIVE_SLEEPINESS: Set[str] = {"خواب‌آلودگی","حملات خواب","کاتاپلکسی","چرت‌های ناگهانی"}
+
+# واژگان کوچک هیوریستیک‌های تمایز
+KW_ATTENTION: Set[str] = {"تمرکز","حواس","بی‌قراری"}
+KW_FOCUS: Set[str] = {"تمرکز","حواس"}
+KW_SOCIAL: Set[str] = {"جمع","اجتماعی","قضاوت","مسخره"}
+KW_ATYPICAL: Set[str] = {"پرخوابی","پرخوری","صبح زود"}
+KW_SOMATIC: Set[str] = {"علائم جسمی","درد"}
+KW_APPEARANCE: Set[str] = {"ظاهر","قیافه","دماغ"}
+KW_CROSS_DRESS: Set[str] = {"لباس جنس دیگر"}
+
+# ============= تطبیق یک‌بارهٔ کلیدواژه‌ها (Aho–Corasick) =============
+# هر واژگانی که هیوریستیک‌ها با hits.has(...) می‌پرسند باید این‌جا ثبت شده باشد
+KEYWORD_SETS: Dict[str, Iterable[str]] = {
+    "EMERGENCY_KEYWORDS": EMERGENCY_KEYWORDS,
+    "KW_GAD_CORE": KW_GAD_CORE, "KW_PANIC": KW_PANIC,
+    "KW_OCD": KW_OCD, "KW_OCD_STRONG": KW_OCD_STRONG,
+    "KW_SLEEP": KW_SLEEP, "KW_DEPRESSIVE": KW_DEPRESSIVE, "KW_IRRITABILITY": KW_IRRITABILITY, "KW_MANIC": KW_MANIC,
+    "KW_GENDER_DYSPHORIA": KW_GENDER_DYSPHORIA, "KW_SEXUAL_AROUSAL_WORDS": KW_SEXUAL_AROUSAL_WORDS,
+    "KW_AVOIDANT_PD": KW_AVOIDANT_PD, "KW_TRAUMA": KW_TRAUMA, "KW_PTSD_SYMPTOMS": KW_PTSD_SYMPTOMS,
+    "KW_BINGE_EATING": KW_BINGE_EATING, "KW_COMPENSATORY_BEHAVIORS": KW_COMPENSATORY_BEHAVIORS,
+    "KW_EATING_TRIGGER": KW_EATING_TRIGGER,
+    "KW_SUBSTANCE": KW_SUBSTANCE, "KW_MEDICAL": KW_MEDICAL,
+    "KW_SEXUAL_GENERAL": KW_SEXUAL_GENERAL, "KW_SEXUAL_ED": KW_SEXUAL_ED,
+    "KW_CHILDHOOD_ONSET": KW_CHILDHOOD_ONSET, "KW_ADHD": KW_ADHD,
+    "KW_SHIFT": KW_SHIFT, "KW_PHASE": KW_PHASE,
+    "KW_BDD": KW_BDD, "KW_HEALTH_ANX": KW_HEALTH_ANX, "KW_BPD": KW_BPD, "KW_DISS": KW_DISS,
+    "KW_GRIEF": KW_GRIEF, "KW_PERIPARTUM": KW_PERIPARTUM, "KW_EXCESSIVE_SLEEPINESS": KW_EXCESSIVE_SLEEPINESS,
+    "KW_ATTENTION": KW_ATTENTION, "KW_FOCUS": KW_FOCUS, "KW_SOCIAL": KW_SOCIAL, "KW_ATYPICAL": KW_ATYPICAL,
+    "KW_SOMATIC": KW_SOMATIC, "KW_APPEARANCE": KW_APPEARANCE, "KW_CROSS_DRESS": KW_CROSS_DRESS,
+}
+_KW_NAME_BY_ID: Dict[int, str] = {id(v): k for k, v in KEYWORD_SETS.items()}
+_KW_MATCHER = KeywordMatcher({k: {w.lower() for w in v} for k, v in KEYWORD_SETS.items()})
+
+def _kw_norm(text: str) -> str:
+    return (text or "").replace("‌"," ").lower()
+
+class KeywordHits:
+    """نتیجهٔ یک بار پیمایش متن: نام همهٔ واژگان‌هایی که در متن آمده‌اند."""
+    __slots__ = ("names",)
+
+    def __init__(self, names: FrozenSet[str]):
+        self.names = names
+
+    def has(self, *vocabs: Iterable[str]) -> bool:
+        return any(_KW_NAME_BY_ID[id(v)] in self.names for v in vocabs)
+
+def keyword_hits(text: str) -> KeywordHits:
+    return KeywordHits(_KW_MATCHER.scan(_kw_norm(text)))
+
+def is_mania_like(hits: KeywordHits) -> bool:
+    return hits.has(KW_MANIC)
+
+def is_grief_dominant(hits: KeywordHits) -> bool:
+    return hits.has(KW_GRIEF) and not is_mania_like(hits)
+
+def has_adhd_signal(hits: KeywordHits) -> bool:
+    return (
+        hits.has(KW_ADHD) or
+        (hits.has(KW_ATTENTION) and hits.has(KW_CHILDHOOD_ONSET))
+    )
+
+# ============= امبدینگ/رنکینگ =============
+@_no_grad
+def rank_by_sims(sims, top_k: int = 5, min_sim: float = 0.45,
+                 snap: Optional[BankSnapshot] = None) -> List[Tuple[str, float, int]]:
+    """
+    max-pooling هر اختلال روی بردار شباهت با scatter-max (بدون حلقهٔ پایتونی روی بانک):
+    بهترین آیتم هر disorder_id، آستانهٔ min_sim و top-k در چند عمل برداری.
+    """
+    import torch
+    snap = snap or current_snapshot()
+    index = snap.index
+    if not index.rank_rows:
+        return []
+    rows, dids = snap.rank_tensors()
+    nbank = len(snap.bank)
+    s = sims.index_select(0, rows).float()
+    n = len(index.rank_dids)
+    best = torch.full((n,), float("-inf"), device=s.device).scatter_reduce(0, dids, s, reduce="amax")
+    # در تساوی، اولین ردیف بانک (کوچک‌ترین اندیس) برنده است
+    cand = torch.where(s == best.index_select(0, dids), rows, torch.full_like(rows, nbank))
+    arg = torch.full((n,), nbank, dtype=torch.long, device=s.device).scatter_reduce(0, dids, cand, reduce="amin")
+
+    best = torch.where(best >= min_sim, best, torch.full_like(best, float("-inf")))
+    k = min(top_k, n)
+    if k <= 0:
+        return []
+    # مرتب‌سازی پایدار: در تساوی امتیاز، اختلالی که زودتر در بانک آمده جلوتر است
+    vals, didx = torch.sort(best, descending=True, stable=True)
+    vals, didx = vals[:k], didx[:k]
+    out: List[Tuple[str, float, int]] = []
+    for v, d, i in zip(vals.tolist(), didx.tolist(), arg.index_select(0, didx).tolist()):
+        if v == float("-inf"):
+            break
+        out.append((index.rank_dids[d], float(v), int(i)))
+    return out
+
+# ============= کانتکست درخواست =============
+@dataclass
+class QueryContext:
+    """امبدینگ پیام و شباهتش با کل بانک؛ یک بار در هر درخواست محاسبه و در کل pipeline استفاده می‌شود."""
+    text: str
+    snap: BankSnapshot
+    hits: Optional[KeywordHits] = None
+    key: str = ""            # normalize_query(text)؛ کلید کش
+    emb: Any = None          # [1, dim] نرمال‌شده
+    sims: Any = None         # [len(snap.bank)] شباهت با همهٔ عناوین بانک (با ایندکس تقریبی: فقط نامزدها، بقیه -inf)
+    exact: bool = True
+    _sim_list: Optional[List[float]] = field(default=None, repr=False)
+
+    def sim_values(self) -> List[float]:
+        # یک بار انتقال به پایتون برای sortهای بعدی (به‌جای float(sims[i]) در هر مقایسه)
+        if self._sim_list is None:
+            self._sim_list = [] if self.sims is None else self.sims.float().cpu().tolist()
+        return self._sim_list
+
+    def row_sims(self, rows: List[int]) -> List[float]:
+        """شباهت دقیق با ردیف‌های داده‌شده (با ایندکس تقریبی فقط همین ردیف‌ها محاسبه می‌شوند)."""
+        if self.exact:
+            sims = self.sim_values()
+            return [sims[i] for i in rows]
+        return self.snap.item_sims_exact(rows, self.emb[0].float().cpu().numpy())
+
+@lru_cache(maxsize=1)
+def get_query_batcher() -> EmbeddingBatcher:
+    return EmbeddingBatcher(
+        lambda texts: _encode_texts(texts, batch_size=EMBED_MAX_BATCH),
+        max_batch=EMBED_MAX_BATCH,
+        max_wait=EMBED_MAX_WAIT_MS / 1000.0,
+        name="query-embed",
+    )
+
+@_no_grad
+def encode_query(user_text: str):
+    import torch
+    if EMBED_BATCHING:
+        vec = get_query_batcher().encode(user_text)
+        return torch.from_numpy(vec).unsqueeze(0).to(get_device())
+    m = get_model()
+    return m.encode([user_text], convert_to_tensor=True, normalize_embeddings=True).to(get_device())
+
+# ============= کش پرسش‌ها =============
+# امبدینگ فقط به متن و مدل وابسته است و با تعویض بانک باطل نمی‌شود؛
+# رتبه‌بندی به fingerprint بانک گره خورده و با اسنپ‌شات تازه کنار گذاشته می‌شود.
+_EMB_CACHE = TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+_ROWS_CACHE = TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+_ROWS_CACHE_FP = ""                  # fingerprint بانکی که _ROWS_CACHE برایش پر شده
+_SHARED_M = {"hits": 0, "misses": 0, "errors": 0}
+_QUERY_CACHE_LOCK = threading.Lock()  # برای _SHARED_M و _ROWS_CACHE_FP
+
+def _settings_hash(*parts: Any) -> str:
+    return hashlib.sha1("\0".join(map(str, parts)).encode("utf-8")).hexdigest()[:12]
+
+# کلیدهای کش مشترک بین پروسه‌هایی با تنظیمات متفاوت نباید هم‌پوشانی داشته باشند:
+# امبدینگ به مدل/بک‌اند وابسته است، رتبه‌بندی به همهٔ تنظیمات بازیابی و fingerprint بانک هم
+_SHARED_PREFIX = "chat:q:" + _settings_hash(SENTENCE_MODEL_NAME, ENCODER_BACKEND)
+_SHARED_RANK_PREFIX = "chat:q:" + _settings_hash(
+    SENTENCE_MODEL_NAME, ENCODER_BACKEND, MULTI_VECTOR, MULTI_VECTOR_AGG, VECTOR_INDEX,
+    VECTOR_INDEX_MIN_ITEMS, ANN_CANDIDATES, IVF_NLIST, IVF_NPROBE, HNSW_EF,
+)
+
+def _shared_cache():
+    if not QUERY_CACHE_ALIAS or not QUERY_CACHE_SIZE:
+        return None
+    from django.core.cache import caches
+    return caches[QUERY_CACHE_ALIAS]
+
+def _shared_key(kind: str, *parts: str, prefix: str = _SHARED_PREFIX) -> str:
+    return f"{prefix}:{kind}:" + hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()
+
+def _shared_rows_key(fp: str, *parts: str) -> str:
+    return _shared_key("rows", *parts, prefix=f"{_SHARED_RANK_PREFIX}:{fp[:16]}")
+
+def _shared_count(name: str) -> None:
+    with _QUERY_CACHE_LOCK:
+        _SHARED_M[name] += 1
+
+def _shared_get(key: str) -> Any:
+    cache = _shared_cache()
+    if cache is None:
+        return None
+    try:
+        val = cache.get(key)
+    except Exception:
+        _shared_count("errors")
+        return None
+    _shared_count("hits" if val is not None else "misses")
+    return val
+
+def _shared_set(key: str, val: Any) -> None:
+    cache = _shared_cache()
+    if cache is None:
+        return
+    try:
+        cache.set(key, val, timeout=QUERY_CACHE_TTL or None)
+    except Exception:
+        _shared_count("errors")
+
+def _query_emb(key: str, text: str) -> np.ndarray:
+    # key فقط برای جستجوی کش است؛ در miss خود متن کاربر encode می‌شود
+    vec = _EMB_CACHE.get(key)
+    if vec is not None:
+        return vec
+    raw = _shared_get(_shared_key("emb", key))
+    if raw is not None:
+        vec = np.frombuffer(raw, dtype=np.float32).copy()
+    else:
+        vec = encode_query(text)[0].float().cpu().numpy()
+        _shared_set(_shared_key("emb", key), vec.tobytes())
+    _EMB_CACHE.set(key, vec)
+    return vec
+
+def query_cache_stats() -> Dict[str, Any]:
+    with _QUERY_CACHE_LOCK:
+        shared = dict(_SHARED_M)
+    return {"emb": _EMB_CACHE.stats(), "rows": _ROWS_CACHE.stats(),
+            "shared": dict(shared, alias=QUERY_CACHE_ALIAS)}
+
+@_no_grad
+def build_query_context(user_text: str, hits: Optional[KeywordHits] = None) -> QueryContext:
+    snap = current_snapshot()
+    ctx = QueryContext(text=user_text, snap=snap, hits=hits or keyword_hits(user_text),
+                       key=normalize_query(user_text))
+    bank_emb = snap.emb()
+    if bank_emb is None or not snap.titles:
+        return ctx
+    import torch
+    q = _query_emb(ctx.key, user_text)
+    ctx.emb = torch.from_numpy(q).unsqueeze(0).to(get_device())
+    vi = snap.vector_index()
+    if vi.exact:
+        # هر دو طرف نرمال‌شده‌اند: ضرب داخلی همان cos_sim است
+        sims = torch.mv(bank_emb, ctx.emb[0].to(bank_emb.dtype))
+    else:
+        scores, ids = vi.search(q, ANN_CANDIDATES)
+        sims = torch.full((len(snap.search_np),), float("-inf"))
+        sims[torch.from_numpy(ids)] = torch.from_numpy(np.ascontiguousarray(scores, dtype=np.float32))
+        sims = sims.to(get_device())
+        ctx.exact = False
+    ctx.sims = snap.item_sims(sims)
+    return ctx
+
+def rank_disorders(ctx: QueryContext, top_k: int = 5, min_sim: float = 0.45) -> List[Tuple[str, float, int]]:
+    global _ROWS_CACHE_FP
+    if ctx.sims is None:
+        return []
+    fp = ctx.snap.fingerprint
+    if _ROWS_CACHE_FP != fp:
+        with _QUERY_CACHE_LOCK:
+            if _ROWS_CACHE_FP != fp:
+                _ROWS_CACHE.clear()
+                _ROWS_CACHE_FP = fp
+    ck = (fp, ctx.key, top_k, min_sim)
+    rows = _ROWS_CACHE.get(ck)
+    if rows is None:
+        sk = _shared_rows_key(fp, ctx.key, str(top_k), repr(min_sim))
+        rows = _shared_get(sk)
+        if rows is not None:
+            rows = [tuple(r) for r in rows]
+        else:
+            rows = rank_by_sims(ctx.sims, top_k=top_k, min_sim=min_sim, snap=ctx.snap)
+            _shared_set(sk, rows)
+        _ROWS_CACHE.set(ck, rows)
+    return list(rows)
+
+def rank_disorders_from_text(user_text: str, top_k: int = 5, min_sim: float = 0.45) -> List[Tuple[str, float, int]]:
+    return rank_disorders(build_query_context(user_text), top_k=top_k, min_sim=min_sim)
+
+def pick_representative_items(rows: List[Tuple[str,float,int]]) -> List[Dict[str,Any]]:
+    bank = current_snapshot().bank
+    return [bank[idx] for _,_,idx in rows]
+
+def _find_item_by_id(item_id: str) -> Optional[Dict[str, Any]]:
+    if not item_id: return None
+    snap = current_snapshot()
+    i = snap.index.by_id.get(item_id)
+    return None if i is None else snap.bank[i]
+
+def _find_representative_item_for_did(did: str,
+                                      prefer_ids: Optional[List[str]] = None,
+                                      prefer_symptom_subs: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+    prefer_ids = prefer_ids or []
+    prefer_symptom_subs = [s.lower() for s in (prefer_symptom_subs or [])]
+
+    snap = current_snapshot()
+    bank, index = snap.bank, snap.index
+    hits = [index.by_did_id[(did, iid)] for iid in prefer_ids if (did, iid) in index.by_did_id]
+    if hits:
+        return bank[min(hits)]
+    rows = index.by_did.get(did) or []
+    if prefer_symptom_subs:
+        for i in rows:
+            sym = (bank[i].get("symptom","") or "").lower()
+            if any(sub in sym for sub in prefer_symptom_subs):
+                return bank[i]
+    return bank[rows[0]] if rows else None
+
+# ============= ساخت Batch =============
+def _group_from_item(it: Dict[str, Any]) -> Dict[str, Any]:
+    gqs = []
+    gw = (it.get("gateway") or {})
+    gw_text = gw.get("text", "")
+    timeframe = gw.get("timeframe_hint", "")
+    if timeframe:
+        gw_text = f"{gw_text}\n🕒 بازهٔ مدنظر: {timeframe}"
+    gqs.append({"qid": gw.get("id"), "kind": "yesno", "text": gw_text, "required": False})
+
+    for fq in (it.get("followups") or []):
+        rt = fq.get("response_type")
+        qobj = {"qid": fq.get("id"), "text": fq.get("text",""), "required": False}
+        if rt == "yesno":
+            qobj["kind"] = "yesno"
+        elif rt == "likert_0_3":
+            qobj["kind"] = "likert"; qobj["min"]=0; qobj["max"]=3
+        else:
+            qobj["kind"] = "text"; qobj["placeholder"] = "مثال یا توضیح کوتاه..."
+        gqs.append(qobj)
+
+    return {
+        "title": it.get("symptom",""),
+        "disorder_id": str(it.get("disorder_id","")),
+        "questions": gqs
+    }
+
+def build_batch_spec_multi(ctx: QueryContext,
+                           selected_items: List[Dict[str,Any]],
+                           per_family: int = BATCH_ITEMS_PER_FAMILY,
+                           max_groups: int = BATCH_MAX_GROUPS) -> Tuple[List[Dict[str,Any]], Dict[str,Any]]:
+    bank, index = ctx.snap.bank, ctx.snap.index
+
+    picked_idx: List[int] = []
+    seen_norm: Set[str] = set()
+
+    for base in selected_items:
+        did = str(base.get("disorder_id"))
+        same_idx = index.by_did_symptom.get(did) or []
+        if ctx.sims is not None and same_idx:
+            sims = dict(zip(same_idx, ctx.row_sims(same_idx)))
+            same_sorted = sorted(same_idx, key=lambda i: sims[i], reverse=True)
+        else:
+            same_sorted = same_idx
+
+        cnt = 0
+        for i in same_sorted:
+            lab = index.labels_norm[i]
+            if lab in seen_norm:
+                continue
+            seen_norm.add(lab)
+            picked_idx.append(i)
+            cnt += 1
+            if cnt >= per_family:
+                break
+        if len(picked_idx) >= max_groups:
+            break
+
+    items = [bank[i] for i in picked_idx]
+    groups = [_group_from_item(it) for it in items]
+    spec = {"ui":"batch","groups": groups}
+    return items, spec
+
+# ============= فیلتر زمینه‌ای =============
+def filter_groups_by_context(ctx: QueryContext, groups: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
+    hits = ctx.hits
+    has_substance   = hits.has(KW_SUBSTANCE)
+    has_medical     = hits.has(KW_MEDICAL)
+    mania_like      = is_mania_like(hits)
+
+    has_peripartum  = hits.has(KW_PERIPARTUM)
+    has_eating      = hits.has(KW_BINGE_EATING) or hits.has(KW_COMPENSATORY_BEHAVIORS) or hits.has(KW_EATING_TRIGGER)
+    has_excess_day  = hits.has(KW_EXCESSIVE_SLEEPINESS)
+    has_child_adhd  = has_adhd_signal(hits)
+
+    # تمایز دیفوریا در برابر پارافیلیک: اگر «پوشیدن لباس جنس دیگر» بدون واژگان برانگیختگی جنسی بیاید،
+    # گروه‌های پارافیلیکِ صرف را حذف می‌کنیم (تا جای درست یعنی Gender Dysphoria فعال بماند).
+    mention_cross_dress = hits.has(KW_CROSS_DRESS)
+    mention_arousal     = hits.has(KW_SEXUAL_AROUSAL_WORDS)
+
+    out: List[Dict[str,Any]] = []
+    seen_titles: Set[str] = set()
+
+    for g in groups:
+        title = (g.get("title") or "")
+        tlow = title.lower()
+
+        if ("ماده" in tlow or "مصرف" in tlow or "دارو" in tlow or "جسمی" in tlow):
+            if not (has_substance or has_medical):
+                continue
+
+        if mania_like and any(k in tlow for k in ["نارکولپسی","آپنه","پاراسومنیا","ریتم خواب","ریتم","پرخوابی","بی‌خوابی"]):
+            continue
+
+        if any(k in tlow for k in ["زایمان","بارداری","پیرامون"]):
+            if not has_peripartum:
+                continue
+
+        if any(k in tlow for k in ["پرخوری","بی‌اشتهایی","رومینیشن","پیکا","خوردن"]):
+            if not has_eating:
+                continue
+
+        if any(k in tlow for k in ["نارکولپسی","خواب‌آلودگی","حملات خواب"]):
+            if not has_excess_day:
+                continue
+
+        if any(k in tlow for k in ["adhd","بیش‌فعالی","نقص توجه","یادگیری","اوتیسم","تیک","tourette"]):
+            if not has_child_adhd:
+                continue
+
+        # حذف پارافیلیک ترانسوستیک اگر کاربر فقط از پوشش/نقش گفت و اشاره‌ای به برانگیختگی جنسی نکرد
+        if ("transvestic" in tlow or "ترانسوستیک" in tlow or "پوشیدن لباس جنس دیگر" in tlow):
+            if mention_cross_dress and not mention_arousal:
+                continue
+
+        nl = _norm_label(title)
+        if nl in seen_titles:
+            continue
+        seen_titles.add(nl)
+
+        out.append(g)
+
+    return out
+
+# ============= تمایز (Diff) =============
+def _label_has_any(did: str, subs: Set[str]) -> bool:
+    lab = (current_snapshot().labels.get(did, "") or "").lower()
+    return any(s in lab for s in subs)
+
+def _rows_contain_labels(rows: List[Tuple[str,float,int]], subs: Set[str]) -> bool:
+    return any(_label_has_any(did, subs) for did,_,_ in rows)
+
+def need_mdd_vs_bipolar(hits: KeywordHits, rows) -> bool:
+    if is_grief_dominant(hits):
+        return False
+    dep_kw = hits.has(KW_DEPRESSIVE)
+    cand_dep = _rows_contain_labels(rows, {"افسرد","depress"})
+    if not (dep_kw or cand_dep):
+        return False
+    mania = is_mania_like(hits)
+    redflag = hits.has(KW_SLEEP) and hits.has(KW_IRRITABILITY)
+    if mania or redflag:
+        return True
+    has_dep = cand_dep
+    has_bip = _rows_contain_labels(rows, {"دو قطبی","دوقطبی","bipolar","مانیا"})
+    return has_dep and has_bip
+
+def need_gad_vs_ocd(hits: KeywordHits, rows) -> bool:
+    return (hits.has(KW_GAD_CORE) and (hits.has(KW_OCD) or hits.has(KW_OCD_STRONG)))
+
+def need_social_anxiety_vs_avoidant_pd(hits: KeywordHits, rows) -> bool:
+    return hits.has(KW_SOCIAL) or hits.has(KW_AVOIDANT_PD)
+
+def need_bed_vs_bulimia(hits: KeywordHits, rows) -> bool:
+    return hits.has(KW_BINGE_EATING) or hits.has(KW_COMPENSATORY_BEHAVIORS)
+
+def need_bipolar_vs_adhd(hits: KeywordHits, rows) -> bool:
+    return is_mania_like(hits) or has_adhd_signal(hits)
+
+def need_insomnia_vs_circadian(hits: KeywordHits, rows) -> bool:
+    return hits.has(KW_SLEEP) and (hits.has(KW_SHIFT) or hits.has(KW_PHASE))
+
+def need_ocd_vs_ocpd(hits: KeywordHits, rows) -> bool:
+    return hits.has(KW_OCD) or hits.has(KW_OCD_STRONG)
+
+def need_dysthymia_vs_mdd(hits: KeywordHits, rows) -> bool:
+    return hits.has(KW_DEPRESSIVE)
+
+def need_ptsd_vs_bpd(hits: KeywordHits, rows) -> bool:
+    return (hits.has(KW_TRAUMA) or hits.has(KW_PTSD_SYMPTOMS)) or hits.has(KW_BPD)
+
+def need_adhd_vs_depression(hits: KeywordHits, rows) -> bool:
+    return has_adhd_signal(hits) or (hits.has(KW_DEPRESSIVE) and hits.has(KW_FOCUS))
+
+def need_adhd_vs_anxiety(hits: KeywordHits, rows) -> bool:
+    return has_adhd_signal(hits) or hits.has(KW_GAD_CORE)
+
+def need_atypical_vs_melancholic_depression(hits: KeywordHits, rows) -> bool:
+    return hits.has(KW_ATYPICAL) or hits.has(KW_DEPRESSIVE)
+
+def need_atypical_vs_dysthymia(hits: KeywordHits, rows) -> bool:
+    return hits.has(KW_DEPRESSIVE)
+
+def need_somatic_vs_mood_anxiety(hits: KeywordHits, rows) -> bool:
+    return hits.has(KW_HEALTH_ANX) or hits.has(KW_SOMATIC)
+
+def need_mixed_anxiety_depression(hits: KeywordHits, rows) -> bool:
+    return hits.has(KW_DEPRESSIVE) and hits.has(KW_GAD_CORE)
+
+def need_bdd_vs_sad_depression(hits: KeywordHits, rows) -> bool:
+    return hits.has(KW_BDD) or hits.has(KW_APPEARANCE)
+
+DIFF_NEED_FUNCS = {
+    "mdd_vs_bipolar": need_mdd_vs_bipolar,
+    "gad_vs_ocd": need_gad_vs_ocd,
+    "social_anxiety_vs_avoidant_pd": need_social_anxiety_vs_avoidant_pd,
+    "bed_vs_bulimia": need_bed_vs_bulimia,
+    "bipolar_vs_adhd": need_bipolar_vs_adhd,
+    "insomnia_vs_circadian": need_insomnia_vs_circadian,
+    "ocd_vs_ocpd": need_ocd_vs_ocpd,
+    "dysthymia_vs_mdd": need_dysthymia_vs_mdd,
+    "ptsd_vs_bpd": need_ptsd_vs_bpd,
+    "adhd_vs_depression": need_adhd_vs_depression,
+    "adhd_vs_anxiety": need_adhd_vs_anxiety,
+    "atypical_vs_melancholic_depression": need_atypical_vs_melancholic_depression,
+    "atypical_vs_dysthymia": need_atypical_vs_dysthymia,
+    "somatic_vs_mood_anxiety": need_somatic_vs_mood_anxiety,
+    "mixed_anxiety_depression": need_mixed_anxiety_depression,
+    "bdd_vs_sad_depression": need_bdd_vs_sad_depression,
+    "did_vs_bpd_schizo": need_ptsd_vs_bpd,
+}
+
+def pick_diff_clusters(ctx: QueryContext, rows: List[Tuple[str,float,int]]) -> List[Dict[str,Any]]:
+    res = []
+    for cl in ctx.snap.diff_bank:
+        name = cl.get("cluster","")
+        fn = DIFF_NEED_FUNCS.get(name)
+        if not fn:
+            continue
+        try:
+            if fn(ctx.hits, rows):
+                res.append(cl)
+        except Exception:
+            continue
+    return res
+
+def build_diff_batch_spec(clusters: List[Dict[str,Any]]) -> Dict[str, Any]:
+    groups = []
+    for cl in clusters:
+        qs = []
+        for q in (cl.get("questions") or []):
+            rt = q.get("response_type","yesno")
+            qobj = {"qid": q.get("id"), "text": q.get("text",""), "required": False}
+            if rt == "yesno":
+                qobj["kind"] = "yesno"
+            elif rt == "likert_0_3":
+                qobj["kind"] = "likert"; qobj["min"]=0; qobj["max"]=3
+            elif rt == "multiple_choice":
+                opts = q.get("options") or []
+                labels = " / ".join([o.get("label","") for o in opts if isinstance(o, dict)])
+                qobj["kind"] = "text"
+                qobj["placeholder"] = f"انتخاب: {labels}" if labels else "انتخاب را بنویس..."
+            else:
+                qobj["kind"] = "text"; qobj["placeholder"] = "مثال یا توضیح کوتاه..."
+            qs.append(qobj)
+
+        groups.append({
+            "title": cl.get("title",""),
+            "disorder_id": "diff",
+            "questions": qs
+        })
+    return {"ui":"batch", "groups": groups}
+
+# ============= Heuristics: افزودن آیتم‌ها =============
+def infer_extra_dids_and_items(hits: KeywordHits) -> Tuple[List[str], List[str]]:
+    """
+    خروجی: (extra_dids, direct_item_ids)
+    direct_item_ids: آیتم‌هایی که باید صریحاً اضافه شوند (مثل ANX_PANIC، GENDER_dysphoria_adult)
+    """
+    extras: List[str] = []
+    direct_items: List[str] = []
+
+    # پانیک: آیتم مستقیم
+    if hits.has(KW_PANIC):
+        direct_items.append("ANX_PANIC")
+
+    # Gender Dysphoria در اولویت بالاتر از ترانسوستیک
+    if hits.has(KW_GENDER_DYSPHORIA):
+        # اگر واژگان برانگیختگی جنسی دیده نشود، به‌صورت مستقیم دیفوریا را اضافه کن
+        if not hits.has(KW_SEXUAL_AROUSAL_WORDS):
+            # این آیتم را باید در بانک داشته باشید
+            direct_items.append("GENDER_dysphoria_adult")
+        else:
+            # هر دو را می‌توان آورد (دیفوریا و پارافیلیک)
+            direct_items.append("GENDER_dysphoria_adult")
+            extras.append("paraphilic")
+
+    # الگوهای قبلی
+    if is_mania_like(hits):
+        extras.append("bipolar")
+
+    if hits.has(KW_DEPRESSIVE) and (hits.has(KW_SLEEP) or hits.has(KW_IRRITABILITY)):
+        if "bipolar" not in extras:
+            extras.append("bipolar")
+
+    if hits.has(KW_OCD) or hits.has(KW_OCD_STRONG):
+        extras.append("ocd_related")
+
+    if hits.has(KW_SEXUAL_ED) or hits.has(KW_SEXUAL_GENERAL):
+        extras.append("sexual_function")
+
+    if hits.has(KW_SLEEP) and (not is_mania_like(hits)):
+        extras.append("sleep_wake")
+
+    if hits.has(KW_GAD_CORE):
+        extras.append("anxiety")
+
+    if has_adhd_signal(hits):
+        extras.append("neurodev")
+
+    # یکتا
+    seen = set()
+    extras_u = []
+    for d in extras:
+        if d not in seen:
+            extras_u.append(d); seen.add(d)
+    # direct unique
+    seen = set()
+    direct_u = []
+    for d in direct_items:
+        if d not in seen:
+            direct_u.append(d); seen.add(d)
+
+    return extras_u, direct_u
+
+def _ensure_one_bipolar_gateway_if_dep_like(hits: KeywordHits, spec: Dict[str, Any]) -> None:
+    if not (hits.has(KW_DEPRESSIVE) and ("groups" in spec)):
+        return
+    titles = " ".join([g.get("title","") for g in spec.get("groups",[])]).lower()
+    if ("دو قطبی" in titles) or ("بایپولار" in titles) or ("bipolar" in titles) or ("هیپومانیا" in titles) or ("مانیا" in titles):
+        return
+    it = _find_representative_item_for_did(
+        "bipolar",
+        prefer_ids=["BP_mania_hypomania_screen"],
+        prefer_symptom_subs=["هیپومانیا","مانیا","بالا رفتن","خلق بالا"]
+    )
+    if it:
+        spec["groups"].insert(0, _group_from_item(it))
+
+def _ensure_bipolar_gateway_if_mania_like(hits: KeywordHits, spec: Dict[str, Any]) -> None:
+    if not (is_mania_like(hits) and ("groups" in spec)):
+        return
+    titles = " ".join([g.get("title","") for g in spec.get("groups",[])]).lower()
+    if ("دو قطبی" in titles) or ("بایپولار" in titles) or ("bipolar" in titles) or ("هیپومانیا" in titles) or ("مانیا" in titles):
+        return
+    it = _find_representative_item_for_did(
+        "bipolar",
+        prefer_ids=["BP_mania_hypomania_screen"],
+        prefer_symptom_subs=["هیپومانیا","مانیا","بالا رفتن","خلق بالا"]
+    )
+    if it:
+        spec["groups"].insert(0, _group_from_item(it))
+
+# ============= امتیازدهی پاسخ‌های فرم =============
+def _qmeta_for_items(shown_item_ids: Set[str]) -> Dict[str, QuestionMeta]:
+    """متادیتای سؤال‌های آیتم‌های نمایش‌داده‌شده (به ترتیب بانک)؛ اگر خالی باشد کل بانک."""
+    index = current_snapshot().index
+    if not shown_item_ids:
+        return index.qmeta_all
+    rows = sorted(index.by_id[iid] for iid in shown_item_ids if iid in index.by_id)
+    qmeta: Dict[str, QuestionMeta] = {}
+    for r in rows:
+        for qid, meta in index.qmeta_rows[r]:
+            qmeta[qid] = meta
+    return qmeta
+
+def _answer_score(meta: QuestionMeta, answers: Dict[str, Any], qid: str) -> int:
+    val = answers.get(qid, None)
+    if val is None or (isinstance(val, str) and not val.strip()):
+        val = _default_answer(meta.response_type)
+    return _score_value(meta.response_type, val)
+
+def _results_from_totals(total_by_dis: Dict[str, int], max_by_dis: Dict[str, int]) -> List[Dict[str, Any]]:
+    labels = current_snapshot().labels
+    results = []
+    for did, sc in total_by_dis.items():
+        mx = max_by_dis.get(did, 0) or 1
+        pct = round(100.0 * sc / mx, 1)
+        if sc > 0:
+            results.append({
+                "disorder_id": did,
+                "label": labels.get(did, f"اختلال {did}"),
+                "score": sc,
+                "max": mx,
+                "percent": pct,
+                "severity": severity_label(pct)
+            })
+    results.sort(key=lambda r: (-r["percent"], -r["score"]))
+    return results
+
+def score_batch(answers: Dict[str, Any], shown_item_ids: Set[str]) -> List[Dict[str, Any]]:
+    total_by_dis: Dict[str, int] = {}
+    max_by_dis: Dict[str, int] = {}
+    for qid, meta in _qmeta_for_items(shown_item_ids).items():
+        did = meta.disorder_id
+        total_by_dis[did] = total_by_dis.get(did, 0) + _answer_score(meta, answers, qid)
+        max_by_dis[did]   = max_by_dis.get(did, 0) + meta.max_score
+    return _results_from_totals(total_by_dis, max_by_dis)
+
+SCORE_GROUP_MIN = 4     # گروه‌های کوچک‌تر (مجموعهٔ آیتم تقریباً یکتا) همان score_batch را می‌گیرند
+
+def score_submissions(submissions: Iterable[Tuple[Dict[str, Any], Iterable[str]]]) -> List[List[Dict[str, Any]]]:
+    """
+    امتیازدهی دسته‌ای برای بازامتیازدهی آفلاین: هر ورودی (answers, shown_item_ids) است و
+    خروجی برای هر ارسال همان فهرست نتایج score_batch است؛ کل دسته روی یک snapshot بانک اجرا می‌شود.
+    """
+    subs = [(answers or {}, frozenset(shown or ())) for answers, shown in submissions]
+    with pinned_snapshot():
+        return _score_submissions_grouped(subs)
+
+def _score_submissions_grouped(subs: List[Tuple[Dict[str, Any], FrozenSet[str]]]) -> List[List[Dict[str, Any]]]:
+    # ارسال‌ها بر اساس مجموعهٔ آیتم‌های نمایش‌داده‌شده گروه می‌شوند و ستون‌های سؤال (qid → اختلال،
+    # نوع پاسخ، سقف امتیاز) برای هر گروه یک بار ساخته می‌شود. پاسخ خالی در همهٔ انواع 0 است، پس فقط
+    # پاسخ‌های داده‌شده امتیاز می‌گیرند و جمع هر اختلال با یک np.add.at روی کل گروه حساب می‌شود؛
+    # score_batch برای هر ارسال روی همهٔ سؤال‌های آیتم‌هایش (در حالت خالی کل بانک) حلقه می‌زد.
+    groups: Dict[FrozenSet[str], List[int]] = {}
+    for i, (_, shown) in enumerate(subs):
+        groups.setdefault(shown, []).append(i)
+
+    out: List[List[Dict[str, Any]]] = [[] for _ in subs]
+    for shown, members in groups.items():
+        if len(members) < SCORE_GROUP_MIN:
+            for i in members:
+                out[i] = score_batch(subs[i][0], set(shown))
+            continue
+        qmeta = _qmeta_for_items(set(shown))
+        if not qmeta:
+            continue
+        # ترتیب اختلال‌ها مثل score_batch: اولین حضور در ترتیب سؤال‌ها
+        dids = list(dict.fromkeys(m.disorder_id for m in qmeta.values()))
+        did_pos = {d: k for k, d in enumerate(dids)}
+        col = {qid: (did_pos[m.disorder_id], m.response_type) for qid, m in qmeta.items()}
+        maxes = [0] * len(dids)
+        for m in qmeta.values():
+            maxes[did_pos[m.disorder_id]] += m.max_score
+        max_by_dis = dict(zip(dids, maxes))
+
+        rows: List[int] = []
+        cols: List[int] = []
+        vals: List[int] = []
+        for r, i in enumerate(members):
+            for qid, val in subs[i][0].items():
+                c = col.get(qid)
+                if c is None or val is None or (isinstance(val, str) and not val.strip()):
+                    continue
+                sc = _score_value(c[1], val)
+                if sc:
+                    rows.append(r); cols.append(c[0]); vals.append(sc)
+        totals = np.zeros((len(members), len(dids)), dtype=np.int64)
+        np.add.at(totals, (np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)),
+                  np.asarray(vals, dtype=np.int64))
+        for r, i in enumerate(members):
+            out[i] = _results_from_totals(dict(zip(dids, totals[r].tolist())), max_by_dis)
+    return out
+
+# ============= گرم کردن (warmup) =============
+_WARMUP: Dict[str, Any] = {"state": "cold", "timings": {}, "error": None, "started": None, "finished": None}
+_WARMUP_LOCK = threading.Lock()
+
+def warmup() -> Dict[str, Any]:
+    """
+    همهٔ کارهای سنگین اولین درخواست را جلوتر انجام می‌دهد: بانک، مدل، امبدینگ بانک،
+    کلیدواژه‌ها و یک استنتاج آزمایشی. مدت هر مرحله در timings ثبت می‌شود.
+    """
+    with _WARMUP_LOCK:
+        if _WARMUP["state"] == "ready":
+            return warmup_status()
+        _WARMUP.update(state="warming", error=None, started=time.time(), finished=None)
+        timings: Dict[str, float] = {}
+        _WARMUP["timings"] = timings
+
+        def step(name, fn):
+            t0 = time.perf_counter()
+            out = fn()
+            timings[name] = round(time.perf_counter() - t0, 4)
+            return out
+
+        try:
+            snap = step("bank", get_snapshot)
+            step("encoder", get_model)
+            step("bank_embeddings", snap.emb)
+            step("rank_index", snap.rank_tensors)
+            hits = step("keywords", lambda: keyword_hits("warmup استرس"))
+            step("inference", lambda: rank_disorders(build_query_context("سلام، استرس دارم", hits)))
+        except Exception as e:
+            log.exception("chat: warmup failed")
+            _WARMUP.update(state="failed", error=f"{type(e).__name__}: {e}", finished=time.time())
+        else:
+            _WARMUP.update(state="ready", finished=time.time())
+            log.info("chat: warm in %.2fs %s", sum(timings.values()), timings)
+    return warmup_status()
+
+def start_warmup() -> None:
+    """warmup در یک thread پس‌زمینه (اگر قبلاً شروع نشده باشد)."""
+    if _WARMUP["state"] in ("cold", "failed") and not _WARMUP_LOCK.locked():
+        threading.Thread(target=warmup, name="chat-warmup", daemon=True).start()
+
+def warmup_status() -> Dict[str, Any]:
+    out = dict(_WARMUP, timings=dict(_WARMUP["timings"]))
+    out["ready"] = out["state"] == "ready"
+    snap = _SNAPSHOT
+    out["bank_version"] = snap.version if snap is not None else None
+    return out
+
+# ============= preload پیش از fork =============
+_TORCH_DEFAULT_THREADS = [0]     # تعداد پیش‌فرض torch، پیش از اینکه preload_for_fork آن را 1 کند
+
+def configure_torch_threads(n: Optional[int] = None) -> None:
+    """
+    TORCH_THREADS=0 یعنی پیش‌فرض torch؛ اگر master آن را برای fork به 1 رسانده، برگردانده می‌شود.
+    وقتی چیزی برای تنظیم نیست torch import نمی‌شود (workerی که چت سرو نمی‌کند سبک می‌ماند).
+    """
+    n = TORCH_THREADS if n is None else n
+    if n <= 0:
+        n = _TORCH_DEFAULT_THREADS[0]
+    if n <= 0:
+        return
+    import torch
+    torch.set_num_threads(n)
+
+def preload_for_fork() -> Dict[str, float]:
+    """
+    در پروسهٔ master و پیش از fork اجرا می‌شود: مدل و ماتریس امبدینگ بانک یک بار ساخته می‌شوند
+    و workerها آن‌ها را copy-on-write به اشتراک می‌گذارند.
+    هیچ thread یا استنتاج query در master شروع نمی‌شود (threadها از fork جان سالم به در نمی‌برند).
+    """
+    import gc, torch
+    # استخر OpenMP در master ساخته نشود؛ هر worker بعد از fork تعداد خودش را تنظیم می‌کند
+    _TORCH_DEFAULT_THREADS[0] = torch.get_num_threads()
+    torch.set_num_threads(1)
+    timings: Dict[str, float] = {}
+    t0 = time.perf_counter()
+    snap = get_snapshot()
+    timings["bank"] = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    get_model().eval()
+    timings["encoder"] = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    snap.emb()
+    snap.rank_tensors()
+    timings["bank_embeddings"] = time.perf_counter() - t0
+    # اشیای موجود از دید GC منجمد می‌شوند تا پیمایش GC در workerها صفحات مشترک را کپی نکند
+    gc.collect()
+    gc.freeze()
+    log.info("chat: preloaded for fork %s", {k: round(v, 3) for k, v in timings.items()})
+    return timings
+
+def after_fork() -> None:
+    """در هر worker بلافاصله بعد از fork."""
+    configure_torch_threads()
+    start_warmup()          # مدل و امبدینگ از master آمده‌اند؛ فقط استنتاج آزمایشی می‌ماند
+
+def warmup_on_startup() -> None:
+    """از AppConfig.ready در پروسهٔ سرور؛ با PREFORK_PRELOAD کار به after_fork در هر worker می‌رسد."""
+    if WARMUP_ON_STARTUP and not PREFORK_PRELOAD:
+        start_warmup()
+
+# ============= View: صفحه =============
+@ensure_csrf_cookie
+def chat_page(request: HttpRequest):
+    return render(request, CHAT_TEMPLATE, {})
+
+# ============= View: آمادگی =============
+def chat_ready(request: HttpRequest):
+    """
+    probe آمادگی برای load balancer: تا گرم شدن worker کد 503 برمی‌گرداند.
+    اولین فراخوانی، اگر warmup هنوز شروع نشده، آن را در پس‌زمینه راه می‌اندازد.
+    """
+    status = warmup_status()
+    if not status["ready"]:
+        start_warmup()
+        status = warmup_status()
+    return JsonResponse({"ok": status["ready"], **status}, status=200 if status["ready"] else 503)
+
+# ============= View: آمار امبدینگ =============
+def chat_stats(request: HttpRequest):
+    if not (settings.DEBUG or getattr(request.user, "is_staff", False)):
+        return JsonResponse({"ok": False, "error": "forbidden"}, status=403)
+    snap = current_snapshot()
+    return JsonResponse({
+        "ok": True,
+        "bank_version": snap.version,
+        "embed_batching": EMBED_BATCHING,
+        "query_batcher": get_query_batcher().stats() if EMBED_BATCHING else None,
+        "query_cache": query_cache_stats(),
+        "text_pool": text_pool.stats(),
+    })
+
+# ============= View: بارگذاری مجدد بانک (ادمین) =============
+def chat_reload(request: HttpRequest):
+    """
+    بارگذاری مجدد دستی بانک در همین پروسه (workerهای دیگر با تغییر mtime فایل‌ها به‌روز می‌شوند).
+    """
+    if request.method != "POST":
+        return JsonResponse({"ok": False, "error": "POST only"}, status=405)
+    if not getattr(request.user, "is_staff", False):
+        return JsonResponse({"ok": False, "error": "forbidden"}, status=403)
+    snap = reload_bank(force=True)
+    return JsonResponse({"ok": True, "version": snap.version, "items": len(snap.bank)})
+
+# ============= View: API =============
+@timed_view("chat_api")
+@ensure_csrf_cookie
+def chat_api(request: HttpRequest):
+    return _chat_api_pinned(request)
+
+@timed_view("chat_api")
+@ensure_csrf_cookie
+async def chat_api_async(request: HttpRequest):
+    """
+    نسخهٔ ASGI: کل pipeline (encode، رتبه‌بندی، سشن) در text_pool اجرا می‌شود و event loop آزاد می‌ماند؛
+    اگر صف استخر پر باشد فوراً 503 با Retry-After برمی‌گردد.
+    """
+    try:
+        return await text_pool.run(_chat_api_pinned, request)
+    except PoolFull:
+        return busy_response()
+
+def free_message_reply(msg: str, st: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    pipeline پیام آزاد (کلیدواژه، امبدینگ، رتبه‌بندی، ساخت فرم): payload پاسخ را برمی‌گرداند و st را به‌روز می‌کند.
+    باید داخل pinned_snapshot اجرا شود؛ chat_api و مسیر صوت‌به‌چت هر دو از همین استفاده می‌کنند.
+    """
+    if not msg:
+        return {"ui":"text", "reply":"یه چیزی بنویس لطفاً 😊"}
+
+    with stage("keywords"):
+        hits = keyword_hits(msg)     # یک پیمایش برای همهٔ واژگان‌ها
+    if check_emergency(msg, hits):
+        return {"ui":"text", "reply":"به نظر می‌رسه به کمک فوری نیاز داری. لطفاً همین الآن با اورژانس ۱۱۵ تماس بگیر یا با یکی از متخصصین ما صحبت کن. ❤️"}
+
+    # 1) امبدینگ (یک بار برای کل درخواست)
+    with stage("encode"):
+        ctx = build_query_context(msg, hits)
+    with stage("rank"):
+        rows = rank_disorders(ctx, top_k=5, min_sim=0.45)
+
+    # 2) هیؤریستیک‌ها: DID/آیتم‌های مستقیم مثل پانیک و دیفوریا
+    with stage("heuristics"):
+        extra_dids, direct_item_ids = infer_extra_dids_and_items(hits)
+
+    # اگر هیچ شباهت کافی نبود، از آیتم‌های مستقیم/دسته‌ها استفاده کن
+    if not rows and (extra_dids or direct_item_ids):
+        selected_items: List[Dict[str, Any]] = []
+
+        # آیتم‌های مستقیم (مثلاً ANX_PANIC، GENDER_dysphoria_adult)
+        for iid in direct_item_ids:
+            it = _find_item_by_id(iid)
+            if it: selected_items.append(it)
+
+        # دسته‌های پیشنهادی
+        for did in extra_dids:
+            if did == "ocd_related":
+                rep = _find_representative_item_for_did("ocd_related", prefer_ids=["OCD_core"], prefer_symptom_subs=["وسواس"])
+            elif did == "bipolar":
+                rep = _find_representative_item_for_did("bipolar", prefer_ids=["BP_mania_hypomania_screen"], prefer_symptom_subs=["هیپومانیا","مانیا","خلق بالا"])
+            elif did == "sexual_function":
+                rep = _find_representative_item_for_did("sexual_function", prefer_ids=["SEX_ED","SEX_function"])
+            elif did == "gender_identity":
+                rep = _find_representative_item_for_did("gender_identity", prefer_ids=["GENDER_dysphoria_adult"], prefer_symptom_subs=["دیفوریا","ناهماهنگی جنسیتی"])
+            else:
+                rep = _find_representative_item_for_did(did)
+            if rep: selected_items.append(rep)
+
+        if selected_items:
+            with stage("batch_spec"):
+                items, spec = build_batch_spec_multi(ctx, selected_items, per_family=BATCH_ITEMS_PER_FAMILY, max_groups=BATCH_MAX_GROUPS)
+            with stage("filter"):
+                spec["groups"] = filter_groups_by_context(ctx, spec["groups"])
+
+            with stage("diff"):
+                diff_clusters = pick_diff_clusters(ctx, [])
+            if diff_clusters:
+                diff_spec = build_diff_batch_spec(diff_clusters)
+                spec["groups"] = diff_spec["groups"] + spec["groups"]
+                st["diff_active"] = [cl.get("cluster") for cl in diff_clusters]
+
+            _ensure_bipolar_gateway_if_mania_like(hits, spec)
+            _ensure_one_bipolar_gateway_if_dep_like(hits, spec)
+
+            st["mode"] = "batch"
+            st["user_text"] = msg
+            st["batch_items_ids"] = [it.get("id") for it in items if it.get("id")]
+            return spec
+
+        return {"ui":"text", "reply":"هنوز مطمئن نیستم. لطفاً کمی بیشتر دربارهٔ علائمت توضیح بده."}
+
+    # اگر rows داریم:
+    selected_items = pick_representative_items(rows)
+
+    # آیتم‌های مستقیم را جلوتر تزریق کن
+    for iid in direct_item_ids:
+        it = _find_item_by_id(iid)
+        if it and it not in selected_items:
+            selected_items.insert(0, it)
+
+    # دسته‌های اضافی
+    existing_dids = {str(it.get("disorder_id")) for it in selected_items}
+    for did in extra_dids:
+        if did in existing_dids: 
+            continue
+        if did == "ocd_related":
+            rep = _find_representative_item_for_did("ocd_related", prefer_ids=["OCD_core"], prefer_symptom_subs=["وسواس"])
+        elif did == "bipolar":
+            rep = _find_representative_item_for_did("bipolar", prefer_ids=["BP_mania_hypomania_screen"], prefer_symptom_subs=["هیپومانیا","مانیا","خلق بالا"])
+        elif did == "sexual_function":
+            rep = _find_representative_item_for_did("sexual_function", prefer_ids=["SEX_ED","SEX_function"])
+        elif did == "gender_identity":
+            rep = _find_representative_item_for_did("gender_identity", prefer_ids=["GENDER_dysphoria_adult"], prefer_symptom_subs=["دیفوریا","ناهماهنگی جنسیتی"])
+        else:
+            rep = _find_representative_item_for_did(did)
+        if rep:
+            selected_items.append(rep)
+            existing_dids.add(did)
+
+    with stage("batch_spec"):
+        items, spec = build_batch_spec_multi(ctx, selected_items, per_family=BATCH_ITEMS_PER_FAMILY, max_groups=BATCH_MAX_GROUPS)
+    with stage("filter"):
+        spec["groups"] = filter_groups_by_context(ctx, spec["groups"])
+
+    if not spec["groups"]:
+        return {"ui":"text", "reply":"علائمی که گفتی واضح نبود. کمی دقیق‌تر بگو چه چیزهایی اذیتت می‌کنه."}
+
+    with stage("diff"):
+        diff_clusters = pick_diff_clusters(ctx, rows)
+    if diff_clusters:
+        diff_spec = build_diff_batch_spec(diff_clusters)
+        spec["groups"] = diff_spec["groups"] + spec["groups"]
+        st["diff_active"] = [cl.get("cluster") for cl in diff_clusters]
+
+    _ensure_bipolar_gateway_if_mania_like(hits, spec)
+    _ensure_one_bipolar_gateway_if_dep_like(hits, spec)
+
+    st["mode"] = "batch"
+    st["user_text"] = msg
+    st["batch_items_ids"] = [it.get("id") for it in items if it.get("id")]
+
+    return spec
+
+def chat_message_for_session(request: HttpRequest, msg: str) -> Dict[str, Any]:
+    """پیام آزاد با وضعیت سشن همین درخواست؛ برای endpointهایی که متن را خودشان می‌سازند (مثل صوت‌به‌چت)."""
+    st = _st_from_session(request.session.get("chat_state", {}))
+    with pinned_snapshot():
+        payload = free_message_reply(msg, st)
+    with stage("session"):
+        request.session["chat_state"] = _st_to_session(st)
+        request.session.modified = True
+    return payload
+
+def _chat_api_pinned(request: HttpRequest):
+    # کل درخواست روی یک نسخهٔ بانک اجرا می‌شود، حتی اگر وسط کار بارگذاری مجدد رخ دهد
+    with pinned_snapshot():
+        return _chat_api(request)
+
+def _chat_api(request: HttpRequest):
+    if request.method != "POST":
+        return JsonResponse({"ok": False, "error": "POST only"}, status=405)
+
+    try:
+        data = json.loads(request.body.decode("utf-8"))
+    except Exception:
+        data = {}
+
+    action = (data.get("action") or "").strip()
+    st = _st_from_session(request.session.get("chat_state", {}))
+
+    def save_ok(payload: Dict[str, Any], *, reset: bool=False):
+        with stage("session"):
+            if reset:
+                st.clear()
+            request.session["chat_state"] = _st_to_session(st)
+            request.session.modified = True
+            return JsonResponse(payload, safe=True)
+
+    # ----------- پیام آزاد -----------
+    if action == "" and "message" in data:
+        return save_ok(free_message_reply((data.get("message") or "").strip(), st))
+
+    # ----------- دریافت پاسخ فرم -----------
+    if action == "batch_submit":
+        answers: Dict[str, Any] = data.get("answers") or {}
+
+        shown_item_ids: Set[str] = set(st.get("batch_items_ids") or [])
+        with stage("score"):
+            results = score_batch(answers, shown_item_ids)
+
+        if not results:
+            return save_ok({"ui":"text","reply":"بر اساس پاسخ‌ها نشانهٔ فعالی تأیید نشد. می‌تونی فقط به سؤال‌هایی که دوست داری جواب بدی؛ بقیه به‌صورت «خیر» درنظر گرفته می‌شن."})
+
+        lines = ["نتیجهٔ غربالگری (غیردقیق/غیرتشخیصی):"]
+        for r in results[:6]:
+            lines.append(f"• {r['label']} — امتیاز {r['score']}/{r['max']} (٪{r['percent']})")
+
+        return save_ok({"ui":"text", "reply":"\n".join(lines)}, reset=True)
+
+    return JsonResponse({"ok": False, "error": "bad request"}, status=400)
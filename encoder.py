@@ -0,0 +1,120 @@
+# web/views/encoder.py
+# میکروبچ کردن امبدینگ پرسش‌ها: درخواست‌های هم‌زمان در یک پنجره‌ی کوتاه جمع می‌شوند
+# و با یک forward pass مشترک محاسبه می‌شوند؛ نتیجه‌ی هر پرسش به درخواست خودش برمی‌گردد.
+import time, queue, threading, logging
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class EmbeddingBatcher:
+    """
+    encode_fn(texts) -> ndarray با شکل (len(texts), dim).
+    یک thread پس‌زمینه اولین پرسش صف را برمی‌دارد و هرچه در صف هست را هم برمی‌دارد؛ فقط اگر پرسش دیگری
+    منتظر بوده (یعنی واقعاً هم‌زمانی هست) تا max_wait ثانیه (یا تا max_batch پرسش) منتظر بقیه می‌ماند.
+    پرسش تنها بی‌درنگ encode می‌شود. متن‌های تکراری یکی و همه یک‌جا encode می‌شوند.
+    """
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray],
+                 max_batch: int = 32, max_wait: float = 0.005, name: str = "embed-batcher"):
+        self.encode_fn = encode_fn
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait))
+        self.name = name
+        self._q: "queue.Queue[Tuple[str, Future, float]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._started = time.monotonic()
+        self._m: Dict[str, float] = {
+            "requests": 0, "batches": 0, "texts_encoded": 0, "errors": 0,
+            "batch_size_max": 0,
+            "queue_wait_seconds_total": 0.0, "queue_wait_seconds_max": 0.0,
+            "encode_seconds_total": 0.0, "encode_seconds_max": 0.0,
+        }
+
+    def _ensure_worker(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def submit(self, text: str) -> Future:
+        fut: Future = Future()
+        self._ensure_worker()
+        self._q.put((text, fut, time.perf_counter()))
+        return fut
+
+    def encode(self, text: str, timeout: Optional[float] = None) -> np.ndarray:
+        """امبدینگ یک متن (بردار یک‌بعدی)؛ تا آماده شدن batch بلاک می‌شود."""
+        return self.submit(text).result(timeout)
+
+    def _collect(self) -> List[Tuple[str, Future, float]]:
+        batch = [self._q.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._q.get_nowait())
+            except queue.Empty:
+                break
+        if len(batch) == 1:
+            return batch            # کسی منتظر نیست؛ پنجرهٔ انتظار فقط تأخیر اضافه می‌کند
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            left = deadline - time.monotonic()
+            try:
+                batch.append(self._q.get(timeout=left) if left > 0 else self._q.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            t0 = time.perf_counter()
+            texts: List[str] = []
+            pos: Dict[str, int] = {}
+            for text, _, _ in batch:
+                if text not in pos:
+                    pos[text] = len(texts)
+                    texts.append(text)
+            try:
+                emb = np.asarray(self.encode_fn(texts))
+            except BaseException as e:
+                log.exception("%s: encode failed for %d texts", self.name, len(texts))
+                with self._lock:
+                    self._m["errors"] += 1
+                for _, fut, _ in batch:
+                    fut.set_exception(e)
+                continue
+            dt = time.perf_counter() - t0
+            for text, fut, _ in batch:
+                fut.set_result(emb[pos[text]])
+            waits = [t0 - t for _, _, t in batch]
+            with self._lock:
+                m = self._m
+                m["requests"] += len(batch)
+                m["batches"] += 1
+                m["texts_encoded"] += len(texts)
+                m["batch_size_max"] = max(m["batch_size_max"], len(batch))
+                m["queue_wait_seconds_total"] += sum(waits)
+                m["queue_wait_seconds_max"] = max(m["queue_wait_seconds_max"], max(waits))
+                m["encode_seconds_total"] += dt
+                m["encode_seconds_max"] = max(m["encode_seconds_max"], dt)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out: Dict[str, Any] = dict(self._m)
+        out.update({"max_batch": self.max_batch, "max_wait_ms": self.max_wait * 1000.0,
+                    "queued": self._q.qsize()})
+        b = out["batches"] or 1
+        n = out["requests"] or 1
+        out["batch_size_avg"] = out["requests"] / b
+        out["encode_seconds_avg"] = out["encode_seconds_total"] / b
+        out["queue_wait_seconds_avg"] = out["queue_wait_seconds_total"] / n
+        busy = out["encode_seconds_total"]
+        out["texts_per_encode_second"] = out["texts_encoded"] / busy if busy else 0.0
+        out["requests_per_second"] = out["requests"] / max(1e-9, time.monotonic() - self._started)
+        return out
@@ -0,0 +1,59 @@
+# web/views/kwmatch.py
+# تطبیق چندالگویی Aho–Corasick: همهٔ دسته‌های کلیدواژه با یک بار پیمایش متن
+from collections import deque
+from typing import Dict, FrozenSet, Iterable, List, Set
+
+
+class KeywordMatcher:
+    """
+    اتوماتون از روی {نام دسته: واژه‌ها} یک بار ساخته می‌شود؛
+    scan(text) مجموعهٔ نام دسته‌هایی را برمی‌گرداند که دست‌کم یکی از واژه‌هایشان زیررشتهٔ متن است.
+    متن و واژه‌ها همان‌طور که داده شده‌اند مقایسه می‌شوند (نرمال‌سازی با فراخواننده است).
+    """
+    def __init__(self, categories: Dict[str, Iterable[str]]):
+        goto: List[Dict[str, int]] = [{}]
+        out: List[Set[str]] = [set()]
+        for cat, words in categories.items():
+            for w in words:
+                if not w:
+                    continue
+                node = 0
+                for ch in w:
+                    nxt = goto[node].get(ch)
+                    if nxt is None:
+                        nxt = len(goto)
+                        goto.append({}); out.append(set())
+                        goto[node][ch] = nxt
+                    node = nxt
+                out[node].add(cat)
+
+        # لینک‌های شکست با BFS؛ خروجی هر گره با خروجی گره‌ی شکستش ادغام می‌شود
+        fail = [0] * len(goto)
+        q = deque(goto[0].values())
+        while q:
+            r = q.popleft()
+            for ch, s in goto[r].items():
+                q.append(s)
+                f = fail[r]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                nxt = goto[f].get(ch, 0)
+                fail[s] = nxt if nxt != s else 0
+                out[s] |= out[fail[s]]
+
+        self._goto = goto
+        self._fail = fail
+        self._out: List[FrozenSet[str]] = [frozenset(o) for o in out]
+        self.categories = frozenset(categories)
+
+    def scan(self, text: str) -> FrozenSet[str]:
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        hits: Set[str] = set()
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                hits |= out[node]
+        return frozenset(hits)
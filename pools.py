@@ -0,0 +1,84 @@
+# web/views/pools.py
+# استخرهای thread محدود برای کارهای سنگین CPU در viewهای async (جدا برای STT و متن)
+import asyncio, threading, contextvars, logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import JsonResponse
+
+log = logging.getLogger(__name__)
+
+TEXT_POOL_WORKERS = int(getattr(settings, "TEXT_POOL_WORKERS", 4))
+TEXT_POOL_QUEUE = int(getattr(settings, "TEXT_POOL_QUEUE", 32))        # کار منتظر، علاوه بر workerها
+STT_POOL_WORKERS = int(getattr(settings, "STT_POOL_WORKERS", getattr(settings, "STT_POOL_SIZE", 1)))
+STT_POOL_QUEUE = int(getattr(settings, "STT_POOL_QUEUE", 4))
+POOL_RETRY_AFTER = int(getattr(settings, "POOL_RETRY_AFTER", 2))         # ثانیه، برای هدر Retry-After
+
+
+class PoolFull(Exception):
+    """صف استخر پر است؛ درخواست بلافاصله رد می‌شود."""
+
+
+class BoundedPool:
+    """
+    ThreadPoolExecutor با سقف «در حال اجرا + منتظر»؛ submit در صورت پر بودن فوراً PoolFull می‌دهد
+    به‌جای اینکه صف بی‌انتها رشد کند. ContextVarها (اسنپ‌شات پین‌شده، زمان‌سنجی) به thread منتقل می‌شوند.
+    """
+    def __init__(self, name: str, workers: int, queue: int):
+        self.name = name
+        self.workers = max(1, workers)
+        self.capacity = self.workers + max(0, queue)
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._m: Dict[str, int] = {"submitted": 0, "rejected": 0, "pending": 0}
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> Future:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._m["rejected"] += 1
+            raise PoolFull(self.name)
+        ctx = contextvars.copy_context()
+
+        def job():
+            try:
+                return ctx.run(fn, *args)
+            finally:
+                close_old_connections()     # اتصال DB این thread خارج از چرخهٔ درخواست Django است
+
+        with self._lock:
+            self._m["submitted"] += 1
+            self._m["pending"] += 1
+        try:
+            fut = self._executor.submit(job)
+        except BaseException:
+            self._release(None)
+            raise
+        fut.add_done_callback(self._release)
+        return fut
+
+    def _release(self, _fut) -> None:
+        with self._lock:
+            self._m["pending"] -= 1
+        self._slots.release()
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out: Dict[str, Any] = dict(self._m)
+        out.update({"workers": self.workers, "capacity": self.capacity})
+        return out
+
+
+text_pool = BoundedPool("text-pool", TEXT_POOL_WORKERS, TEXT_POOL_QUEUE)
+stt_pool = BoundedPool("stt-pool", STT_POOL_WORKERS, STT_POOL_QUEUE)
+
+
+def busy_response(what: str = "server busy") -> JsonResponse:
+    resp = JsonResponse({"ok": False, "error": what}, status=503)
+    resp["Retry-After"] = str(POOL_RETRY_AFTER)
+    return resp
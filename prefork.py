@@ -0,0 +1,35 @@
+# web/views/prefork.py
+# هوک‌های gunicorn برای لود مدل در master پیش از fork (اشتراک copy-on-write بین workerها)
+#
+#   # gunicorn.conf.py
+#   preload_app = True
+#   from web.views.prefork import on_starting, post_fork
+#
+#   # settings.py
+#   CHATBOT = {..., "PREFORK_PRELOAD": True, "TORCH_THREADS": 2}
+#
+# warmup هر worker از post_fork شروع می‌شود؛ با preload_app متغیر CHATBOT_SERVER را نگذارید
+# (web/apps.py)، وگرنه warmup در master و پیش از fork اجرا می‌شود.
+#
+# بهتر است bank_emb.npy از قبل با `manage.py build_bank_index` ساخته شده باشد
+# تا master فقط فایل را بخواند و مدل را برای encode بانک اجرا نکند.
+
+
+def on_starting(server):
+    import django
+    django.setup()
+    from .chat import PREFORK_PRELOAD, preload_for_fork
+    if PREFORK_PRELOAD:
+        timings = preload_for_fork()
+        server.log.info("chat engine preloaded in master: %s", {k: round(v, 3) for k, v in timings.items()})
+
+
+def post_fork(server, worker):
+    from .chat import PREFORK_PRELOAD, after_fork, configure_torch_threads
+    if PREFORK_PRELOAD:
+        after_fork()
+    else:
+        from .chat import WARMUP_ON_STARTUP, start_warmup
+        configure_torch_threads()
+        if WARMUP_ON_STARTUP:
+            start_warmup()
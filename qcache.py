@@ -0,0 +1,64 @@
+# web/views/qcache.py
+# کش LRU با انقضای زمانی (TTL) و شمارنده‌های hit/miss، امن برای چند thread
+import time, threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    حداکثر maxsize مدخل؛ با پر شدن، قدیمی‌ترین استفاده (LRU) بیرون می‌رود.
+    ttl بر حسب ثانیه از لحظهٔ set است (0 = بدون انقضا). maxsize=0 کش را غیرفعال می‌کند.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 0.0):
+        self.maxsize = max(0, int(maxsize))
+        self.ttl = max(0.0, float(ttl))
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._m: Dict[str, int] = {"hits": 0, "misses": 0, "sets": 0, "evictions": 0, "expired": 0}
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            ent = self._data.get(key, _MISSING)
+            if ent is not _MISSING:
+                exp, value = ent
+                if exp and exp <= now:
+                    del self._data[key]
+                    self._m["expired"] += 1
+                else:
+                    self._data.move_to_end(key)
+                    self._m["hits"] += 1
+                    return value
+            self._m["misses"] += 1
+            return default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if not self.maxsize:
+            return
+        exp = time.monotonic() + self.ttl if self.ttl else 0.0
+        with self._lock:
+            self._data[key] = (exp, value)
+            self._data.move_to_end(key)
+            self._m["sets"] += 1
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._m["evictions"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out: Dict[str, Any] = dict(self._m)
+            out["size"] = len(self._data)
+        out.update({"maxsize": self.maxsize, "ttl": self.ttl})
+        looked = out["hits"] + out["misses"]
+        out["hit_rate"] = out["hits"] / looked if looked else 0.0
+        return out
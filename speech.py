@@ -1,63 +1,276 @@
-# web/views/speech.py
-import os, subprocess, tempfile, json
-from django.http import JsonResponse
-from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
-from django.views.decorators.http import require_POST
-from django.conf import settings
-
-USE_WHISPER = True  # یا False برای Vosk
-
-@require_POST
-@ensure_csrf_cookie
-def speech_to_text(request):
-    if "audio" not in request.FILES:
-        return JsonResponse({"ok": False, "error": "no file"}, status=400)
-
-    up = request.FILES["audio"]   # webm/opus
-    with tempfile.TemporaryDirectory() as td:
-        in_path  = os.path.join(td, "in.webm")
-        out_path = os.path.join(td, "out.wav")
-        with open(in_path, "wb") as f:
-            for chunk in up.chunks():
-                f.write(chunk)
-
-        # تبدیل به WAV تک‌کاناله 16kHz
-        # ffmpeg -i in.webm -ac 1 -ar 16000 out.wav
-        try:
-            subprocess.check_call([
-                "ffmpeg", "-y", "-i", in_path, "-ac", "1", "-ar", "16000", out_path
-            ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        except Exception as e:
-            return JsonResponse({"ok": False, "error": f"ffmpeg failed: {e}"}, status=500)
-
-        text = ""
-        try:
-            if USE_WHISPER:
-                import whisper
-                model_name = getattr(settings, "WHISPER_MODEL", "base")
-                model = whisper.load_model(model_name)
-                # می‌توانی language="fa" هم بدهی اگر زبان مشخص است
-                res = model.transcribe(out_path, language="fa")
-                text = (res.get("text") or "").strip()
-            else:
-                from vosk import Model, KaldiRecognizer, SetLogLevel
-                SetLogLevel(-1)
-                # مسیر مدل فارسی را دانلود و تنظیم کن (مثلا vosk-model-small-fa-0.4)
-                model_dir = getattr(settings, "VOSK_MODEL_DIR", "/opt/vosk-model-small-fa")
-                if not os.path.isdir(model_dir):
-                    return JsonResponse({"ok": False, "error": "Vosk model not found"}, status=500)
-
-                import wave, json as pyjson
-                wf = wave.open(out_path, "rb")
-                rec = KaldiRecognizer(Model(model_dir), wf.getframerate())
-                rec.SetWords(True)
-                while True:
-                    data = wf.readframes(4000)
-                    if len(data) == 0: break
-                    rec.AcceptWaveform(data)
-                final = pyjson.loads(rec.FinalResult())
-                text = (final.get("text") or "").strip()
-        except Exception as e:
-            return JsonResponse({"ok": False, "error": f"stt failed: {e}"}, status=500)
-
-    return JsonResponse({"ok": True, "text": text or ""})
+# web/views/speech.py
+import json, time, hashlib, logging
+from asgiref.sync import sync_to_async
+from django.db import DatabaseError
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
+from django.views.decorators.http import require_GET, require_POST
+from django.conf import settings
+from django.urls import reverse
+from typing import Any, Dict, Tuple
+
+from .audio import decode_to_pcm, decode_to_pcm_async, AudioDecodeError
+from .stt import (
+    transcribe_audio, transcript_key, cached_transcript, store_transcript,
+    acached_transcript, astore_transcript,
+)
+from .stt import STT_BACKEND, stt_stats, supports_streaming, open_stream, get_stream, close_stream, STTBusy, STTUnavailable
+from .timing import stage, timed_view
+from .pools import PoolFull, stt_pool, text_pool, busy_response
+from .chat import chat_message_for_session
+from .sttjobs import JOBS_ENABLED, submit_job, get_job, public_job, job_stats
+
+log = logging.getLogger(__name__)
+
+
+def _backend() -> str:
+    # settings.STT_BACKEND؛ برای /api/speech/stream/ باید "vosk" باشد
+    return STT_BACKEND
+
+
+def _stt_error(e: Exception) -> JsonResponse:
+    if isinstance(e, AudioDecodeError):
+        return JsonResponse({"ok": False, "error": f"ffmpeg failed: {e}"}, status=500)
+    if isinstance(e, STTUnavailable):
+        return JsonResponse({"ok": False, "error": str(e)}, status=500)
+    if isinstance(e, (STTBusy, PoolFull)):
+        return busy_response("stt busy")
+    return JsonResponse({"ok": False, "error": f"stt failed: {e}"}, status=500)
+
+
+def _transcribe_upload(up) -> Tuple[str, bool]:
+    """متن فایل آپلودی و اینکه از کش آمده یا نه؛ خطاهای ffmpeg/STT بالا می‌روند."""
+    backend = _backend()
+    with stage("stt_cache"):
+        key = transcript_key(up.chunks(), backend)
+        text = cached_transcript(key)
+    if text is not None:
+        return text, True
+
+    t0 = time.perf_counter()
+    # تبدیل مستقیم به PCM تک‌کاناله 16kHz در حافظه (ffmpeg از طریق pipe)
+    with stage("ffmpeg"):
+        pcm = decode_to_pcm(up.chunks())
+    text = transcribe_audio(backend, pcm) or ""
+    store_transcript(key, text, time.perf_counter() - t0)
+    return text, False
+
+
+def _read_upload(up, backend: str) -> Tuple[bytes, str]:
+    # فایل بزرگ را Django روی دیسک نگه می‌دارد؛ خواندن و هش با هم در یک thread
+    data = b"".join(up.chunks())
+    return data, transcript_key([data], backend)
+
+
+async def _transcribe_upload_async(up) -> Tuple[str, bool]:
+    """
+    همان _transcribe_upload برای viewهای async: ffmpeg با asyncio و transcribe در stt_pool.
+    خواندن آپلود، هش و کش Django (Redis/memcached/DB) sync هستند و در thread اجرا می‌شوند، نه روی event loop.
+    """
+    backend = _backend()
+    with stage("stt_cache"):
+        data, key = await sync_to_async(_read_upload, thread_sensitive=False)(up, backend)
+        text = await acached_transcript(key)
+    if text is not None:
+        return text, True
+
+    t0 = time.perf_counter()
+    with stage("ffmpeg"):
+        pcm = await decode_to_pcm_async(data)
+    text = await stt_pool.run(transcribe_audio, backend, pcm) or ""
+    await astore_transcript(key, text, time.perf_counter() - t0)
+    return text, False
+
+
+def _speech_payload(text: str, cached: bool) -> Dict[str, Any]:
+    return {"ok": True, "text": text, **({"cached": True} if cached else {})}
+
+
+@timed_view("speech_to_text")
+@require_POST
+@ensure_csrf_cookie
+def speech_to_text(request):
+    if "audio" not in request.FILES:
+        return JsonResponse({"ok": False, "error": "no file"}, status=400)
+
+    try:
+        text, cached = _transcribe_upload(request.FILES["audio"])   # webm/opus
+    except Exception as e:
+        return _stt_error(e)
+    return JsonResponse(_speech_payload(text, cached))
+
+
+@timed_view("speech_to_text")
+@require_POST
+@ensure_csrf_cookie
+async def speech_to_text_async(request):
+    """
+    نسخهٔ ASGI: ffmpeg با asyncio اجرا می‌شود و transcribe در stt_pool (جدا از استخر متن)،
+    تا آپلودهای صوتی workerهای چت متنی را اشغال نکنند.
+    """
+    if "audio" not in request.FILES:
+        return JsonResponse({"ok": False, "error": "no file"}, status=400)
+
+    try:
+        text, cached = await _transcribe_upload_async(request.FILES["audio"])
+    except Exception as e:
+        return _stt_error(e)
+    return JsonResponse(_speech_payload(text, cached))
+
+
+@timed_view("speech_chat")
+@require_POST
+@ensure_csrf_cookie
+def speech_chat(request):
+    """
+    صوت → متن → pipeline پیام آزاد چت، در یک درخواست و با مدل‌های گرم همین پروسه؛
+    به‌جای api_speech و بعد api_chat (یک رفت‌وبرگشت، یک بار بارگذاری سشن و parse کمتر).
+    خروجی: text (متن تشخیص‌داده‌شده) و reply (همان پاسخ api_chat برای پیام آزاد).
+    """
+    if "audio" not in request.FILES:
+        return JsonResponse({"ok": False, "error": "no file"}, status=400)
+
+    try:
+        text, cached = _transcribe_upload(request.FILES["audio"])
+    except Exception as e:
+        return _stt_error(e)
+    reply = chat_message_for_session(request, text)
+    return JsonResponse({**_speech_payload(text, cached), "reply": reply})
+
+
+@timed_view("speech_chat")
+@require_POST
+@ensure_csrf_cookie
+async def speech_chat_async(request):
+    """نسخهٔ ASGI از speech_chat: بخش چت در text_pool اجرا می‌شود."""
+    if "audio" not in request.FILES:
+        return JsonResponse({"ok": False, "error": "no file"}, status=400)
+
+    try:
+        text, cached = await _transcribe_upload_async(request.FILES["audio"])
+    except Exception as e:
+        return _stt_error(e)
+    try:
+        reply = await text_pool.run(chat_message_for_session, request, text)
+    except PoolFull:
+        return busy_response()
+    return JsonResponse({**_speech_payload(text, cached), "reply": reply})
+
+
+def _session_owner(request, create: bool = False) -> str:
+    """هش کلید session؛ job و جلسهٔ استریم فقط به همان session نشان داده می‌شوند."""
+    if request.session.session_key is None and create:
+        request.session.save()
+    key = request.session.session_key or ""
+    return hashlib.sha256(key.encode("utf-8")).hexdigest() if key else ""
+
+
+def _job_cache_error(e: Exception) -> JsonResponse:
+    # کش دیتابیسی پیش‌فرض بدون «manage.py createcachetable» جدول ندارد
+    log.error("stt jobs: job cache unavailable: %s", e)
+    return JsonResponse({"ok": False, "error": "speech job storage is unavailable"}, status=503)
+
+
+@timed_view("speech_job_create")
+@require_POST
+@ensure_csrf_cookie
+def speech_job_create(request):
+    """
+    حالت job برای ضبط‌های طولانی: فایل در صف گذاشته می‌شود و فوراً 202 با job_id برمی‌گردد؛
+    کلاینت نتیجه را از status_url می‌پرسد.
+    """
+    if not JOBS_ENABLED:
+        return JsonResponse({"ok": False, "error": "speech jobs are disabled (no shared job cache)"}, status=501)
+    if "audio" not in request.FILES:
+        return JsonResponse({"ok": False, "error": "no file"}, status=400)
+    data = b"".join(request.FILES["audio"].chunks())
+    try:
+        job = submit_job(data, _backend(), _session_owner(request, create=True))
+    except PoolFull:
+        return busy_response("stt queue full")
+    except DatabaseError as e:
+        return _job_cache_error(e)
+    return JsonResponse({
+        "ok": True, **public_job(job),
+        "status_url": reverse("web:api_speech_job", args=[job["id"]]),
+    }, status=202)
+
+
+@require_GET
+def speech_job_status(request, job_id: str):
+    try:
+        job = get_job(job_id, _session_owner(request))
+    except DatabaseError as e:
+        return _job_cache_error(e)
+    if job is None:
+        return JsonResponse({"ok": False, "error": "unknown job"}, status=404)
+    return JsonResponse({"ok": True, **public_job(job)})
+
+
+def speech_stats(request):
+    if not (settings.DEBUG or getattr(request.user, "is_staff", False)):
+        return JsonResponse({"ok": False, "error": "forbidden"}, status=403)
+    return JsonResponse({"ok": True, **stt_stats(), "stt_pool": stt_pool.stats(), "jobs": job_stats()})
+
+
+def _stream_error(e: Exception) -> JsonResponse:
+    if isinstance(e, (OSError, ValueError)) and not isinstance(e, AudioDecodeError):
+        e = AudioDecodeError(str(e))     # نوشتن در pipe بستهٔ ffmpeg
+    return _stt_error(e)
+
+
+@require_POST
+@ensure_csrf_cookie
+def speech_stream(request):
+    """
+    تشخیص افزایشی: کلاینت هر تکهٔ ضبط (timeslice از MediaRecorder) را جداگانه POST می‌کند.
+      - درخواست اول بدون sid  → جلسه ساخته می‌شود و sid برمی‌گردد
+      - درخواست‌های بعدی ?sid=... → متن نهایی‌شده تا این لحظه + partial
+      - آخرین درخواست ?sid=...&final=1 → متن نهایی
+    بدنه یا فایل multipart با کلید audio است یا بایت‌های خام.
+    جلسه در حافظهٔ همین پروسه است؛ پشت load balancer باید sticky باشد.
+    sid فقط برای session سازنده‌اش معتبر است؛ بیش از STT_MAX_STREAMS جلسهٔ باز 503 می‌گیرد.
+    """
+    if (request.content_type or "").startswith("multipart/"):
+        up = request.FILES.get("audio")
+        chunk = b"".join(up.chunks()) if up else b""
+    else:
+        chunk = request.body
+
+    sid = (request.GET.get("sid") or "").strip()
+    final = (request.GET.get("final") or "").lower() in ("1", "true", "yes")
+
+    if sid:
+        stream = get_stream(sid, _session_owner(request))
+        if stream is None:
+            return JsonResponse({"ok": False, "error": "unknown stream"}, status=404)
+    else:
+        backend = _backend()
+        if not supports_streaming(backend):
+            return JsonResponse({"ok": False, "error": f"streaming requires the vosk backend (active: {backend})"},
+                                status=501)
+        try:
+            stream = open_stream(backend, _session_owner(request, create=True))
+        except STTUnavailable as e:
+            return JsonResponse({"ok": False, "error": str(e)}, status=500)
+        except STTBusy:
+            return busy_response("stt busy")
+        except AudioDecodeError as e:
+            return JsonResponse({"ok": False, "error": f"ffmpeg failed: {e}"}, status=500)
+
+    try:
+        snap = stream.feed(chunk)
+    except Exception as e:
+        # ffmpeg زودتر بسته شده، تکه خراب است یا جایگاه STT نرسید: جلسه دیگر قابل ادامه نیست
+        close_stream(stream.sid)
+        stream.abort()
+        return _stream_error(e)
+    if not final:
+        return JsonResponse({"ok": True, "final": False, **snap})
+
+    close_stream(stream.sid)
+    try:
+        text = stream.finish()
+    except Exception as e:
+        return _stream_error(e)
+    return JsonResponse({"ok": True, "final": True, "sid": stream.sid, "text": text or ""})
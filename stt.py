@@ -0,0 +1,505 @@
+# web/views/stt.py
+# رجیستری موتورهای گفتار‌به‌متن (Whisper/Vosk) در سطح پروسه:
+# مدل فقط یک بار لود می‌شود و درخواست‌ها از یک استخر محدود از نمونه‌های گرم سرویس می‌گیرند.
+import os, json, time, uuid, hashlib, threading, queue, logging, contextvars
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .audio import SAMPLE_RATE, PCMPipe, pcm_to_float32, prepare_for_stt, preprocess_signature, vad_stats
+from .qcache import TTLCache
+from .timing import register_collector, stage
+
+log = logging.getLogger(__name__)
+
+# ============= تنظیمات =============
+STT_POOL_SIZE = int(getattr(settings, "STT_POOL_SIZE", 1))                   # تعداد نمونهٔ گرم مدل
+STT_MAX_CONCURRENCY = int(getattr(settings, "STT_MAX_CONCURRENCY", STT_POOL_SIZE))
+STT_QUEUE_TIMEOUT = float(getattr(settings, "STT_QUEUE_TIMEOUT", 30.0))      # ثانیه
+STT_LANGUAGE = getattr(settings, "STT_LANGUAGE", "fa")
+STT_STREAM_IDLE_TIMEOUT = float(getattr(settings, "STT_STREAM_IDLE_TIMEOUT", 30.0))
+STT_MAX_STREAMS = int(getattr(settings, "STT_MAX_STREAMS", 8))              # جلسهٔ استریم باز هم‌زمان (هر کدام یک ffmpeg؛ 0 = بدون سقف)
+STT_CACHE_SIZE = int(getattr(settings, "STT_CACHE_SIZE", 256))               # تعداد متن نگه‌داری‌شده (0 = خاموش)
+STT_CACHE_TTL = float(getattr(settings, "STT_CACHE_TTL", 3600.0))            # ثانیه (0 = بدون انقضا)
+STT_CACHE_ALIAS = getattr(settings, "STT_CACHE_ALIAS", None)                 # کش مشترک Django بین workerها (اختیاری)
+
+
+class STTUnavailable(Exception):
+    """مدل در دسترس نیست (مثلاً مسیر مدل Vosk وجود ندارد)."""
+
+
+class STTBusy(Exception):
+    """صف انتظار پر است و در زمان مجاز نوبت نرسید."""
+
+
+# ============= بک‌اندها =============
+class _WhisperBackend:
+    name = "whisper"
+    shareable = False   # یک نمونه‌ی Whisper هم‌زمان امن نیست
+
+    def __init__(self):
+        self.model_name = getattr(settings, "WHISPER_MODEL", "base")
+        self.model_id = self.model_name
+
+    def load(self) -> Any:
+        import whisper
+        return whisper.load_model(self.model_name)
+
+    def transcribe(self, model: Any, pcm: np.ndarray, language: str) -> str:
+        res = model.transcribe(pcm_to_float32(pcm), language=language)
+        return (res.get("text") or "").strip()
+
+
+class _VoskBackend:
+    name = "vosk"
+    shareable = True    # Model در Vosk بین Recognizerها قابل اشتراک است
+
+    def __init__(self):
+        # مسیر مدل فارسی را دانلود و تنظیم کن (مثلا vosk-model-small-fa-0.4)
+        self.model_dir = getattr(settings, "VOSK_MODEL_DIR", "/opt/vosk-model-small-fa")
+        self.model_id = os.path.basename(os.path.normpath(self.model_dir))
+
+    def load(self) -> Any:
+        if not os.path.isdir(self.model_dir):
+            raise STTUnavailable("Vosk model not found")
+        from vosk import Model, SetLogLevel
+        SetLogLevel(-1)
+        return Model(self.model_dir)
+
+    def recognizer(self, model: Any) -> Any:
+        from vosk import KaldiRecognizer
+        rec = KaldiRecognizer(model, SAMPLE_RATE)
+        rec.SetWords(True)
+        return rec
+
+    def transcribe(self, model: Any, pcm: np.ndarray, language: str) -> str:
+        rec = self.recognizer(model)
+        data = memoryview(pcm.astype(np.int16, copy=False).tobytes())
+        for off in range(0, len(data), 8000):        # 4000 فریم ۱۶ بیتی
+            rec.AcceptWaveform(bytes(data[off:off + 8000]))
+        final = json.loads(rec.FinalResult())
+        return (final.get("text") or "").strip()
+
+
+_BACKENDS = {"whisper": _WhisperBackend, "vosk": _VoskBackend}
+
+STT_BACKEND = getattr(settings, "STT_BACKEND", "whisper")                     # whisper | vosk (استریم فقط vosk)
+if STT_BACKEND not in _BACKENDS:
+    log.warning("stt: unknown STT_BACKEND %r, using whisper", STT_BACKEND)
+    STT_BACKEND = "whisper"
+
+
+# ============= موتور + استخر =============
+class STTEngine:
+    def __init__(self, backend: Any, pool_size: int = STT_POOL_SIZE, max_concurrency: int = STT_MAX_CONCURRENCY):
+        self.backend = backend
+        self.pool_size = 1 if backend.shareable else max(1, pool_size)
+        self._free: "queue.LifoQueue[Any]" = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()     # فقط لود مدل مشترک؛ ببینید _load_shared
+        self.max_concurrency = max(1, max_concurrency)
+        self._sem = threading.BoundedSemaphore(self.max_concurrency)
+        self._shared: Optional[Any] = None
+        self._m: Dict[str, float] = {
+            "loads": 0, "load_seconds_total": 0.0, "last_load_seconds": 0.0,
+            "requests": 0, "errors": 0, "rejected": 0, "in_flight": 0,
+            "queue_wait_seconds_total": 0.0, "queue_wait_seconds_max": 0.0,
+            "transcribe_seconds_total": 0.0, "transcribe_seconds_max": 0.0,
+        }
+
+    def _load(self) -> Any:
+        t0 = time.perf_counter()
+        with stage("stt_load"):
+            model = self.backend.load()
+        dt = time.perf_counter() - t0
+        with self._lock:
+            self._m["loads"] += 1
+            self._m["load_seconds_total"] += dt
+            self._m["last_load_seconds"] = dt
+        log.info("stt: loaded %s model in %.2fs", self.backend.name, dt)
+        return model
+
+    def _load_shared(self) -> Any:
+        # double-checked زیر _load_lock، نه _lock: _load برای متریک خودش _lock را می‌گیرد
+        # و Lock غیربازگشتی است؛ گرفتن _lock اینجا اولین درخواست Vosk را قفل می‌کرد
+        if self._shared is None:
+            with self._load_lock:
+                if self._shared is None:
+                    self._shared = self._load()
+        return self._shared
+
+    def _take(self, deadline: float) -> Any:
+        if self.backend.shareable:
+            return self._load_shared()
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            grow = self._created < self.pool_size
+            if grow:
+                self._created += 1
+        if grow:
+            try:
+                return self._load()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._free.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            raise STTBusy("stt queue timeout")
+
+    def _give(self, model: Any) -> None:
+        if not self.backend.shareable:
+            self._free.put(model)
+
+    def shared_model(self) -> Any:
+        """مدل مشترک بک‌اند shareable، بدون گرفتن جایگاه هم‌زمانی (برای Recognizerهای استریم)."""
+        if not self.backend.shareable:
+            raise STTUnavailable(f"{self.backend.name} has no shareable model")
+        return self._load_shared()
+
+    def checkout(self, timeout: float = STT_QUEUE_TIMEOUT) -> Any:
+        t0 = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        with stage("stt_wait"):
+            acquired = self._sem.acquire(timeout=timeout)
+        if not acquired:
+            with self._lock:
+                self._m["rejected"] += 1
+            raise STTBusy("stt concurrency limit")
+        try:
+            model = self._take(deadline)
+        except BaseException as e:
+            self._sem.release()
+            if isinstance(e, STTBusy):
+                with self._lock:
+                    self._m["rejected"] += 1
+            raise
+        wait = time.perf_counter() - t0
+        with self._lock:
+            self._m["queue_wait_seconds_total"] += wait
+            self._m["queue_wait_seconds_max"] = max(self._m["queue_wait_seconds_max"], wait)
+            self._m["in_flight"] += 1
+        return model
+
+    def checkin(self, model: Any) -> None:
+        with self._lock:
+            self._m["in_flight"] -= 1
+        self._give(model)
+        self._sem.release()
+
+    @contextmanager
+    def acquire(self, timeout: float = STT_QUEUE_TIMEOUT):
+        model = self.checkout(timeout)
+        try:
+            yield model
+        finally:
+            self.checkin(model)
+
+    def record_request(self, seconds: float) -> None:
+        """متریک یک رونویسی موفق (فایل کامل یا جلسهٔ استریم)."""
+        with self._lock:
+            self._m["requests"] += 1
+            self._m["transcribe_seconds_total"] += seconds
+            self._m["transcribe_seconds_max"] = max(self._m["transcribe_seconds_max"], seconds)
+
+    def record_error(self) -> None:
+        with self._lock:
+            self._m["errors"] += 1
+
+    def transcribe(self, pcm: np.ndarray, language: str = STT_LANGUAGE) -> str:
+        with self.acquire() as model:
+            t0 = time.perf_counter()
+            try:
+                with stage("transcribe"):
+                    text = self.backend.transcribe(model, pcm, language)
+            except Exception:
+                self.record_error()
+                raise
+            self.record_request(time.perf_counter() - t0)
+        return text
+
+    def transcribe_segments(self, segments, language: str = STT_LANGUAGE) -> str:
+        """بخش‌ها تا سقف هم‌زمانی موتور موازی رونویسی و به ترتیب به هم وصل می‌شوند."""
+        workers = min(len(segments), self.max_concurrency, len(segments) if self.backend.shareable else self.pool_size)
+        if workers <= 1:
+            texts = [self.transcribe(seg, language) for seg in segments]
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stt-seg") as ex:
+                futs = [ex.submit(contextvars.copy_context().run, self.transcribe, seg, language) for seg in segments]
+                texts = [f.result() for f in futs]
+        return " ".join(t for t in texts if t)
+
+    def warmup(self) -> None:
+        with self.acquire():
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out: Dict[str, Any] = dict(self._m)
+            warm = (1 if self._shared is not None else 0) if self.backend.shareable else self._created
+        out.update({"backend": self.backend.name, "pool_size": self.pool_size, "warm_instances": warm})
+        n = out["requests"] or 1
+        out["transcribe_seconds_avg"] = out["transcribe_seconds_total"] / n
+        out["queue_wait_seconds_avg"] = out["queue_wait_seconds_total"] / n
+        return out
+
+
+# ============= رجیستری سطح پروسه =============
+_ENGINES: Dict[str, STTEngine] = {}
+_ENGINES_LOCK = threading.Lock()
+
+def get_stt_engine(backend: str) -> STTEngine:
+    eng = _ENGINES.get(backend)
+    if eng is not None:
+        return eng
+    with _ENGINES_LOCK:
+        eng = _ENGINES.get(backend)
+        if eng is None:
+            eng = STTEngine(_BACKENDS[backend]())
+            _ENGINES[backend] = eng
+    return eng
+
+def transcribe_audio(backend: str, pcm: np.ndarray) -> str:
+    """PCM خروجی ffmpeg → VAD/سقف طول → رونویسی بخش‌ها؛ صوت تماماً ساکت اصلاً به مدل نمی‌رسد."""
+    _reap_idle_streams()
+    with stage("vad"):
+        prepared = prepare_for_stt(pcm)
+    if not prepared.segments:
+        return ""
+    return get_stt_engine(backend).transcribe_segments(prepared.segments)
+
+
+# ============= کش متن بر اساس محتوای صوت =============
+# ارسال دوبارهٔ همان ضبط (تلاش مجدد فرانت، دابل‌کلیک) بدون ffmpeg و مدل جواب می‌گیرد.
+# کلید: هش بایت‌های آپلودی + بک‌اند و مدل + زبان + تنظیمات پیش‌پردازش.
+# cached_transcript/store_transcript sync هستند (کش Django)؛ از coroutine نسخه‌های a* را صدا بزنید.
+_TEXT_CACHE = TTLCache(STT_CACHE_SIZE, STT_CACHE_TTL)
+_TEXT_CACHE_LOCK = threading.Lock()
+_TEXT_CACHE_M: Dict[str, float] = {"saved_seconds": 0.0, "shared_hits": 0, "shared_errors": 0}
+
+
+def _text_shared_cache():
+    if not STT_CACHE_ALIAS or not STT_CACHE_SIZE:
+        return None
+    from django.core.cache import caches
+    return caches[STT_CACHE_ALIAS]
+
+
+def transcript_key(chunks: Iterable[bytes], backend: str, language: str = STT_LANGUAGE) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    for chunk in chunks:
+        h.update(chunk)
+    model_id = getattr(get_stt_engine(backend).backend, "model_id", "")
+    return f"stt:{backend}:{model_id}:{language}:{preprocess_signature()}:{h.hexdigest()}"
+
+
+def cached_transcript(key: str) -> Optional[str]:
+    """
+    متن ذخیره‌شده یا None؛ روی hit زمان decode+transcribe صرفه‌جویی‌شده شمرده می‌شود.
+    sync است؛ داخل coroutine نباید صدا زده شود (acached_transcript را ببینید).
+    """
+    if not STT_CACHE_SIZE:
+        return None
+    ent: Optional[Tuple[str, float]] = _TEXT_CACHE.get(key)
+    if ent is None:
+        shared = _text_shared_cache()
+        if shared is not None:
+            try:
+                ent = shared.get(key)
+            except Exception:
+                with _TEXT_CACHE_LOCK:
+                    _TEXT_CACHE_M["shared_errors"] += 1
+            if ent is not None:
+                _TEXT_CACHE.set(key, ent)
+                with _TEXT_CACHE_LOCK:
+                    _TEXT_CACHE_M["shared_hits"] += 1
+    if ent is None:
+        return None
+    with _TEXT_CACHE_LOCK:
+        _TEXT_CACHE_M["saved_seconds"] += ent[1]
+    return ent[0]
+
+
+def store_transcript(key: str, text: str, cost_seconds: float) -> None:
+    """sync است؛ داخل coroutine از astore_transcript استفاده کنید."""
+    if not STT_CACHE_SIZE:
+        return
+    ent = (text, float(cost_seconds))
+    _TEXT_CACHE.set(key, ent)
+    shared = _text_shared_cache()
+    if shared is not None:
+        try:
+            shared.set(key, ent, timeout=STT_CACHE_TTL or None)
+        except Exception:
+            with _TEXT_CACHE_LOCK:
+                _TEXT_CACHE_M["shared_errors"] += 1
+
+
+async def acached_transcript(key: str) -> Optional[str]:
+    """نسخهٔ async: کش مشترک (Redis/memcached/DB) در thread خوانده می‌شود، نه روی event loop."""
+    return await sync_to_async(cached_transcript, thread_sensitive=False)(key)
+
+
+async def astore_transcript(key: str, text: str, cost_seconds: float) -> None:
+    await sync_to_async(store_transcript, thread_sensitive=False)(key, text, cost_seconds)
+
+
+def transcript_cache_stats() -> Dict[str, Any]:
+    with _TEXT_CACHE_LOCK:
+        extra = dict(_TEXT_CACHE_M)
+    return {**_TEXT_CACHE.stats(), **extra, "alias": STT_CACHE_ALIAS}
+
+
+def _transcript_cache_metrics() -> List[str]:
+    s = transcript_cache_stats()
+    return [
+        "# HELP stt_transcript_cache_total Transcript cache lookups by content hash.",
+        "# TYPE stt_transcript_cache_total counter",
+        f'stt_transcript_cache_total{{result="hit"}} {s["hits"] + s["shared_hits"]}',
+        f'stt_transcript_cache_total{{result="miss"}} {s["misses"] - s["shared_hits"]}',
+        "# HELP stt_transcript_cache_saved_seconds_total Decode and transcription time skipped on cache hits.",
+        "# TYPE stt_transcript_cache_saved_seconds_total counter",
+        f"stt_transcript_cache_saved_seconds_total {s['saved_seconds']:.3f}",
+    ]
+
+
+register_collector(_transcript_cache_metrics)
+
+
+def stt_stats() -> Dict[str, Any]:
+    return {
+        "engines": {name: eng.stats() for name, eng in list(_ENGINES.items())},
+        "streams_open": len(_STREAMS),
+        "streams_max": STT_MAX_STREAMS,
+        "preprocess": vad_stats(),
+        "transcript_cache": transcript_cache_stats(),
+    }
+
+
+# ============= تشخیص گفتار افزایشی (استریم) =============
+class STTStream:
+    """
+    یک جلسه‌ی استریم: chunkهای صوتی (مثلاً timesliceهای MediaRecorder) به ffmpeg ماندگار
+    داده می‌شوند و PCM خروجی همان لحظه وارد حلقه‌ی AcceptWaveform در KaldiRecognizer می‌شود.
+    Recognizer روی مدل مشترک موتور ساخته می‌شود و جایگاه هم‌زمانی فقط هنگام پردازش هر بلوک
+    گرفته می‌شود؛ جلسهٔ بیکار یا رهاشده آپلودهای دیگر را معطل نمی‌کند.
+    """
+    def __init__(self, engine: STTEngine, owner: str = ""):
+        if not hasattr(engine.backend, "recognizer"):
+            raise STTUnavailable(f"streaming is not supported by {engine.backend.name}")
+        self.sid = uuid.uuid4().hex
+        self.owner = owner                  # هش session سازنده؛ فقط همان می‌تواند feed/finish کند
+        self.engine = engine
+        self.model = engine.shared_model()
+        self.started = time.perf_counter()
+        self.touched = time.monotonic()
+        self._lock = threading.Lock()
+        self._parts: list = []
+        self._partial = ""
+        self._rec = engine.backend.recognizer(self.model)
+        self._pipe = PCMPipe(self._on_pcm, block=8000, low_latency=True)
+
+    def _on_pcm(self, data: bytes) -> None:
+        with self.engine.acquire(), self._lock:
+            if self._rec.AcceptWaveform(data):
+                txt = (json.loads(self._rec.Result()).get("text") or "").strip()
+                if txt:
+                    self._parts.append(txt)
+                self._partial = ""
+            else:
+                self._partial = (json.loads(self._rec.PartialResult()).get("partial") or "").strip()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            text = " ".join(self._parts)
+            partial = " ".join(p for p in (text, self._partial) if p)
+        return {"sid": self.sid, "text": text, "partial": partial}
+
+    def feed(self, chunk: bytes) -> Dict[str, Any]:
+        """
+        خطای پردازش بلوک‌های قبلی (مثلاً STTBusy در thread خوانندهٔ ffmpeg) همین‌جا بالا می‌رود؛
+        بعد از آن بقیهٔ صوت دور ریخته شده و partialها کهنه‌اند، پس جلسه قابل ادامه نیست.
+        """
+        self.touched = time.monotonic()
+        self._pipe.check()
+        self._pipe.write(chunk)
+        self._pipe.check()
+        return self.snapshot()
+
+    def finish(self) -> str:
+        try:
+            self._pipe.close()
+            with self.engine.acquire(), self._lock:
+                txt = (json.loads(self._rec.FinalResult()).get("text") or "").strip()
+                if txt:
+                    self._parts.append(txt)
+                text = " ".join(self._parts)
+            self.engine.record_request(time.perf_counter() - self.started)
+            return text
+        except Exception:
+            self.engine.record_error()
+            raise
+
+    def abort(self) -> None:
+        self._pipe.kill()
+
+
+_STREAMS: Dict[str, STTStream] = {}
+_STREAMS_LOCK = threading.Lock()
+_STREAMS_OPENING = 0                # جلسه‌های در حال ساخت، برای سقف STT_MAX_STREAMS
+
+def _reap_idle_streams() -> None:
+    now = time.monotonic()
+    with _STREAMS_LOCK:
+        stale = [s for s in _STREAMS.values() if now - s.touched > STT_STREAM_IDLE_TIMEOUT]
+        for s in stale:
+            _STREAMS.pop(s.sid, None)
+    for s in stale:
+        log.info("stt: dropping idle stream %s", s.sid)
+        s.abort()
+
+def supports_streaming(backend: str) -> bool:
+    return hasattr(_BACKENDS[backend], "recognizer")
+
+def open_stream(backend: str = "vosk", owner: str = "") -> STTStream:
+    """
+    جلسهٔ تازه برای owner؛ هر جلسه یک ffmpeg و دو thread دارد، پس بیش از STT_MAX_STREAMS
+    جلسهٔ باز (پس از کنار گذاشتن جلسه‌های بیکار) STTBusy می‌دهد.
+    """
+    global _STREAMS_OPENING
+    _reap_idle_streams()
+    with _STREAMS_LOCK:
+        if STT_MAX_STREAMS > 0 and len(_STREAMS) + _STREAMS_OPENING >= STT_MAX_STREAMS:
+            raise STTBusy("too many open streams")
+        _STREAMS_OPENING += 1
+    st = None
+    try:
+        st = STTStream(get_stt_engine(backend), owner)
+    finally:
+        with _STREAMS_LOCK:
+            _STREAMS_OPENING -= 1
+            if st is not None:
+                _STREAMS[st.sid] = st
+    return st
+
+def get_stream(sid: str, owner: str) -> Optional[STTStream]:
+    """جلسه فقط برای سازنده‌اش؛ برای بقیه مثل جلسهٔ ناموجود None است."""
+    _reap_idle_streams()
+    with _STREAMS_LOCK:
+        st = _STREAMS.get(sid)
+    if st is None or not owner or st.owner != owner:
+        return None
+    return st
+
+def close_stream(sid: str) -> Optional[STTStream]:
+    with _STREAMS_LOCK:
+        return _STREAMS.pop(sid, None)
@@ -0,0 +1,173 @@
+# web/views/sttjobs.py
+# صف job برای تبدیل گفتار به متن: آپلود بلافاصله با شناسهٔ job جواب می‌گیرد و
+# decode + transcribe در یک استخر محلی انجام می‌شود؛ وضعیت/نتیجه در کش Django نگه داشته می‌شود.
+# وضعیت باید از هر worker خواندنی باشد: اگر alias در CACHES تعریف نشده باشد کش دیتابیسی
+# STT_JOB_CACHE_TABLE استفاده می‌شود (یک بار: manage.py createcachetable stt_job_cache).
+# LocMemCache فقط همان پروسه را می‌بیند، پس job خاموش می‌ماند مگر STT_JOB_ALLOW_LOCAL_CACHE (تک‌پروسه).
+import time, uuid, logging
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.db import DatabaseCache
+
+from .audio import decode_to_pcm, AudioDecodeError
+from .pools import BoundedPool
+from .stt import transcribe_audio, transcript_key, cached_transcript, store_transcript, STTBusy, STTUnavailable
+from .timing import collect_stages, observe, stage
+
+log = logging.getLogger(__name__)
+
+# ============= تنظیمات =============
+STT_JOB_WORKERS = int(getattr(settings, "STT_JOB_WORKERS", getattr(settings, "STT_POOL_SIZE", 1)))
+STT_JOB_QUEUE = int(getattr(settings, "STT_JOB_QUEUE", 16))                  # job منتظر، علاوه بر workerها
+STT_JOB_TTL = int(getattr(settings, "STT_JOB_TTL", 3600))                     # ثانیه نگه‌داری نتیجه
+STT_JOB_CACHE_ALIAS = getattr(settings, "STT_JOB_CACHE_ALIAS", "stt_jobs")
+STT_JOB_CACHE_TABLE = getattr(settings, "STT_JOB_CACHE_TABLE", "stt_job_cache")   # وقتی alias تعریف نشده
+STT_JOB_ALLOW_LOCAL_CACHE = bool(getattr(settings, "STT_JOB_ALLOW_LOCAL_CACHE", False))  # فقط با یک worker
+STT_JOB_FFMPEG_RETRIES = int(getattr(settings, "STT_JOB_FFMPEG_RETRIES", 2))  # تلاش مجدد پس از خطای ffmpeg
+STT_JOB_RETRY_BACKOFF = float(getattr(settings, "STT_JOB_RETRY_BACKOFF", 0.5))  # ثانیه، دوبرابر در هر تلاش
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+job_pool = BoundedPool("stt-jobs", STT_JOB_WORKERS, STT_JOB_QUEUE)
+
+_LOCAL_BACKENDS = ("django.core.cache.backends.locmem.LocMemCache",)
+_NULL_BACKENDS = ("django.core.cache.backends.dummy.DummyCache",)
+
+
+_DB_CACHE: Optional[DatabaseCache] = None
+
+
+def _cache():
+    global _DB_CACHE
+    if STT_JOB_CACHE_ALIAS in settings.CACHES:
+        return caches[STT_JOB_CACHE_ALIAS]
+    if _DB_CACHE is None:
+        _DB_CACHE = DatabaseCache(STT_JOB_CACHE_TABLE, {"TIMEOUT": STT_JOB_TTL})
+    return _DB_CACHE
+
+
+def _cache_scope() -> str:
+    """shared | local (فقط همین پروسه) | none (چیزی ذخیره نمی‌شود)"""
+    if STT_JOB_CACHE_ALIAS not in settings.CACHES:
+        return "shared"     # کش دیتابیسی STT_JOB_CACHE_TABLE
+    backend = settings.CACHES[STT_JOB_CACHE_ALIAS].get("BACKEND", "")
+    if backend in _NULL_BACKENDS:
+        return "none"
+    return "local" if backend in _LOCAL_BACKENDS else "shared"
+
+
+CACHE_SCOPE = _cache_scope()
+JOBS_ENABLED = CACHE_SCOPE == "shared" or (CACHE_SCOPE == "local" and STT_JOB_ALLOW_LOCAL_CACHE)
+if CACHE_SCOPE == "local":
+    if JOBS_ENABLED:
+        log.warning("stt jobs: cache %r is process-local; run a single worker (STT_JOB_ALLOW_LOCAL_CACHE)",
+                    STT_JOB_CACHE_ALIAS)
+    else:
+        log.warning("stt jobs: cache %r is process-local, so job status would not be visible across workers; "
+                    "speech jobs are disabled. Use a shared cache or set STT_JOB_ALLOW_LOCAL_CACHE for a "
+                    "single-process server.", STT_JOB_CACHE_ALIAS)
+elif not JOBS_ENABLED:
+    log.warning("stt jobs: cache %r does not store anything; speech jobs are disabled", STT_JOB_CACHE_ALIAS)
+
+
+def _key(job_id: str) -> str:
+    return f"sttjob:{job_id}"
+
+
+def _save(job: Dict[str, Any]) -> None:
+    _cache().set(_key(job["id"]), job, STT_JOB_TTL)
+
+
+def get_job(job_id: str, owner: str) -> Optional[Dict[str, Any]]:
+    """job فقط برای سازنده‌اش؛ برای بقیه مثل job ناموجود None است."""
+    job = _cache().get(_key(job_id))
+    if job is None or not owner or job.get("owner") != owner:
+        return None
+    return job
+
+
+def _decode_with_retry(data: bytes, job: Dict[str, Any]):
+    delay = STT_JOB_RETRY_BACKOFF
+    for attempt in range(STT_JOB_FFMPEG_RETRIES + 1):
+        job["attempts"] = attempt + 1
+        try:
+            with stage("ffmpeg"):
+                return decode_to_pcm([data])
+        except AudioDecodeError as e:
+            if attempt >= STT_JOB_FFMPEG_RETRIES:
+                raise
+            log.warning("stt job %s: ffmpeg failed (%s), retry %d", job["id"], e, attempt + 1)
+            time.sleep(delay)
+            delay *= 2
+
+
+def _run(job: Dict[str, Any], data: bytes, backend: str) -> None:
+    job.update(status=RUNNING, started=time.time())
+    _save(job)
+    t0 = time.perf_counter()
+    with collect_stages() as stages:
+        try:
+            pcm = _decode_with_retry(data, job)
+            text = transcribe_audio(backend, pcm) or ""
+            job.update(status=DONE, text=text)
+            store_transcript(job["key"], text, time.perf_counter() - t0)
+        except AudioDecodeError as e:
+            job.update(status=FAILED, error=f"ffmpeg failed: {e}")
+        except (STTUnavailable, STTBusy) as e:
+            job.update(status=FAILED, error=str(e) or "stt busy")
+        except Exception as e:
+            log.exception("stt job %s failed", job["id"])
+            job.update(status=FAILED, error=f"stt failed: {e}")
+    total = time.perf_counter() - t0
+    job.update(
+        finished=time.time(),
+        timings_ms={"queue": round((job["started"] - job["created"]) * 1000.0, 2),
+                    **{k: round(v * 1000.0, 2) for k, v in stages.items()},
+                    "run": round(total * 1000.0, 2)},
+    )
+    _save(job)
+    observe("speech_job", 200 if job["status"] == DONE else 500, total, dict(stages))
+
+
+def submit_job(data: bytes, backend: str, owner: str) -> Dict[str, Any]:
+    """
+    job را ثبت و در صف می‌گذارد؛ اگر صف پر باشد PoolFull بالا می‌رود و چیزی ذخیره نمی‌شود.
+    اگر همین صوت قبلاً رونویسی شده باشد job بدون صف، تمام‌شده برمی‌گردد.
+    owner شناسهٔ سازنده (هش session) است و وضعیت فقط به همان برگردانده می‌شود.
+    اگر جدول کش دیتابیسی ساخته نشده باشد DatabaseError بالا می‌رود.
+    """
+    key = transcript_key([data], backend)
+    job = {"id": uuid.uuid4().hex, "status": QUEUED, "backend": backend, "created": time.time(),
+           "attempts": 0, "text": None, "error": None, "key": key, "owner": owner}
+    text = cached_transcript(key)
+    if text is not None:
+        job.update(status=DONE, text=text, cached=True, finished=job["created"])
+        _save(job)
+        return job
+    _save(job)
+    try:
+        job_pool.submit(_run, job, data, backend)
+    except BaseException:
+        _cache().delete(_key(job["id"]))
+        raise
+    return job
+
+
+def public_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    out = {"job_id": job["id"], "status": job["status"], "attempts": job.get("attempts", 0)}
+    if job["status"] == DONE:
+        out["text"] = job.get("text") or ""
+        if job.get("cached"):
+            out["cached"] = True
+    elif job["status"] == FAILED:
+        out["error"] = job.get("error")
+    if job.get("timings_ms"):
+        out["timings_ms"] = job["timings_ms"]
+    return out
+
+
+def job_stats() -> Dict[str, Any]:
+    alias = STT_JOB_CACHE_ALIAS if STT_JOB_CACHE_ALIAS in settings.CACHES else f"db:{STT_JOB_CACHE_TABLE}"
+    return {**job_pool.stats(), "enabled": JOBS_ENABLED, "cache_alias": alias, "cache_scope": CACHE_SCOPE}
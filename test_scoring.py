@@ -0,0 +1,154 @@
+# web/tests/test_scoring.py
+# امتیازدهی دسته‌ای (score_submissions): امتیاز مورد انتظار روی بانک ثابت و برابری با امتیازدهی
+# اولیهٔ batch_submit (حلقه روی کل بانک)، از جمله qid تکراری بین آیتم‌ها
+import json, random, tempfile
+from pathlib import Path
+
+from django.test import SimpleTestCase
+
+from web.views import chat
+
+_RTS = ["yesno", "likert_0_3", "text", "open", None]
+
+
+def _bank():
+    bank = []
+    for i in range(12):
+        did = ["anxiety", "mood", "sleep_wake"][i % 3]
+        bank.append({
+            "id": f"IT{i}", "disorder_id": did, "symptom": f"علامت {i}",
+            "gateway": {"id": f"IT{i}_G", "text": "؟"},
+            "followups": [{"id": f"IT{i}_F{j}", "text": "؟", "response_type": _RTS[(i + j) % len(_RTS)]}
+                          for j in range(3)],
+        })
+    # qid مشترک بین آیتم‌های با اختلال و نوع پاسخ متفاوت؛ متادیتای آیتم آخر باید برنده شود
+    bank[1]["followups"].append({"id": "SHARED", "text": "؟", "response_type": "yesno"})
+    bank[5]["followups"].append({"id": "SHARED", "text": "؟", "response_type": "likert_0_3"})
+    bank[9]["followups"].append({"id": "SHARED", "text": "؟", "response_type": "text"})
+    bank[4]["followups"].append({"id": "IT0_F1", "text": "؟", "response_type": "likert_0_3"})
+    bank.append({"id": "EMPTY", "disorder_id": "mood", "symptom": "بدون سؤال", "followups": []})
+    return bank
+
+
+def _baseline_score(bank, answers, shown):
+    # همان حلقهٔ batch_submit پیش از جدول متادیتا؛ مرجع مستقل از QuestionBankIndex
+    qmeta = {}
+    for it in bank:
+        if shown and it.get("id") not in shown:
+            continue
+        did = str(it.get("disorder_id"))
+        gid = (it.get("gateway") or {}).get("id")
+        if gid:
+            qmeta[gid] = {"disorder_id": did, "response_type": "yesno"}
+        for fq in (it.get("followups") or []):
+            if fq.get("id"):
+                qmeta[fq["id"]] = {"disorder_id": did, "response_type": fq.get("response_type")}
+    total, mx = {}, {}
+    for qid, meta in qmeta.items():
+        did, rt = meta["disorder_id"], meta["response_type"]
+        val = answers.get(qid, None)
+        if val is None or (isinstance(val, str) and not val.strip()):
+            val = {"yesno": "no", "likert_0_3": 0}.get(rt, "")
+        total[did] = total.get(did, 0) + chat.score_answer(meta, val)
+        mx[did] = mx.get(did, 0) + chat.max_score_for(meta)
+    results = []
+    for did, sc in total.items():
+        m = mx.get(did, 0) or 1
+        pct = round(100.0 * sc / m, 1)
+        if sc > 0:
+            results.append({"disorder_id": did, "label": chat.DEFAULT_LABELS.get(did, f"اختلال {did}"),
+                            "score": sc, "max": m, "percent": pct, "severity": chat.severity_label(pct)})
+    results.sort(key=lambda r: (-r["percent"], -r["score"]))
+    return results
+
+
+def _answer(rt, rng):
+    return rng.choice({
+        "yesno": ["yes", "no", "بله", "", None, "1"],
+        "likert_0_3": [0, 1, 2, 3, "2", 7, "x", ""],
+    }.get(rt, ["گاهی", "", "  ", None, "yes"]))
+
+
+class ScoreSubmissionsTests(SimpleTestCase):
+    # همهٔ فایل‌های بانک (و امبدینگی که reload ممکن است autosave کند) در پوشهٔ موقت
+    _PATCHED = ("QUESTIONS_FILE", "DIFF_QUESTIONS_FILE", "LABELS_FILE", "BANK_EMB_FILE", "BANK_MV_EMB_FILE")
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls._tmp = tempfile.TemporaryDirectory()
+        d = Path(cls._tmp.name)
+        cls.bank = _bank()
+        (d / "questions.json").write_text(json.dumps({"question_bank": cls.bank}, ensure_ascii=False), "utf-8")
+        cls._saved = {name: getattr(chat, name) for name in cls._PATCHED}
+        chat.QUESTIONS_FILE = d / "questions.json"
+        chat.DIFF_QUESTIONS_FILE = d / "differential_questions.json"
+        chat.LABELS_FILE = d / "disorder_labels.json"
+        chat.BANK_EMB_FILE = d / "bank_emb.npy"
+        chat.BANK_MV_EMB_FILE = d / "bank_emb.mv.npy"
+        chat.reload_bank(force=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        for name, value in cls._saved.items():
+            setattr(chat, name, value)
+        chat.reload_bank(force=True)
+        cls._tmp.cleanup()
+        super().tearDownClass()
+
+    def test_expected_scores(self):
+        answers = {
+            "IT0_G": "yes", "IT0_F0": "yes", "IT0_F1": 2, "IT0_F2": "گاهی",  # anxiety: 1+1+2+1 از 6
+            "IT1_G": "no", "IT1_F0": "1", "IT1_F1": "  ", "SHARED": "yes",   # mood: 0+1+0+0+1 از 7
+            "IT2_G": "yes",                                                   # آیتم نمایش‌داده‌نشده
+        }
+        self.assertEqual(chat.score_submissions([(answers, {"IT0", "IT1"})])[0], [
+            {"disorder_id": "anxiety", "label": "اختلالات اضطرابی",
+             "score": 5, "max": 6, "percent": 83.3, "severity": "زیاد"},
+            {"disorder_id": "mood", "label": "اختلال mood",
+             "score": 2, "max": 7, "percent": 28.6, "severity": "کم"},
+        ])
+
+    def test_expected_scores_duplicate_qid_and_empty(self):
+        # SHARED در IT5 (sleep_wake، likert) بعد از IT1 می‌آید و متادیتای آن برنده است
+        self.assertEqual(chat.score_submissions([({"SHARED": 3}, {"IT1", "IT5"})])[0], [
+            {"disorder_id": "sleep_wake", "label": "اختلالات خواب و بیداری",
+             "score": 3, "max": 9, "percent": 33.3, "severity": "متوسط"},
+        ])
+        self.assertEqual(chat.score_submissions([({}, set()), ({"IT0_G": "yes"}, {"EMPTY"})]), [[], []])
+
+    def test_matches_baseline(self):
+        rng = random.Random(0)
+        index = chat.current_snapshot().index
+        item_ids = list(index.by_id) + ["UNKNOWN"]
+        qmeta = index.qmeta_all
+        subs = []
+        for n in range(300):
+            shown = set(rng.sample(item_ids, rng.randint(0, 5))) if n % 10 else set()
+            if n % 7 == 0:
+                shown |= {"IT1", "IT5", "IT9"}
+            answers = {qid: _answer(meta.response_type, rng)
+                       for qid, meta in qmeta.items() if rng.random() < 0.4}
+            answers["NOT_A_QUESTION"] = "yes"
+            subs.append((answers, shown))
+
+        got = chat.score_submissions(iter(subs))
+        self.assertEqual(len(got), len(subs))
+        for (answers, shown), res in zip(subs, got):
+            self.assertEqual(res, _baseline_score(self.bank, answers, shown))
+
+    def test_duplicate_qid_uses_last_shown_item(self):
+        answers = {"SHARED": 3}
+        for shown in ({"IT1"}, {"IT1", "IT5"}, {"IT5", "IT9"}, {"IT1", "IT9"}):
+            want = _baseline_score(self.bank, answers, shown)
+            self.assertEqual(chat.score_submissions([(answers, shown)])[0], want)
+            # گروه بزرگ از همان مجموعهٔ آیتم‌ها از مسیر برداری می‌رود
+            batch = [(answers, shown)] * chat.SCORE_GROUP_MIN
+            self.assertEqual(chat.score_submissions(batch), [want] * len(batch))
+
+    def test_grouped_path_matches_single(self):
+        answers = {"IT0_G": "yes", "IT0_F1": "3", "IT1_F0": 2, "IT1_F1": "  ", "SHARED": "yes", "IT7_F2": "x"}
+        for shown in (set(), {"IT0", "IT1"}, {"EMPTY"}):
+            batch = [(answers, shown), ({}, shown)] * chat.SCORE_GROUP_MIN
+            got = chat.score_submissions(batch)
+            self.assertEqual(got, [_baseline_score(self.bank, a, sh) for a, sh in batch])
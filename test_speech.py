@@ -0,0 +1,190 @@
+# web/tests/test_speech.py
+# مسیر async گفتار با کش مشترک غیر locmem (DatabaseCache): خواندن/نوشتن کش نباید روی event loop انجام شود
+# و job گفتار: بدون جدول کش 503، وضعیت فقط برای session سازنده؛ خطای ffmpeg در استریم جلسه را می‌بندد؛
+# مدل مشترک Vosk یک بار و بدون قفل‌شدن لود می‌شود؛ جلسهٔ استریم مال session سازنده و تعدادش سقف‌دار است
+import json, threading, time, uuid
+from unittest import mock
+
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, SimpleTestCase, TransactionTestCase, override_settings
+
+from web.views import speech, stt, sttjobs
+
+_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "stt": {"BACKEND": "django.core.cache.backends.db.DatabaseCache", "LOCATION": "test_stt_cache"},
+}
+
+
+@override_settings(CACHES=_CACHES)
+class AsyncSpeechSharedCacheTests(TransactionTestCase):
+    databases = {"default"}
+
+    def setUp(self):
+        call_command("createcachetable", "test_stt_cache", verbosity=0)
+        caches["stt"].clear()
+        self._alias = stt.STT_CACHE_ALIAS
+        stt.STT_CACHE_ALIAS = "stt"
+        stt._TEXT_CACHE.clear()
+        self._errors = stt.transcript_cache_stats()["shared_errors"]
+        self.decode = mock.patch.object(speech, "decode_to_pcm_async", mock.AsyncMock(return_value=b"\0\0" * 160))
+        self.transcribe = mock.patch.object(speech, "transcribe_audio", mock.Mock(return_value="سلام"))
+        self.decode.start()
+        self.transcribe.start()
+
+    def tearDown(self):
+        self.transcribe.stop()
+        self.decode.stop()
+        stt.STT_CACHE_ALIAS = self._alias
+        stt._TEXT_CACHE.clear()
+
+    def _post(self):
+        up = SimpleUploadedFile("a.webm", b"same-recording", content_type="audio/webm")
+        return RequestFactory().post("/speech/", {"audio": up})
+
+    async def test_second_upload_hits_shared_cache(self):
+        first = await speech.speech_to_text_async(self._post())
+        self.assertEqual(first.status_code, 200)
+        self.assertNotIn(b'"cached"', first.content)
+
+        stt._TEXT_CACHE.clear()   # فقط کش مشترک (DB) می‌ماند
+        second = await speech.speech_to_text_async(self._post())
+        self.assertEqual(second.status_code, 200)
+        self.assertIn(b'"cached": true', second.content)
+
+        self.assertEqual(speech.transcribe_audio.call_count, 1)
+        stats = stt.transcript_cache_stats()
+        self.assertEqual(stats["shared_errors"], self._errors)
+        self.assertGreaterEqual(stats["shared_hits"], 1)
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class SpeechJobTests(TransactionTestCase):
+    # کش پیش‌فرض job: DatabaseCache روی جدولی که فقط createcachetable می‌سازد
+    databases = {"default"}
+
+    def setUp(self):
+        self._table = sttjobs.STT_JOB_CACHE_TABLE
+        sttjobs.STT_JOB_CACHE_TABLE = "test_stt_job_cache"
+        sttjobs._DB_CACHE = None
+        self.patches = [
+            mock.patch.object(speech, "JOBS_ENABLED", True),
+            mock.patch.object(sttjobs, "cached_transcript", mock.Mock(return_value="سلام")),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        sttjobs.STT_JOB_CACHE_TABLE = self._table
+        sttjobs._DB_CACHE = None
+
+    def _request(self, method, path, session=None, **kw):
+        req = getattr(RequestFactory(), method)(path, **kw)
+        req.session = session or SessionStore()
+        return req
+
+    def test_missing_cache_table_returns_503(self):
+        up = SimpleUploadedFile("a.webm", b"rec", content_type="audio/webm")
+        resp = speech.speech_job_create(self._request("post", "/api/speech/jobs/", data={"audio": up}))
+        self.assertEqual(resp.status_code, 503)
+        resp = speech.speech_job_status(self._request("get", "/api/speech/jobs/x/"), "x")
+        self.assertEqual(resp.status_code, 503)
+
+    def test_status_only_for_creating_session(self):
+        call_command("createcachetable", "test_stt_job_cache", verbosity=0)
+        owner = SessionStore()
+        job = sttjobs.submit_job(b"rec", "vosk", speech._session_owner(self._request("post", "/", owner), create=True))
+
+        resp = speech.speech_job_status(self._request("get", "/", owner), job["id"])
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.content)["text"], "سلام")
+
+        for other in (SessionStore(), None):
+            if other is not None:
+                other.save()
+            resp = speech.speech_job_status(self._request("get", "/", other), job["id"])
+            self.assertEqual(resp.status_code, 404)
+
+
+class SpeechStreamTests(SimpleTestCase):
+    def _post(self, query):
+        req = RequestFactory().post(f"/api/speech/stream/?{query}", b"chunk", content_type="application/octet-stream")
+        req.session = SessionStore()
+        return req
+
+    def _fake_stream(self, owner):
+        st = stt.STTStream.__new__(stt.STTStream)
+        st.sid, st.owner, st.touched = uuid.uuid4().hex, owner, time.monotonic()
+        st.abort = mock.Mock()
+        return st
+
+    def test_stream_is_bound_to_its_session(self):
+        st = self._fake_stream("owner-hash")
+        with mock.patch.object(stt, "_STREAMS", {st.sid: st}):
+            self.assertIs(stt.get_stream(st.sid, "owner-hash"), st)
+            self.assertIsNone(stt.get_stream(st.sid, "other-hash"))
+            self.assertIsNone(stt.get_stream(st.sid, ""))
+
+    def test_open_streams_are_capped(self):
+        streams = {s.sid: s for s in (self._fake_stream("a"), self._fake_stream("b"))}
+        with mock.patch.object(stt, "_STREAMS", streams), mock.patch.object(stt, "STT_MAX_STREAMS", 2), \
+                mock.patch.object(speech, "supports_streaming", return_value=True), \
+                mock.patch.object(stt, "STTStream") as ctor:
+            resp = speech.speech_stream(self._post(""))
+        self.assertEqual(resp.status_code, 503)
+        ctor.assert_not_called()
+
+    def test_busy_engine_in_reader_thread_is_reported_on_feed(self):
+        st = stt.STTStream.__new__(stt.STTStream)
+        st._pipe = mock.Mock()
+        st._pipe.check.side_effect = stt.STTBusy("stt concurrency limit")
+        with self.assertRaises(stt.STTBusy):
+            st.feed(b"chunk")
+        st._pipe.write.assert_not_called()
+
+    def test_busy_maps_to_503_on_feed_and_final(self):
+        for query, method in (("sid=s1", "feed"), ("sid=s1&final=1", "finish")):
+            stream = mock.Mock(sid="s1")
+            stream.feed.return_value = {"sid": "s1", "text": "", "partial": ""}
+            getattr(stream, method).side_effect = stt.STTBusy("stt concurrency limit")
+            with mock.patch.object(speech, "get_stream", return_value=stream), \
+                    mock.patch.object(speech, "close_stream"):
+                resp = speech.speech_stream(self._post(query))
+            self.assertEqual(resp.status_code, 503, query)
+
+    def test_feed_failure_closes_stream(self):
+        stream = mock.Mock(sid="s1")
+        stream.feed.side_effect = BrokenPipeError("ffmpeg exited")
+        req = self._post("sid=s1")
+        with mock.patch.object(speech, "get_stream", return_value=stream), \
+                mock.patch.object(speech, "close_stream") as close:
+            resp = speech.speech_stream(req)
+        self.assertEqual(resp.status_code, 500)
+        self.assertFalse(json.loads(resp.content)["ok"])
+        close.assert_called_once_with("s1")
+        stream.abort.assert_called_once_with()
+
+
+class SharedEngineLoadTests(SimpleTestCase):
+    def test_shareable_model_loads_once_without_deadlock(self):
+        backend = mock.Mock(shareable=True)
+        backend.name = "fake"
+        backend.load.side_effect = lambda: object()
+        eng = stt.STTEngine(backend, max_concurrency=4)
+        got = []
+        threads = [threading.Thread(target=lambda: got.append(eng.shared_model()), daemon=True) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=5)
+        self.assertFalse(any(t.is_alive() for t in threads))
+        self.assertEqual(backend.load.call_count, 1)
+        self.assertEqual(len({id(m) for m in got}), 1)
+        with eng.acquire() as model:
+            self.assertIs(model, got[0])
+        self.assertEqual(eng.stats()["loads"], 1)
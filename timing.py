@@ -0,0 +1,201 @@
+# web/views/timing.py
+# زمان‌سنجی مراحل یک درخواست: هدر Server-Timing، لاگ ساخت‌یافته و متریک‌های Prometheus.
+# وقتی REQUEST_TIMING خاموش است و کسی هم جمع‌آوری نمی‌کند، stage فقط یک ContextVar.get است.
+import hmac, json, time, bisect, logging, threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse
+
+log = logging.getLogger(__name__)
+
+REQUEST_TIMING = bool(getattr(settings, "REQUEST_TIMING", False))
+REQUEST_TIMING_SLOW_MS = float(getattr(settings, "REQUEST_TIMING_SLOW_MS", 0.0))   # لاگ فقط بالاتر از این (0 = همه)
+# /metrics پیش‌فرض بسته است. باز کردن: METRICS_TOKEN (هدر Authorization: Bearer <token>)، یا METRICS_ALLOWED_IPS.
+# پشت nginx/پراکسی محلی REMOTE_ADDR همیشه آدرس پراکسی (مثلاً 127.0.0.1) است؛ آنجا فهرست IP هر درخواستی را
+# راه می‌دهد و فقط وقتی معنی دارد که Prometheus مستقیم به gunicorn وصل شود. پشت پراکسی از توکن استفاده کنید.
+METRICS_TOKEN = getattr(settings, "METRICS_TOKEN", "") or ""
+METRICS_ALLOWED_IPS = set(getattr(settings, "METRICS_ALLOWED_IPS", []))
+
+_SINK: ContextVar[Optional[Dict[str, float]]] = ContextVar("chat_stage_sink", default=None)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    sink = _SINK.get()
+    if sink is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        sink[name] = sink.get(name, 0.0) + (time.perf_counter() - t0)
+
+
+@contextmanager
+def collect_stages() -> Iterator[Dict[str, float]]:
+    """مدت هر stage (ثانیه) در دیکشنری برگشتی جمع می‌شود."""
+    sink: Dict[str, float] = {}
+    token = _SINK.set(sink)
+    try:
+        yield sink
+    finally:
+        _SINK.reset(token)
+
+
+# ============= متریک‌ها =============
+_BUCKETS: Tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Histogram:
+    __slots__ = ("counts", "total", "n")
+
+    def __init__(self):
+        self.counts: List[int] = [0] * (len(_BUCKETS) + 1)
+        self.total = 0.0
+        self.n = 0
+
+    def observe(self, v: float) -> None:
+        self.counts[bisect.bisect_left(_BUCKETS, v)] += 1
+        self.total += v
+        self.n += 1
+
+
+_LOCK = threading.Lock()
+_REQUESTS: Dict[Tuple[str, str], int] = {}
+_REQUEST_HIST: Dict[str, _Histogram] = {}
+_STAGE_HIST: Dict[Tuple[str, str], _Histogram] = {}
+_COLLECTORS: List[Callable[[], List[str]]] = []
+
+
+def register_collector(fn: Callable[[], List[str]]) -> None:
+    """fn سطرهای متنی Prometheus (با HELP/TYPE) برمی‌گرداند و به انتهای /metrics اضافه می‌شود."""
+    _COLLECTORS.append(fn)
+
+
+def _observe(view: str, status: int, total: float, stages: Dict[str, float]) -> None:
+    with _LOCK:
+        key = (view, str(status))
+        _REQUESTS[key] = _REQUESTS.get(key, 0) + 1
+        _REQUEST_HIST.setdefault(view, _Histogram()).observe(total)
+        for name, secs in stages.items():
+            _STAGE_HIST.setdefault((view, name), _Histogram()).observe(secs)
+
+
+def _hist_lines(metric: str, labels: str, h: _Histogram) -> List[str]:
+    out = []
+    acc = 0
+    for le, c in zip(_BUCKETS, h.counts):
+        acc += c
+        out.append(f'{metric}_bucket{{{labels},le="{le}"}} {acc}')
+    out.append(f'{metric}_bucket{{{labels},le="+Inf"}} {h.n}')
+    out.append(f"{metric}_sum{{{labels}}} {h.total:.6f}")
+    out.append(f"{metric}_count{{{labels}}} {h.n}")
+    return out
+
+
+def metrics_text() -> str:
+    with _LOCK:
+        lines = ["# HELP web_requests_total Requests handled by instrumented views.",
+                 "# TYPE web_requests_total counter"]
+        for (view, status), n in sorted(_REQUESTS.items()):
+            lines.append(f'web_requests_total{{view="{view}",status="{status}"}} {n}')
+        lines += ["# HELP web_request_seconds Wall time of instrumented views.",
+                  "# TYPE web_request_seconds histogram"]
+        for view, h in sorted(_REQUEST_HIST.items()):
+            lines += _hist_lines("web_request_seconds", f'view="{view}"', h)
+        lines += ["# HELP web_stage_seconds Time spent in each pipeline stage.",
+                  "# TYPE web_stage_seconds histogram"]
+        for (view, name), h in sorted(_STAGE_HIST.items()):
+            lines += _hist_lines("web_stage_seconds", f'view="{view}",stage="{name}"', h)
+    for fn in _COLLECTORS:
+        lines += fn()
+    return "\n".join(lines) + "\n"
+
+
+def observe(name: str, status: int, total: float, stages: Dict[str, float]) -> None:
+    """ثبت زمان کارهای خارج از چرخهٔ درخواست (مثلاً jobهای پس‌زمینه) در همان متریک‌ها."""
+    if REQUEST_TIMING:
+        _observe(name, status, total, stages)
+
+
+# ============= دکوراتور view =============
+def timed_view(name: str):
+    """
+    کل view و stageهای داخلش را زمان می‌گیرد: هدر Server-Timing، متریک و (برای درخواست‌های کند) لاگ.
+    اگر REQUEST_TIMING خاموش باشد view مستقیم صدا زده می‌شود.
+    """
+    def begin():
+        parent = _SINK.get()
+        sink: Dict[str, float] = {}
+        return parent, sink, _SINK.set(sink), time.perf_counter()
+
+    def end(state, resp):
+        parent, sink, token, t0 = state
+        total = time.perf_counter() - t0
+        _SINK.reset(token)
+        if parent is not None:
+            for k, v in sink.items():
+                parent[k] = parent.get(k, 0.0) + v
+        if resp is None:
+            return
+        status = getattr(resp, "status_code", 0)
+        _observe(name, status, total, sink)
+        parts = [f"{k};dur={v * 1000.0:.2f}" for k, v in sink.items()]
+        parts.append(f"total;dur={total * 1000.0:.2f}")
+        resp["Server-Timing"] = ", ".join(parts)
+        if total * 1000.0 >= REQUEST_TIMING_SLOW_MS:
+            log.info(json.dumps({
+                "event": "request_timing", "view": name, "status": status,
+                "total_ms": round(total * 1000.0, 2),
+                "stages_ms": {k: round(v * 1000.0, 2) for k, v in sink.items()},
+            }))
+
+    def deco(view):
+        if not REQUEST_TIMING:
+            return view
+
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def awrapper(request, *args, **kwargs):
+                state, resp = begin(), None
+                try:
+                    resp = await view(request, *args, **kwargs)
+                    return resp
+                finally:
+                    end(state, resp)
+            return awrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            state, resp = begin(), None
+            try:
+                resp = view(request, *args, **kwargs)
+                return resp
+            finally:
+                end(state, resp)
+        return wrapper
+    return deco
+
+
+# ============= View: متریک‌ها =============
+def _metrics_allowed(request) -> bool:
+    if METRICS_TOKEN:
+        auth = request.META.get("HTTP_AUTHORIZATION", "")
+        if auth.startswith("Bearer ") and hmac.compare_digest(auth[7:].strip(), METRICS_TOKEN):
+            return True
+    if METRICS_ALLOWED_IPS and request.META.get("REMOTE_ADDR") in METRICS_ALLOWED_IPS:
+        return True
+    return settings.DEBUG or getattr(getattr(request, "user", None), "is_staff", False)
+
+
+def metrics(request):
+    """خروجی متنی Prometheus؛ فقط با METRICS_TOKEN، آدرس‌های METRICS_ALLOWED_IPS، یا برای staff/DEBUG."""
+    if not _metrics_allowed(request):
+        return HttpResponse("forbidden\n", status=403, content_type="text/plain")
+    return HttpResponse(metrics_text(), content_type="text/plain; version=0.0.4; charset=utf-8")
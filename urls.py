@@ -1,8 +1,13 @@
+from django.conf import settings
 from django.urls import path
 from django.views.generic import RedirectView
 
-from .views.chat import chat_page, chat_api
-from .views.speech import speech_to_text
+from .views.chat import chat_page, chat_api, chat_api_async, chat_reload, chat_stats, chat_ready
+from .views.speech import (
+    speech_to_text, speech_to_text_async, speech_stream, speech_stats, speech_job_create, speech_job_status,
+    speech_chat, speech_chat_async,
+)
+from .views.timing import metrics
 from .views.feedback import FeedbackCreateView, FeedbackThanksView, request_call
 from .views.contact import ContactUsView
 from .views.articles import article_list, article_detail
@@ -12,6 +17,9 @@ from .views.books import book_list, book_detail
   
 app_name = "web"
 
+# زیر ASGI نسخه‌های async (استنتاج در استخرهای thread جدا) به همان مسیرها وصل می‌شوند
+ASYNC_VIEWS = bool(getattr(settings, "ASYNC_VIEWS", False))
+
 urlpatterns = [
     path("", RedirectView.as_view(pattern_name="web:chat", permanent=False), name="root"),
 
@@ -19,8 +27,17 @@ urlpatterns = [
     path("chat/", chat_page, name="chat"),
 
     # APIها
-    path("api/chat/", chat_api, name="chat_api"),
-    path("api/speech/", speech_to_text, name="api_speech"),
+    path("api/chat/", chat_api_async if ASYNC_VIEWS else chat_api, name="chat_api"),
+    path("api/chat/reload/", chat_reload, name="chat_reload"),
+    path("api/chat/stats/", chat_stats, name="chat_stats"),
+    path("api/chat/ready/", chat_ready, name="chat_ready"),
+    path("api/speech/", speech_to_text_async if ASYNC_VIEWS else speech_to_text, name="api_speech"),
+    path("api/speech/stream/", speech_stream, name="api_speech_stream"),
+    path("api/speech/chat/", speech_chat_async if ASYNC_VIEWS else speech_chat, name="api_speech_chat"),
+    path("api/speech/jobs/", speech_job_create, name="api_speech_jobs"),
+    path("api/speech/jobs/<str:job_id>/", speech_job_status, name="api_speech_job"),
+    path("api/speech/stats/", speech_stats, name="api_speech_stats"),
+    path("metrics/", metrics, name="metrics"),
 
     # بازخورد
     path("feedback/", FeedbackCreateView.as_view(), name="feedback"),
@@ -0,0 +1,232 @@
+# web/views/vindex.py
+# ایندکس برداری روی ماتریس امبدینگ نرمال‌شده (ضرب داخلی = cos_sim):
+#   flat  جستجوی کامل (دقیق)
+#   ivf   خوشه‌بندی k-means کروی + جستجو فقط در nprobe خوشه‌ی نزدیک (numpy خالص، فایل‌ها با mmap)
+#   hnsw  گراف HNSW با hnswlib (اختیاری؛ اگر نصب نباشد در دسترس نیست)؛ mmap نمی‌شود، ببینید HNSWIndex
+import os, json, tempfile
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+INDEX_KINDS = ("flat", "ivf", "hnsw")
+
+
+def topk(scores: np.ndarray, ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """k بهترین امتیاز به ترتیب نزولی؛ در تساوی، شناسهٔ کوچک‌تر جلوتر."""
+    if k < len(scores):
+        part = np.argpartition(-scores, k - 1)[:k]
+        scores, ids = scores[part], ids[part]
+    order = np.lexsort((ids, -scores))
+    return scores[order], ids[order]
+
+
+def _save_npy(path: Path, arr: np.ndarray) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, np.ascontiguousarray(arr), allow_pickle=False)
+        os.replace(tmp, path)
+    except BaseException:
+        try: os.unlink(tmp)
+        except OSError: pass
+        raise
+
+
+def _meta_path(prefix: Path) -> Path:
+    return Path(str(prefix) + ".json")
+
+
+def _read_meta(prefix: Path) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_meta_path(prefix), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(prefix: Path, meta: Dict[str, Any]) -> None:
+    path = _meta_path(prefix)
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=path.name, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp, path)
+
+
+# ============= flat =============
+class FlatIndex:
+    kind = "flat"
+    exact = True
+
+    def __init__(self, vecs: np.ndarray):
+        self.vecs = vecs
+
+    def __len__(self) -> int:
+        return len(self.vecs)
+
+    def search(self, q: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        scores = self.vecs @ q
+        return topk(scores, np.arange(len(scores)), min(k, len(scores)))
+
+    def save(self, prefix: Path, fingerprint: str) -> None:
+        pass                        # خود ماتریس امبدینگ همان ایندکس است
+
+
+# ============= IVF =============
+class IVFIndex:
+    """
+    centroids: [nlist, dim]؛ order: ردیف‌ها مرتب‌شده بر اساس خوشه؛ offsets: [nlist + 1]
+    (ردیف‌های خوشهٔ c در order[offsets[c]:offsets[c+1]]). خود بردارها از ماتریس بانک خوانده می‌شوند.
+    """
+    kind = "ivf"
+    exact = False
+
+    def __init__(self, vecs: np.ndarray, centroids: np.ndarray, order: np.ndarray,
+                 offsets: np.ndarray, nprobe: int = 16):
+        self.vecs = vecs
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.nprobe = max(1, min(int(nprobe), len(centroids)))
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    @staticmethod
+    def resolve_nlist(nlist: int, n: int) -> int:
+        """تعداد خوشهٔ واقعی برای n ردیف (0 = 4·√n)."""
+        nlist = int(nlist) or max(1, int(4 * np.sqrt(n)))
+        return max(1, min(nlist, n))
+
+    @classmethod
+    def build(cls, vecs: np.ndarray, nlist: int = 0, nprobe: int = 16,
+              iters: int = 20, sample: int = 100_000, seed: int = 0) -> "IVFIndex":
+        n = len(vecs)
+        nlist = cls.resolve_nlist(nlist, n)
+        rng = np.random.default_rng(seed)
+        train = np.asarray(vecs[rng.choice(n, size=min(n, sample), replace=False)], dtype=np.float32)
+        cent = train[rng.choice(len(train), size=nlist, replace=False)].copy()
+        for _ in range(iters):
+            assign = np.argmax(train @ cent.T, axis=1)
+            sums = np.zeros_like(cent)
+            np.add.at(sums, assign, train)
+            counts = np.bincount(assign, minlength=nlist)
+            empty = counts == 0
+            if empty.any():
+                # خوشهٔ خالی با یک نقطهٔ تصادفی دوباره مقداردهی می‌شود
+                sums[empty] = train[rng.choice(len(train), size=int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            cent = sums / np.maximum(norms, 1e-12)
+        assign = np.empty(n, dtype=np.int64)
+        for off in range(0, n, 8192):
+            assign[off:off + 8192] = np.argmax(np.asarray(vecs[off:off + 8192], dtype=np.float32) @ cent.T, axis=1)
+        order = np.argsort(assign, kind="stable").astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+        return cls(vecs, cent.astype(np.float32), order, offsets, nprobe)
+
+    def search(self, q: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        cs = self.centroids @ q
+        probe = np.argpartition(-cs, self.nprobe - 1)[:self.nprobe] if self.nprobe < len(cs) else np.arange(len(cs))
+        ids = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probe])
+        if not len(ids):
+            return np.zeros(0, dtype=np.float32), ids
+        scores = np.asarray(self.vecs[ids], dtype=np.float32) @ q
+        return topk(scores, ids, min(k, len(ids)))
+
+    def save(self, prefix: Path, fingerprint: str) -> None:
+        _save_npy(Path(str(prefix) + ".centroids.npy"), self.centroids)
+        _save_npy(Path(str(prefix) + ".order.npy"), self.order)
+        _save_npy(Path(str(prefix) + ".offsets.npy"), self.offsets)
+        _write_meta(prefix, {"kind": self.kind, "fingerprint": fingerprint, "count": len(self),
+                             "nlist": int(len(self.centroids))})
+
+    @classmethod
+    def load(cls, prefix: Path, vecs: np.ndarray, fingerprint: str, nprobe: int = 16,
+             nlist: int = 0) -> Optional["IVFIndex"]:
+        """None اگر فایل‌ها برای این بانک یا nlist دیگری ساخته شده باشند (بازسازی می‌شود)."""
+        meta = _read_meta(prefix)
+        if not meta or meta.get("kind") != cls.kind or meta.get("fingerprint") != fingerprint \
+                or meta.get("count") != len(vecs) or meta.get("nlist") != cls.resolve_nlist(nlist, len(vecs)):
+            return None
+        try:
+            load = lambda s: np.load(str(prefix) + s, mmap_mode="r", allow_pickle=False)
+            return cls(vecs, load(".centroids.npy"), load(".order.npy"), load(".offsets.npy"), nprobe)
+        except (OSError, ValueError):
+            return None
+
+
+# ============= HNSW (اختیاری) =============
+class HNSWIndex:
+    """
+    برخلاف IVF، hnswlib فایل گراف را با load_index در حافظهٔ خصوصی پروسه می‌خواند و mmap ندارد؛
+    هر worker کپی خودش از گراف را دارد (فقط ماتریس بانک بین workerها مشترک است).
+    """
+    kind = "hnsw"
+    exact = False
+
+    def __init__(self, index: Any, count: int, ef: int = 128, max_k: int = 0):
+        # ef یک بار و دست‌کم برابر بزرگ‌ترین k تنظیم می‌شود؛ set_ef حالت مشترک ایندکس است
+        # و تغییرش هنگام جستجو روی جستجوهای هم‌زمان threadهای دیگر اثر می‌گذارد
+        self.index = index
+        self.count = count
+        self.index.set_ef(max(int(ef), int(max_k), 1))
+
+    def __len__(self) -> int:
+        return self.count
+
+    @classmethod
+    def build(cls, vecs: np.ndarray, ef: int = 128, M: int = 16, ef_construction: int = 200,
+              max_k: int = 0) -> "HNSWIndex":
+        import hnswlib
+        n, dim = vecs.shape
+        idx = hnswlib.Index(space="ip", dim=int(dim))
+        idx.init_index(max_elements=n, ef_construction=ef_construction, M=M)
+        idx.add_items(np.asarray(vecs, dtype=np.float32), np.arange(n))
+        return cls(idx, n, ef, max_k)
+
+    def search(self, q: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        k = min(k, self.count)
+        labels, dist = self.index.knn_query(q[None, :].astype(np.float32), k=k)
+        # فاصلهٔ ip در hnswlib برابر 1 - ضرب داخلی است
+        return topk(1.0 - dist[0].astype(np.float32), labels[0].astype(np.int64), k)
+
+    def save(self, prefix: Path, fingerprint: str) -> None:
+        path = Path(str(prefix) + ".bin")
+        fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=path.name, suffix=".tmp")
+        os.close(fd)
+        self.index.save_index(tmp)
+        os.replace(tmp, path)
+        _write_meta(prefix, {"kind": self.kind, "fingerprint": fingerprint, "count": self.count})
+
+    @classmethod
+    def load(cls, prefix: Path, vecs: np.ndarray, fingerprint: str, ef: int = 128,
+             max_k: int = 0) -> Optional["HNSWIndex"]:
+        meta = _read_meta(prefix)
+        if not meta or meta.get("kind") != cls.kind or meta.get("fingerprint") != fingerprint \
+                or meta.get("count") != len(vecs):
+            return None
+        import hnswlib
+        idx = hnswlib.Index(space="ip", dim=int(vecs.shape[1]))
+        try:
+            idx.load_index(str(prefix) + ".bin", max_elements=len(vecs))
+        except (OSError, RuntimeError):
+            return None
+        return cls(idx, len(vecs), ef, max_k)
+
+
+# ============= ارزیابی =============
+def recall_at_k(index: Any, exact: FlatIndex, queries: np.ndarray, ks: Sequence[int] = (1, 10, 50)) -> Dict[int, float]:
+    """میانگین |نتایج ایندکس ∩ نتایج دقیق| / k برای هر k."""
+    out: Dict[int, float] = {}
+    for k in ks:
+        k = min(k, len(exact))
+        if k <= 0 or not len(queries):
+            continue
+        hit = 0
+        for q in queries:
+            _, truth = exact.search(q, k)
+            _, got = index.search(q, k)
+            hit += len(np.intersect1d(truth, got))
+        out[k] = hit / (k * len(queries))
+    return out
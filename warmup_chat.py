@@ -0,0 +1,18 @@
+# web/management/commands/warmup_chat.py
+# گرم کردن موتور چت: دانلود/لود مدل، ساخت امبدینگ بانک (و ذخیرهٔ فایل mmap)، استنتاج آزمایشی
+#   python manage.py warmup_chat
+from django.core.management.base import BaseCommand, CommandError
+
+from web.views.chat import warmup
+
+
+class Command(BaseCommand):
+    help = "Load the sentence encoder, build bank embeddings and run a dummy inference, reporting per-step timings."
+
+    def handle(self, *args, **opts):
+        status = warmup()
+        for name, secs in status["timings"].items():
+            self.stdout.write(f"{name:<16} {secs:8.3f}s")
+        if not status["ready"]:
+            raise CommandError(f"warmup failed: {status['error']}")
+        self.stdout.write(self.style.SUCCESS(f"ready (bank version {status['bank_version']})"))